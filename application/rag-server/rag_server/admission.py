@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from fastapi import HTTPException, status
+
+from constants import ADMISSION_LIMITS
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Bounds the requests one endpoint serves at a time on the worker. Requests over
+# max_concurrent wait in a FIFO queue, a request is rejected right away when the
+# queue already holds max_queue requests, or once it waited max_queue_wait seconds.
+# Slots are taken on the event loop, release() may be called from any thread
+class AdmissionController:
+    def __init__(self, name, max_concurrent, max_queue, max_queue_wait):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.waiters = deque()
+        self.loop = None
+        self._stats_lock = threading.Lock()
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_queue_timeout = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait = 0.0
+        # Moving average of how long admitted requests hold their slot
+        self.avg_service_time = 1.0
+
+    # Estimated seconds until a rejected request would find room in the queue
+    def retry_after(self):
+        backlog = len(self.waiters) + 1
+        return max(1, math.ceil(self.avg_service_time * backlog / self.max_concurrent))
+
+    def _reject(self, reason, stat):
+        setattr(self, stat, getattr(self, stat) + 1)
+        retry_after = self.retry_after()
+        logger.warning(
+            f"Rejected {self.name} request, {reason}: {self.in_flight} in flight, "
+            f"{len(self.waiters)} queued, retry after {retry_after}s"
+        )
+        raise AdmissionRejected(
+            f"Server is busy, {reason}. Retry in {retry_after}s", retry_after
+        )
+
+    # Waits for a slot and returns the function that gives it back, raises
+    # AdmissionRejected when the request should be shed instead
+    async def acquire(self):
+        self.loop = asyncio.get_running_loop()
+        queued_at = time.monotonic()
+        if self.in_flight < self.max_concurrent and not self.waiters:
+            self.in_flight += 1
+        else:
+            if len(self.waiters) >= self.max_queue:
+                self._reject("the queue is full", "rejected_queue_full")
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.waiters))
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.max_queue_wait)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as the wait ended, pass it on
+                    self._release_slot()
+                else:
+                    waiter.cancel()
+                    self.waiters.remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._reject(
+                    f"no slot within {self.max_queue_wait}s", "rejected_queue_timeout"
+                )
+
+        admitted_at = time.monotonic()
+        self.admitted += 1
+        self.total_queue_wait += admitted_at - queued_at
+        return self._release_function(admitted_at)
+
+    def _release_function(self, admitted_at):
+        released = threading.Event()
+        lock = threading.Lock()
+
+        def release():
+            with lock:
+                if released.is_set():
+                    return
+                released.set()
+            with self._stats_lock:
+                service_time = time.monotonic() - admitted_at
+                self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * service_time
+            try:
+                on_loop = asyncio.get_running_loop() is self.loop
+            except RuntimeError:
+                on_loop = False
+            if on_loop:
+                self._release_slot()
+            else:
+                self.loop.call_soon_threadsafe(self._release_slot)
+
+        return release
+
+    # The slot goes straight to the oldest waiter, so in_flight only drops when
+    # nobody is queued
+    def _release_slot(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self.waiters),
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_queue_timeout": self.rejected_queue_timeout,
+            "avg_queue_wait": (
+                self.total_queue_wait / self.admitted if self.admitted else 0.0
+            ),
+            "avg_service_time": self.avg_service_time,
+        }
+
+
+admission_controllers = {
+    endpoint: AdmissionController(endpoint, **limits)
+    for endpoint, limits in ADMISSION_LIMITS.items()
+}
+
+
+def admission_stats():
+    return {
+        endpoint: controller.stats()
+        for endpoint, controller in admission_controllers.items()
+    }
+
+
+# Shed requests get a 429 with a Retry-After header
+async def admit_request(endpoint):
+    try:
+        return await admission_controllers[endpoint].acquire()
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
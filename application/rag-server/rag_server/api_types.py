@@ -4,6 +4,9 @@ from typing import Any, Dict, List, Optional, Union
 from fastapi import FastAPI
 from pydantic import BaseModel, Field, validator
 
+from constants import (CONTEXT_TOKEN_BUDGET, DEADLINE_ANSWER_RESERVE,
+                       HISTORY_TOKEN_CEILING, MAX_TOOL_ROUNDS,
+                       REQUEST_DEADLINE)
 from llm.prompts import baseline_sys_prompt
 
 app = FastAPI()
@@ -24,6 +27,13 @@ class CoarseSearchType(str, Enum):
     mmr = "mmr"
 
 
+class StreamFormat(str, Enum):
+    # Accumulated message snapshots on every delta
+    v1 = "v1"
+    # Typed text_delta, tool_call, tool_result and done events
+    v2 = "v2"
+
+
 class SelfQueryApi(str, Enum):
     OpenAI = "OpenAI"
     Azure = "Azure"
@@ -51,6 +61,20 @@ class ConfigParams(BaseModel):
     self_query_api: Optional[SelfQueryApi] = SelfQueryApi.OpenAI
     self_query_model: Optional[str] = "gpt-4o-mini"
 
+    # Search on the raw prompt while the first model call runs
+    prefetch_retrieval: Optional[bool] = False
+
+    # Estimated tokens of recipe context each recipe db tool call may return
+    context_token_budget: int = Field(CONTEXT_TOKEN_BUDGET, ge=1)
+    # Estimated history tokens before old tool results are compacted, 0 disables
+    history_token_ceiling: Optional[int] = HISTORY_TOKEN_CEILING
+
+    # Seconds a chat request may take, and model turns with tool calls it may make
+    # before the model has to answer. The last DEADLINE_ANSWER_RESERVE seconds are
+    # kept for the answer, a shorter deadline would leave no time for tool calls
+    request_deadline: float = Field(REQUEST_DEADLINE, gt=DEADLINE_ANSWER_RESERVE)
+    max_tool_rounds: int = Field(MAX_TOOL_ROUNDS, ge=1)
+
     class Config:
         extra = "forbid"
 
@@ -145,6 +169,8 @@ class ConverseChatRequest(BaseModel):
     # This is always a user prompt to start or continue existing dialogue
     prompt: str
     config: ConfigParams = Field(default_factory=default_config_params)
+    # Always generate a fresh answer, even if the response cache has a close match
+    bypass_cache: Optional[bool] = False
 
     class Config:
         extra = "forbid"
@@ -169,10 +195,17 @@ class DynamicTunersRequest(BaseModel):
 
 class ChatRequest(BaseModel):
     # Any existing state from previous dialogue, or an empty list if this is the first prompt
-    existing_chat_history: List[Message]
+    # Not sent when the conversation is kept in a server side session
+    existing_chat_history: List[Message] = Field(default_factory=list)
     # This is always a user prompt to start or continue existing dialogue
     prompt: str
     config: ConfigParams = Field(default_factory=default_config_params)
+    # Always generate a fresh answer, even if the response cache has a close match
+    bypass_cache: Optional[bool] = False
+
+    # Keep the chat history on the server, without a session_id a new session is started
+    use_session: Optional[bool] = False
+    session_id: Optional[str] = None
 
     class Config:
         extra = "forbid"
@@ -195,7 +228,12 @@ class ChatHistoryResponse(BaseModel):
 
     # The existing chat history, with the newly added messages
     # this includes any tool calls, tool responses, and the llm response
-    new_chat_history: List[Message]
+    # Only set for requests that don't use a session
+    new_chat_history: Optional[List[Message]] = None
+
+    # Session requests only get the messages added by this turn
+    session_id: Optional[str] = None
+    new_messages: Optional[List[Message]] = None
 
     # fn_calls: PromptFnCalls
     fn_calls: Any  # FIX THIS
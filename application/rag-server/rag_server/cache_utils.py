@@ -0,0 +1,174 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Thread safe in-process LRU with an optional per entry time to live
+class LRUCache:
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# File backed key value store shared by every gunicorn worker on the host. SQLite
+# handles the cross process locking, each thread gets its own connection.
+# Entries are evicted oldest first once max_entries is exceeded
+class SqliteCache:
+    EVICTION_INTERVAL = 100  # Check the size limit every N writes
+
+    def __init__(self, path, table, max_entries, ttl=None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        # Connections are per thread but the instance is shared, so is the counter
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._connection().execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection().execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)"
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    # Returns (value, created_at) regardless of ttl so callers can revalidate stale entries
+    def get_entry(self, key):
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read {self.table} cache entry: {e}")
+            return None
+        return row
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        value, created_at = entry
+        if self.ttl is not None and time.time() - created_at > self.ttl:
+            return None
+        return value
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, created_at=None):
+        self.set_many([(key, value)], created_at)
+
+    def set_many(self, items, created_at=None):
+        created_at = created_at or time.time()
+        try:
+            self._connection().executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                [(key, value, created_at) for key, value in items],
+            )
+            with self._writes_lock:
+                self._writes += len(items)
+                should_evict = self._writes >= self.EVICTION_INTERVAL
+                if should_evict:
+                    self._writes = 0
+            if should_evict:
+                self.evict()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to write {self.table} cache entries: {e}")
+
+    def evict(self):
+        connection = self._connection()
+        if self.ttl is not None:
+            connection.execute(
+                f"DELETE FROM {self.table} WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+        connection.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f"SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def delete(self, key):
+        try:
+            self._connection().execute(
+                f"DELETE FROM {self.table} WHERE key = ?", (key,)
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to delete {self.table} cache entry: {e}")
+
+    def clear(self):
+        try:
+            self._connection().execute(f"DELETE FROM {self.table}")
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to clear {self.table} cache: {e}")
+
+    def __len__(self):
+        try:
+            return (
+                self._connection()
+                .execute(f"SELECT COUNT(*) FROM {self.table}")
+                .fetchone()[0]
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to count {self.table} cache entries: {e}")
+            return 0
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+
+from constants import CIRCUIT_BREAKERS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Tracks the calls to one external dependency within the worker. Failed calls and
+# calls slower than slow_call_seconds count against it, after failure_threshold of
+# them in a row the breaker opens and callers skip the dependency. Once reset_timeout
+# has passed it is half open and allow() lets a single trial call through, its result
+# closes or re-opens the breaker. A trial that never reports back is given up after
+# another reset_timeout
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold, slow_call_seconds, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    # True while calls are being skipped, without counting a rejection
+    def is_open(self):
+        with self._lock:
+            self._refresh_state()
+            return self.state == OPEN or self.trial_started_at is not None
+
+    # Called with the lock held. Results may also be recorded for calls that didn't
+    # ask allow() first, so every method moves a timed out breaker to half open
+    def _refresh_state(self):
+        if (
+            self.state == OPEN
+            and time.monotonic() - self.opened_at >= self.reset_timeout
+        ):
+            self.state = HALF_OPEN
+            self.trial_started_at = None
+            logger.info(f"{self.name} circuit half open, letting a trial call through")
+        elif (
+            self.trial_started_at is not None
+            and time.monotonic() - self.trial_started_at >= self.reset_timeout
+        ):
+            self.trial_started_at = None
+            logger.warning(f"{self.name} trial call never finished, allowing another")
+
+    # False while the breaker is open or its trial call is still running, counts the
+    # call as rejected
+    def allow(self):
+        with self._lock:
+            self._refresh_state()
+            if self.state == OPEN or self.trial_started_at is not None:
+                self.rejected += 1
+                return False
+            if self.state == HALF_OPEN:
+                self.trial_started_at = time.monotonic()
+            return True
+
+    def record_success(self, duration):
+        if duration > self.slow_call_seconds:
+            self._record_failure(slow=True)
+            return
+        with self._lock:
+            self._refresh_state()
+            self.calls += 1
+            self.consecutive_failures = 0
+            self.trial_started_at = None
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                logger.info(f"{self.name} circuit closed")
+
+    def record_failure(self):
+        self._record_failure(slow=False)
+
+    def _record_failure(self, slow):
+        with self._lock:
+            self._refresh_state()
+            self.calls += 1
+            if slow:
+                self.slow_calls += 1
+            else:
+                self.failures += 1
+            self.consecutive_failures += 1
+            self.trial_started_at = None
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED
+                and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.error(
+                    f"{self.name} circuit opened after {self.consecutive_failures} "
+                    f"failed or slow calls, skipping it for {self.reset_timeout}s"
+                )
+
+    # Raises CircuitOpenError without calling func while the breaker is open
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success(time.monotonic() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "rejected": self.rejected,
+                "times_opened": self.times_opened,
+            }
+
+
+circuit_breakers = {
+    name: CircuitBreaker(name, **settings)
+    for name, settings in CIRCUIT_BREAKERS.items()
+}
+
+
+def circuit_breaker_stats():
+    return {name: breaker.stats() for name, breaker in circuit_breakers.items()}
@@ -1,11 +1,82 @@
 MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+# Bounds on blocking work the async handlers hand off to threads, per worker
+BEDROCK_MAX_CONCURRENCY = 16
+RETRIEVAL_MAX_CONCURRENCY = 8
+
+# Admission control per chat endpoint and worker. Requests over max_concurrent wait
+# in a queue of at most max_queue for up to max_queue_wait seconds, anything beyond
+# that is rejected right away with 429 and Retry-After
+ADMISSION_LIMITS = {
+    "chat": {"max_concurrent": 8, "max_queue": 16, "max_queue_wait": 10},
+    "chat_stream": {"max_concurrent": 8, "max_queue": 16, "max_queue_wait": 10},
+}
+
+# Every chat request gets a time budget covering its Bedrock calls and tool calls.
+# Tool calls only get the time left after the reserve, which is kept for the final
+# answer, the model is asked to answer once the reserve is reached or after the
+# last tool round
+REQUEST_DEADLINE = 90
+DEADLINE_ANSWER_RESERVE = 20
+MAX_TOOL_ROUNDS = 4
+# Client timeouts, a call that outlives the request deadline is abandoned by the
+# request but still holds its thread until these expire
+BEDROCK_CONNECT_TIMEOUT = 5
+BEDROCK_READ_TIMEOUT = 60
+QDRANT_TIMEOUT = 10
+SELF_QUERY_TIMEOUT = 15
+
+# Circuit breakers per external dependency and worker. Failed calls and calls slower
+# than slow_call_seconds count against a dependency, after failure_threshold of them
+# in a row it is skipped for reset_timeout seconds and requests degrade instead:
+# self_query_chain -> reranker -> coarse retrieval, web search is not run
+CIRCUIT_BREAKERS = {
+    "openai": {"failure_threshold": 3, "slow_call_seconds": 8, "reset_timeout": 30},
+    "reranker": {"failure_threshold": 3, "slow_call_seconds": 3, "reset_timeout": 30},
+    "qdrant": {"failure_threshold": 3, "slow_call_seconds": 3, "reset_timeout": 15},
+    "google_search": {
+        "failure_threshold": 3,
+        "slow_call_seconds": 4,
+        "reset_timeout": 60,
+    },
+}
+
+# Tool calls from one model turn run in parallel, limits are per tool per worker
+TOOL_EXECUTOR_WORKERS = 16
+TOOL_CONCURRENCY_LIMITS = {"query_food_recipe_vector_db": 8, "google_web_search": 4}
+
+# Vector searches started while the model is still streaming its tool input
+SPECULATIVE_RETRIEVAL_WORKERS = 8
+
+# Prompt prefetch, model queries at least this similar to the prompt reuse its documents
+PREFETCH_WORKERS = 8
+PREFETCH_SIMILARITY_THRESHOLD = 0.85
 EMBEDDING_MODEL_ID = "multi-qa-mpnet-base-dot-v1"
 RERANKER_MODEL_ID = "BAAI/bge-reranker-base"
 
+# Inference backend for the embedding and reranker models
+INFERENCE_BACKEND = "torch"  # options: torch, onnx, onnx_int8
+ONNX_MODEL_DIR = "data/onnx_models"
+
+# Optional local inference sidecar shared by all workers, see inference_server.py
+USE_INFERENCE_SIDECAR = False
+INFERENCE_SOCKET_PATH = "/tmp/rag-inference.sock"
+INFERENCE_MAX_BATCH_SIZE = 64
+INFERENCE_MAX_WAIT_MS = 5
+INFERENCE_TIMEOUT = 30
+# run.sh waits this long for the sidecar to load its models before starting the
+# workers without it
+INFERENCE_STARTUP_TIMEOUT = 300
+
 BUCKET_NAME = "recipes-rag"
 FILE_KEY = "recipes_w_cleaning_time_combined_features.parquet"
 DOWNLOAD_PATH = "data"
 
+# Query embedding cache, the disk tier is shared by all workers on the host
+EMBEDDING_CACHE_SIZE = 4096
+EMBEDDING_CACHE_PATH = "data/embedding_cache.sqlite3"
+EMBEDDING_CACHE_MAX_DISK_ENTRIES = 100000
+
 # Qdrant Store
 MAX_DOC_COUNT = 150
 QDRANT_HOST_URL = "http://localhost:6333"
@@ -16,6 +87,33 @@ QDRANT_S3_PATH = "qdrant/recipe_db_snapshot"
 # Retriever type
 RETRIEVER = "self_query_chain"  # options: coarse, reranker, self_query_chain
 
+# Max number of distinct retriever configs each worker keeps built in memory
+RETRIEVER_CACHE_SIZE = 16
+
+# Tool results, the shared file backed tier is reused by every worker on the host
+TOOL_CACHE_SIZE = 1024
+TOOL_CACHE_TTLS = {"query_food_recipe_vector_db": 24 * 3600}
+USE_SHARED_TOOL_CACHE = False
+TOOL_CACHE_PATH = "data/tool_cache.sqlite3"
+TOOL_CACHE_MAX_DISK_ENTRIES = 20000
+# Semantic response cache for first turn prompts, answers are reused for prompts whose
+# embedding is at least this similar under the same generation config
+USE_RESPONSE_CACHE = False
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.92
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 6 * 3600
+
+# Server side chat sessions, sqlite is shared by all workers on the host while memory
+# only works with a single worker
+SESSION_STORE_BACKEND = "sqlite"  # options: memory, sqlite
+SESSION_STORE_PATH = "data/sessions.sqlite3"
+SESSION_TTL = 24 * 3600
+SESSION_MAX_COUNT = 10000
+
+# Touched whenever the collection is re-created or restored, cached results from
+# before that no longer match
+COLLECTION_EPOCH_PATH = "data/collection_epoch"
+
 # Coarse Retriever Config
 COARSE_SEARCH_TYPE = "similarity"
 COARSE_TOP_K = 5
@@ -24,6 +122,27 @@ COARSE_LAMBDA = 0.5
 # Reranker Config
 RERANKER_TOP_N = 1
 
+# Recipe DB tool results, estimated tokens allowed per tool call and the character
+# caps for the long fields, fields are listed from most to least important
+CONTEXT_TOKEN_BUDGET = 2500
+CONTEXT_CHARS_PER_TOKEN = 4
+CONTEXT_FIELD_LIMITS = {
+    "recipe_category": 80,
+    "aggregated_rating": 10,
+    "review_count": 10,
+    "description": 300,
+    "recipe_ingredient_parts": 500,
+    "recipe_instructions": 1200,
+    "keywords": 150,
+}
+# Fields still sent for lower ranked recipes once the full ones no longer fit
+CONTEXT_COMPACT_FIELDS = ["aggregated_rating", "recipe_ingredient_parts"]
+
+# Chat history sent to Bedrock, estimated tokens above which old tool results are
+# elided, the most recent turns are always sent verbatim
+HISTORY_TOKEN_CEILING = 12000
+HISTORY_KEEP_RECENT_TURNS = 2
+
 # Self-query llm config
 ## Potentially make this dynamically generated based on metadata fields called
 SELF_QUERY_API = "OpenAI"  # OpenAI or Azure
@@ -36,3 +155,21 @@ config_test_dict = {var: eval(var) for var in dir() if not var.startswith("__")}
 GCP_CSE_ID = "b20454e29b3b14095"
 NUM_SEARCH_RESULTS = "3"
 WEB_MAX_CONTENT_LENGTH = 1000
+# Web search tool, every search and page fetch of one tool call shares a single deadline
+WEB_SEARCH_DEADLINE = 6
+WEB_REQUEST_TIMEOUT = 3
+WEB_MAX_CONNECTIONS = 32
+WEB_MAX_CONNECTIONS_PER_HOST = 8
+# Pages are read in chunks until enough text is collected or the byte cap is reached
+WEB_READ_CHUNK_SIZE = 16 * 1024
+WEB_MAX_PAGE_BYTES = 512 * 1024
+# Search results and page text are cached on disk for every worker on the host.
+# Entries older than their ttl are revalidated with a conditional request and are
+# dropped once older than WEB_CACHE_MAX_STALE
+USE_WEB_CACHE = True
+WEB_CACHE_PATH = "data/web_cache.sqlite3"
+WEB_SEARCH_CACHE_TTL = 6 * 3600
+WEB_PAGE_CACHE_TTL = 24 * 3600
+WEB_CACHE_MAX_STALE = 7 * 24 * 3600
+WEB_SEARCH_CACHE_MAX_ENTRIES = 5000
+WEB_PAGE_CACHE_MAX_ENTRIES = 20000
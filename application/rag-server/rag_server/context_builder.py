@@ -0,0 +1,221 @@
+import hashlib
+import logging
+import re
+import threading
+
+from constants import (CONTEXT_CHARS_PER_TOKEN, CONTEXT_COMPACT_FIELDS,
+                       CONTEXT_FIELD_LIMITS, CONTEXT_TOKEN_BUDGET)
+
+logger = logging.getLogger(__name__)
+
+# Every recipe in a tool result starts with a "Recipe: <name> (id: <id>)" line, it is
+# also how recipes that were already sent are recognized in the chat history of later
+# requests
+RECIPE_HEADER_PATTERN = re.compile(r"^Recipe: .*? \(id: ([^)\s]+)\)$", re.MULTILINE)
+
+_stats_lock = threading.Lock()
+context_stats = {
+    "tool_results": 0,
+    "recipes_sent": 0,
+    "recipes_compacted": 0,
+    "recipes_omitted": 0,
+    "recipes_already_seen": 0,
+    "tokens_before": 0,
+    "tokens_after": 0,
+    "tokens_saved": 0,
+}
+
+
+def record_stats(**counts):
+    with _stats_lock:
+        for name, count in counts.items():
+            context_stats[name] += count
+
+
+# Rough estimate, close enough for English text with Claude's tokenizer
+def estimate_tokens(text):
+    return -(-len(text) // CONTEXT_CHARS_PER_TOKEN)
+
+
+# Estimated size of the tool result format_docs would have built, summed from the
+# field lengths instead of rendering it
+def unbudgeted_tokens(context_docs):
+    chars = 0
+    for query, documents in context_docs.items():
+        chars += len(query)
+        for doc in documents:
+            chars += len(doc.page_content)
+            chars += sum(
+                len(key) + len(str(value)) for key, value in doc.metadata.items()
+            )
+    return -(-chars // CONTEXT_CHARS_PER_TOKEN)
+
+
+# Collections ingested before recipe ids existed fall back to the Qdrant point id
+def recipe_id(doc):
+    recipe_id = doc.metadata.get("recipe_id") or doc.metadata.get("_id")
+    if recipe_id:
+        return str(recipe_id)
+    return hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()[:16]
+
+
+def recipe_name(doc):
+    return doc.metadata.get("name") or "No Name Available"
+
+
+def recipe_reference(doc):
+    return f"{recipe_name(doc)} (id: {recipe_id(doc)})"
+
+
+# create_documents fills empty fields with "No ... Available"
+def is_missing(value):
+    value = str(value)
+    return not value or (value.startswith("No ") and value.endswith(" Available"))
+
+
+def truncate(value, limit):
+    value = str(value)
+    if len(value) <= limit:
+        return value
+    return value[:limit].rsplit(" ", 1)[0] + "..."
+
+
+def render_recipe(doc, fields):
+    lines = [f"Recipe: {recipe_reference(doc)}"]
+    for field in fields:
+        value = doc.metadata.get(field)
+        if value is None or is_missing(value):
+            continue
+        lines.append(f"{field}: {truncate(value, CONTEXT_FIELD_LIMITS[field])}")
+    return "\n".join(lines)
+
+
+# Recipes already sent to the model during a conversation, shared by the parallel
+# tool calls of a request
+class SeenRecipes:
+    def __init__(self, keys=None):
+        self._keys = set(keys or [])
+        self._lock = threading.Lock()
+
+    # Returns False if the recipe was already seen
+    def add(self, key):
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._keys.discard(key)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def _collect_text(value, texts):
+    if isinstance(value, str):
+        texts.append(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_text(item, texts)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_text(item, texts)
+
+
+# Recipes sent in earlier tool results, both the invoke_model and converse schemas
+def seen_recipes_from_history(messages):
+    keys = set()
+    for message in messages or []:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for block in content:
+            if not isinstance(block, dict):
+                continue
+            if block.get("type") == "tool_result" or "toolResult" in block:
+                texts = []
+                _collect_text(block, texts)
+                for text in texts:
+                    keys.update(RECIPE_HEADER_PATTERN.findall(text))
+    return keys
+
+
+# Replaces format_docs for the recipe db tool. Recipes are taken round robin over the
+# queries so every query gets its best match before any query gets a second one.
+# Recipes the model has already seen are only referenced by name and id, the rest are sent
+# in full while they fit the budget, then with the compact fields, then omitted
+def build_recipe_context(
+    context_docs, seen_recipes=None, token_budget=CONTEXT_TOKEN_BUDGET
+):
+    seen_recipes = seen_recipes if seen_recipes is not None else SeenRecipes()
+    budget_chars = token_budget * CONTEXT_CHARS_PER_TOKEN
+    full_fields = list(CONTEXT_FIELD_LIMITS)
+
+    max_rank = max((len(documents) for documents in context_docs.values()), default=0)
+    ranked = [
+        (query, documents[rank])
+        for rank in range(max_rank)
+        for query, documents in context_docs.items()
+        if rank < len(documents)
+    ]
+
+    rendered = {query: [] for query in context_docs}
+    already_seen = {query: [] for query in context_docs}
+    used_chars = 0
+    compacted = 0
+    omitted = 0
+    for query, doc in ranked:
+        key = recipe_id(doc)
+        # Repeats, from another query of this call or an earlier tool round, are only
+        # referenced and never rendered
+        if not seen_recipes.add(key):
+            already_seen[query].append(recipe_reference(doc))
+            continue
+
+        text = render_recipe(doc, full_fields)
+        if used_chars + len(text) > budget_chars:
+            text = render_recipe(doc, CONTEXT_COMPACT_FIELDS)
+            compacted += 1
+        if used_chars + len(text) > budget_chars:
+            # Not sent, so a later tool call may still send it
+            seen_recipes.discard(key)
+            compacted -= 1
+            omitted += 1
+            continue
+        used_chars += len(text)
+        rendered[query].append(text)
+
+    sections = []
+    for query in context_docs:
+        section = [f"Query: {query}"]
+        section.extend(rendered[query])
+        if already_seen[query]:
+            section.append(f"Already provided: {', '.join(already_seen[query])}")
+        if len(section) == 1:
+            section.append("No new recipes found")
+        sections.append("\n\n".join(section))
+    if omitted:
+        sections.append(
+            f"{omitted} lower ranked recipes omitted to fit the context budget"
+        )
+    content = "\n---\n".join(sections)
+
+    tokens_before = unbudgeted_tokens(context_docs)
+    tokens_after = estimate_tokens(content)
+    record_stats(
+        tool_results=1,
+        recipes_sent=sum(len(texts) for texts in rendered.values()),
+        recipes_compacted=compacted,
+        recipes_omitted=omitted,
+        recipes_already_seen=sum(len(keys) for keys in already_seen.values()),
+        tokens_before=tokens_before,
+        tokens_after=tokens_after,
+        tokens_saved=max(0, tokens_before - tokens_after),
+    )
+    logger.info(
+        f"Built recipe context with ~{tokens_after} tokens, "
+        f"~{tokens_before - tokens_after} fewer than the unbudgeted format"
+    )
+    return content
@@ -1,8 +1,10 @@
 import asyncio
 import concurrent.futures
+import hashlib
 import json
 import logging
 import os
+import uuid
 from traceback import format_exc
 
 import boto3
@@ -17,9 +19,13 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_qdrant import Qdrant
 from qdrant_client import QdrantClient
 
+from circuit_breaker import CircuitOpenError
 from constants import (BUCKET_NAME, DOWNLOAD_PATH, EMBEDDING_MODEL_ID,
                        FILE_KEY, QDRANT_COLLECTION_NAME, QDRANT_HOST_URL,
-                       QDRANT_SNAPSHOT_URL)
+                       QDRANT_SNAPSHOT_URL, QDRANT_TIMEOUT,
+                       RETRIEVAL_MAX_CONCURRENCY)
+from model_utils import get_embedding_model
+from tool_cache import bump_collection_epoch
 
 logger = logging.getLogger(__name__)
 
@@ -133,6 +139,20 @@ def download_s3_folder(bucket_name, s3_folder, local_dir):
                     logger.error(f"PermissionError: {e}. Cannot write to {local_path}")
 
 
+# Recipes are identified by their content so the id survives re-ingesting the data,
+# the Qdrant point id is derived from it
+RECIPE_ID_NAMESPACE = uuid.UUID("5b1f0c4e-2f61-4c1a-9a3e-7d1c8b0f6a52")
+
+
+def generate_recipe_id(name, instructions):
+    key_text = f"{name.strip().lower()}\n{instructions.strip()}"
+    return hashlib.sha1(key_text.encode("utf-8")).hexdigest()[:16]
+
+
+def recipe_point_id(recipe_id):
+    return str(uuid.uuid5(RECIPE_ID_NAMESPACE, recipe_id))
+
+
 def create_documents(df):
     df_copy = df.copy(deep=True)
     df_copy = df_copy.astype({"AggregatedRating": float, "ReviewCount": int})
@@ -174,6 +194,7 @@ def create_documents(df):
             "review_count": (
                 row["ReviewCount"] if row["ReviewCount"] else "No Reviews Available"
             ),
+            "recipe_id": generate_recipe_id(row["Name"], row["RecipeInstructions"]),
         }
 
         content_field = (
@@ -212,12 +233,10 @@ def initialize_vector_db(
     # return create_db_instance()
     # No creation or reloading necessary, just return a reference
     if needs_init == False:
-        logger.info("Loading embedding model")
-        embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_ID)
+        embedding_model = get_embedding_model()
         logger.info("DB is already running, restoring client and retriever")
-        qdrant_client = QdrantClient(
-            url=qdrant_url, timeout=300
-        )  # Allow up to 5 minutes before failing slow requests
+        # Serving searches should fail fast, see REQUEST_DEADLINE
+        qdrant_client = QdrantClient(url=qdrant_url, timeout=QDRANT_TIMEOUT)
         store = Qdrant(
             client=qdrant_client,
             collection_name=QDRANT_COLLECTION_NAME,
@@ -239,14 +258,17 @@ def create_db_instance(qdrant_url=QDRANT_HOST_URL):
     logger.info("Loading embedding model")
     embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_ID)
 
+    # Duplicate recipes in the data map to the same point and are stored once
     store = Qdrant.from_documents(
         documents,
         embedding_model,
+        ids=[recipe_point_id(doc.metadata["recipe_id"]) for doc in documents],
         url=qdrant_url,
         prefer_grpc=False,
         collection_name=QDRANT_COLLECTION_NAME,
     )
     logger.info(f"Successfully initialized document db with {len(documents)} documents")
+    bump_collection_epoch()
 
     return store
 
@@ -273,11 +295,29 @@ def restore_db_instance_from_url(
     logger.info(
         f"Successfully restored document db snapshot from {snapshot_url} with {num_docs} documents"
     )
+    bump_collection_epoch()
 
     return store
 
 
-def handle_vector_db_queries(queries, retriever):
+# Retrieval requested from async handlers runs here instead of on the event loop
+retrieval_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=RETRIEVAL_MAX_CONCURRENCY, thread_name_prefix="retrieval"
+)
+
+
+# Tool inputs may carry a single query string instead of a list
+def normalize_queries(queries):
+    if isinstance(queries, str):
+        return [queries]
+    if not isinstance(queries, list):
+        return []
+    return [query for query in queries if isinstance(query, str)]
+
+
+# With a timeout, searches that haven't finished by then are left out. They keep
+# their thread until the Qdrant client times out
+def handle_vector_db_queries(queries, retriever, timeout=None):
     context_docs = {}
 
     # Ensure queries is a list of strings
@@ -287,24 +327,81 @@ def handle_vector_db_queries(queries, retriever):
         logger.error("Queries should be a list of strings.")
         return []
 
+    # Retrievers that support it embed and search all queries in a single round trip.
+    # Their invoke goes through batch_retrieve as well, so a failed batch isn't retried
+    # per query, that would only count the same Qdrant failure once more per query
+    if hasattr(retriever, "batch_retrieve"):
+        if timeout is None:
+            return retriever.batch_retrieve(queries)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            return executor.submit(retriever.batch_retrieve, queries).result(timeout)
+        except concurrent.futures.TimeoutError:
+            logger.error(
+                f"Batched vector db queries timed out after {timeout}s, "
+                f"{len(queries)} queries unfinished"
+            )
+            return context_docs
+        finally:
+            executor.shutdown(wait=False)
+
     def fetch_query_results(query):
         return retriever.invoke(query)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_query = {
-            executor.submit(fetch_query_results, query): query for query in queries
-        }
-        for future in concurrent.futures.as_completed(future_to_query):
+    executor = concurrent.futures.ThreadPoolExecutor()
+    future_to_query = {
+        executor.submit(fetch_query_results, query): query for query in queries
+    }
+    try:
+        for future in concurrent.futures.as_completed(future_to_query, timeout):
             query = future_to_query[future]
             try:
                 query_results = future.result()
                 context_docs[query] = query_results
+            except CircuitOpenError:
+                # The tool call reports the dependency as unavailable
+                raise
             except Exception as e:
                 logger.error(f"Error fetching query results for query {query}: {e}")
+    except concurrent.futures.TimeoutError:
+        logger.error(
+            f"Vector db queries timed out after {timeout}s, "
+            f"{len(queries) - len(context_docs)} queries unfinished"
+        )
+    finally:
+        executor.shutdown(wait=timeout is None, cancel_futures=True)
 
     return context_docs
 
 
+async def handle_vector_db_queries_async(queries, retriever):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        retrieval_executor, handle_vector_db_queries, queries, retriever
+    )
+
+
+# Retrieved documents as JSON, e.g. for the tool result cache
+def serialize_docs(docs):
+    return json.dumps(
+        {
+            query: [
+                {"page_content": doc.page_content, "metadata": doc.metadata}
+                for doc in documents
+            ]
+            for query, documents in docs.items()
+        },
+        default=str,
+    )
+
+
+def deserialize_docs(content):
+    return {
+        query: [Document(**doc) for doc in documents]
+        for query, documents in json.loads(content).items()
+    }
+
+
 def format_docs(docs):
     formatted_docs = []
     excluded_columns = ["name", "recipe_category", "description"]
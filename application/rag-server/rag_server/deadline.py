@@ -0,0 +1,68 @@
+import asyncio
+import concurrent.futures
+import time
+
+from constants import DEADLINE_ANSWER_RESERVE
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Time budget of one request, created when the request arrives and passed down to
+# every Bedrock call, retrieval and web search it makes. Blocking calls can't be
+# interrupted, so work is run on an executor and only waited on for the time left
+class Deadline:
+    def __init__(self, budget, reserve=DEADLINE_ANSWER_RESERVE):
+        self.budget = budget
+        self.reserve = reserve
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    # Time tool calls may use, the reserve is kept for the final answer
+    def tool_time(self):
+        return max(0.0, self.remaining() - self.reserve)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    # Once only the reserve is left the model should answer with what it has
+    def low(self):
+        return self.remaining() <= self.reserve
+
+    def check(self, action):
+        if self.expired():
+            raise DeadlineExceeded(
+                f"Request deadline of {self.budget}s reached {action}"
+            )
+
+
+# Waits on the future for at most timeout seconds, work that hasn't started yet is
+# cancelled, work already running is left to finish on its own
+def result_within(future, timeout, action):
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise DeadlineExceeded(f"Request deadline reached {action}")
+
+
+def call_with_deadline(executor, deadline, action, func, *args):
+    if deadline is None:
+        return func(*args)
+    deadline.check(action)
+    return result_within(executor.submit(func, *args), deadline.remaining(), action)
+
+
+async def call_with_deadline_async(executor, deadline, action, func, *args):
+    loop = asyncio.get_running_loop()
+    if deadline is None:
+        return await loop.run_in_executor(executor, func, *args)
+    deadline.check(action)
+    future = loop.run_in_executor(executor, func, *args)
+    try:
+        return await asyncio.wait_for(future, deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"Request deadline reached {action}")
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from cache_utils import LRUCache, SqliteCache
+from constants import (EMBEDDING_CACHE_MAX_DISK_ENTRIES, EMBEDDING_CACHE_PATH,
+                       EMBEDDING_CACHE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+# Only whitespace is normalized, casing and punctuation can change the embedding
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+# Sits between the vector store and the embedding model. Lookups go to the in-process
+# LRU first, then the file backed tier shared by all workers, and only the remaining
+# texts are sent to the model, as one batch
+class CachedEmbeddings(Embeddings):
+    def __init__(
+        self,
+        embeddings,
+        model_id,
+        memory_size=EMBEDDING_CACHE_SIZE,
+        disk_path=EMBEDDING_CACHE_PATH,
+        max_disk_entries=EMBEDDING_CACHE_MAX_DISK_ENTRIES,
+    ):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.memory_cache = LRUCache(memory_size)
+        self.disk_cache = None
+        if disk_path:
+            try:
+                self.disk_cache = SqliteCache(
+                    disk_path, "embeddings", max_entries=max_disk_entries
+                )
+            except Exception as e:
+                logger.warning(f"Embedding disk cache disabled, failed to open it: {e}")
+
+        self._stats_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def cache_key(self, text):
+        key_text = f"{self.model_id}\n{normalize_text(text)}"
+        return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+    def _embed(self, texts, embed_fn):
+        keys = [self.cache_key(text) for text in texts]
+        vectors = {}
+
+        for key in keys:
+            vector = self.memory_cache.get(key)
+            if vector is not None:
+                vectors[key] = vector
+        memory_hits = len(vectors)
+
+        missing_keys = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing_keys and self.disk_cache is not None:
+            for key, blob in self.disk_cache.get_many(missing_keys).items():
+                vector = array("d", blob).tolist()
+                vectors[key] = vector
+                self.memory_cache.set(key, vector)
+        disk_hits = len(vectors) - memory_hits
+
+        # Embed whatever is left in one model call
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            new_vectors = embed_fn(list(missing.values()))
+            for key, vector in zip(missing.keys(), new_vectors):
+                vectors[key] = vector
+                self.memory_cache.set(key, vector)
+            if self.disk_cache is not None:
+                self.disk_cache.set_many(
+                    [
+                        (key, array("d", vectors[key]).tobytes())
+                        for key in missing.keys()
+                    ]
+                )
+
+        with self._stats_lock:
+            self.memory_hits += memory_hits
+            self.disk_hits += disk_hits
+            self.misses += len(missing)
+
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts):
+        return self._embed(texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self._embed(
+            [text], lambda texts: [self.embeddings.embed_query(texts[0])]
+        )[0]
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "memory_size": len(self.memory_cache),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
@@ -1,44 +1,249 @@
+import asyncio
+import json
 import logging
-from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+import os
+import threading
+import time
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
 
-from constants import GCP_CSE_ID, NUM_SEARCH_RESULTS, WEB_MAX_CONTENT_LENGTH
+from circuit_breaker import circuit_breakers
+from constants import (GCP_CSE_ID, NUM_SEARCH_RESULTS, WEB_MAX_CONNECTIONS,
+                       WEB_MAX_CONNECTIONS_PER_HOST, WEB_MAX_CONTENT_LENGTH,
+                       WEB_MAX_PAGE_BYTES, WEB_READ_CHUNK_SIZE,
+                       WEB_REQUEST_TIMEOUT, WEB_SEARCH_DEADLINE)
+from page_text import PageTextExtractor
+from web_cache import conditional_headers, page_cache, search_cache, validators
 
 logger = logging.getLogger(__name__)
 
 FETCH_URL_LIMIT = 3  # Limit the number of URLs to fetch per search result
 
+# GOOGLE_SEARCH_API_URL is only set to point the tool at a local stub for tests
+GOOGLE_SEARCH_API_URL = os.environ.get(
+    "GOOGLE_SEARCH_API_URL", "https://www.googleapis.com/customsearch/v1"
+)
+
+
+# Every web search of the worker runs on one event loop thread. Its session keeps
+# the connections to the search API and result sites alive between tool calls
+class AsyncWebClient:
+    def __init__(self):
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="web-fetch", daemon=True
+                ).start()
+        return self._loop
+
+    # Only called on the loop thread, aiohttp sessions are bound to their loop
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=WEB_MAX_CONNECTIONS,
+                    limit_per_host=WEB_MAX_CONNECTIONS_PER_HOST,
+                    ttl_dns_cache=300,
+                ),
+                timeout=aiohttp.ClientTimeout(total=WEB_REQUEST_TIMEOUT),
+            )
+        return self._session
+
+    # Runs the coroutine on the web loop from any thread and waits for its result
+    def run(self, coro, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+        return future.result(timeout)
+
+    def close(self):
+        if self._session is not None:
+            self.run(self._session.close())
+
+
+web_client = AsyncWebClient()
 
-# Given a URL, fetch the page's text content. We truncate the website content
-# to provide context of the site but without exceeding the model context window
-# without truncation we quickly encounter server errors from bedrock
-def get_page_content(url):
-    logger.info(f"Fetching page content for URL: {url}")
-    try:
-        response = requests.get(url, timeout=3)
-        response.raise_for_status()  # Check if the request was successful
-        soup = BeautifulSoup(response.text, "html.parser")
 
-        # Extract all text content from the page
-        text_content = soup.get_text(separator="\n")
+# Cache lookups and writes run on the default executor, off the web loop
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
 
-        # Truncate content to a maximum length
-        if len(text_content) > WEB_MAX_CONTENT_LENGTH:
-            text_content = text_content[:WEB_MAX_CONTENT_LENGTH]
 
-        return text_content
-    except requests.exceptions.RequestException as e:
+# Given a URL, fetch the page's text content. We truncate the website content to
+# provide context of the site but without exceeding the model context window,
+# without truncation we quickly encounter server errors from bedrock. The body is
+# parsed on the loop as it streams in, one small chunk at a time, and the download
+# stops once enough text was collected. A fresh cached text is returned without any
+# request, a stale one is revalidated and still used if the site can't be reached
+async def fetch_page_content(url):
+    cached, fresh = None, False
+    if page_cache is not None:
+        cached, fresh = await run_blocking(page_cache.get, url)
+        if fresh:
+            return cached["text"]
+
+    logger.info(f"Fetching page content for URL: {url}")
+    try:
+        async with web_client.session().get(
+            url, headers=conditional_headers(cached)
+        ) as response:
+            if response.status == 304 and cached is not None:
+                await run_blocking(page_cache.mark_revalidated, url, cached)
+                return cached["text"]
+            response.raise_for_status()
+            extractor = PageTextExtractor(
+                WEB_MAX_CONTENT_LENGTH, response.charset or "utf-8"
+            )
+            bytes_read = 0
+            async for chunk in response.content.iter_chunked(WEB_READ_CHUNK_SIZE):
+                extractor.feed(chunk)
+                bytes_read += len(chunk)
+                if extractor.done or bytes_read >= WEB_MAX_PAGE_BYTES:
+                    break
+            text = extractor.text()
+            entry = {"text": text, **validators(response)}
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f'Failed to fetch page content for URL "{url}": {e}')
+        if cached is not None:
+            page_cache.mark_stale_served()
+            return cached["text"]
         return ""
 
+    # Only pages that were read successfully are cached, a fetch cancelled by the
+    # search deadline never gets here
+    if page_cache is not None and text:
+        if cached is not None:
+            page_cache.mark_refreshed()
+        await run_blocking(page_cache.set, url, entry)
+    return text
+
+
+def search_cache_key(query, cse_id, num_results):
+    return json.dumps([cse_id, str(num_results), " ".join(query.lower().split())])
+
+
+# Returns the result items of the query, each with its title, snippet and link, or
+# None if the search failed. Cached the same way as page content. Every request to
+# the search API is recorded by its circuit breaker, a request cut off by the search
+# deadline counts as failed
+async def fetch_search_results(query, api_key, cse_id, num_results):
+    cache_key = search_cache_key(query, cse_id, num_results)
+    cached, fresh = None, False
+    if search_cache is not None:
+        cached, fresh = await run_blocking(search_cache.get, cache_key)
+        if fresh:
+            return cached["items"]
+
+    # Asked right before the request, so a half open breaker's trial call is always
+    # recorded. Other searches are skipped until it finishes
+    breaker = circuit_breakers["google_search"]
+    if not breaker.allow():
+        logger.warning(f"google_search circuit is open, skipping query: {query}")
+        if cached is not None:
+            search_cache.mark_stale_served()
+            return cached["items"]
+        return None
+
+    logger.info(f"Fetching Google search results for query: {query}")
+    params = {"key": api_key, "cx": cse_id, "q": query, "num": num_results}
+    start = time.monotonic()
+    try:
+        async with web_client.session().get(
+            GOOGLE_SEARCH_API_URL, params=params, headers=conditional_headers(cached)
+        ) as response:
+            if response.status == 304 and cached is not None:
+                breaker.record_success(time.monotonic() - start)
+                await run_blocking(search_cache.mark_revalidated, cache_key, cached)
+                return cached["items"]
+            response.raise_for_status()
+            search_results = await response.json(content_type=None)
+            breaker.record_success(time.monotonic() - start)
+            entry = {
+                "items": [
+                    {
+                        "title": item.get("title"),
+                        "snippet": item.get("snippet"),
+                        "link": item.get("link"),
+                    }
+                    for item in search_results.get("items", [])
+                ],
+                **validators(response),
+            }
+    except asyncio.CancelledError:
+        breaker.record_failure()
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.error(f"Error fetching search results for query {query}: {e}")
+        breaker.record_failure()
+        if cached is not None:
+            search_cache.mark_stale_served()
+            return cached["items"]
+        return None
+
+    if search_cache is not None:
+        if cached is not None:
+            search_cache.mark_refreshed()
+        await run_blocking(search_cache.set, cache_key, entry)
+    return entry["items"]
+
+
+# Each query's page fetches start as soon as its own search returns, all of it is
+# bounded by one deadline. Whatever hasn't finished by then is cancelled and left
+# out, results that already arrived are still returned
+async def search_pipeline(queries, api_key, cse_id, num_results, deadline):
+    all_search_results = {query: [] for query in queries}
+
+    async def fetch_page_into(result, url):
+        if url:
+            result["page_content"] = await fetch_page_content(url)
+
+    async def search(query):
+        items = await fetch_search_results(query, api_key, cse_id, num_results)
+        if items is None:
+            return
+        items = items[:FETCH_URL_LIMIT]
+        results = [
+            {
+                "title": item.get("title"),
+                "snippet": item.get("snippet"),
+                "page_content": "",
+            }
+            for item in items
+        ]
+        all_search_results[query] = results
+        await asyncio.gather(
+            *(
+                fetch_page_into(result, item.get("link"))
+                for result, item in zip(results, items)
+            )
+        )
+
+    tasks = [asyncio.ensure_future(search(query)) for query in dict.fromkeys(queries)]
+    _done, pending = await asyncio.wait(tasks, timeout=deadline)
+    if pending:
+        logger.error(
+            f"Web search deadline of {deadline}s reached with {len(pending)} "
+            "queries unfinished, returning partial results"
+        )
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    return all_search_results
+
 
 # Executes a list of queries using the Google Custom Search API and returns a list of search results.
 # Returns:
 # A dictionary where each query maps to a list of search results. Each search result contains the title and snippet.
 def handle_google_web_search(
-    queries, api_key, cse_id=GCP_CSE_ID, num_results=NUM_SEARCH_RESULTS
+    queries,
+    api_key,
+    cse_id=GCP_CSE_ID,
+    num_results=NUM_SEARCH_RESULTS,
+    deadline=WEB_SEARCH_DEADLINE,
 ):
     # Ensure queries is a list of strings
     if isinstance(queries, str):
@@ -47,74 +252,7 @@ def handle_google_web_search(
         logger.error("Queries should be a list of strings.")
         return {}
 
-    # The base URL for the Google Custom Search API
-    api_url = "https://www.googleapis.com/customsearch/v1"
-
-    all_search_results = {}
-
-    def fetch_search_results(query):
-        logger.info(f"Fetching Google search results for query: {query}")
-        params = {"key": api_key, "cx": cse_id, "q": query, "num": num_results}
-        try:
-            response = requests.get(api_url, params=params, timeout=3)
-            response.raise_for_status()
-            return query, response.json()
-        except requests.RequestException as e:
-            logger.error(f"Error fetching search results for query {query}: {e}")
-            return query, None
-
-    def fetch_page_content(item):
-        search_result_url = item.get("link")
-        page_content = get_page_content(search_result_url)
-        return {
-            "title": item.get("title"),
-            "snippet": item.get("snippet"),
-            "page_content": page_content,
-        }
-
-    with ThreadPoolExecutor() as executor:
-        # Fetch search results in parallel
-        future_to_query = {
-            executor.submit(fetch_search_results, query): query for query in queries
-        }
-
-        for future in as_completed(future_to_query):
-            try:
-                query, search_results = future.result(timeout=5)
-            except TimeoutError:
-                logger.error(
-                    f"Timeout occurred while fetching search results for query {query}"
-                )
-                all_search_results[query] = []
-                continue
-            except Exception as e:
-                logger.error(
-                    f"Unexpected error while fetching search results for query {query}: {e}"
-                )
-                all_search_results[query] = []
-                continue
-
-            if search_results is None:
-                all_search_results[query] = []
-                continue
-
-            # Fetch page content in parallel for each search result item, limit to the first 3 URLs
-            items = search_results.get("items", [])[:FETCH_URL_LIMIT]
-            future_to_item = {
-                executor.submit(fetch_page_content, item): item for item in items
-            }
-            results = []
-            for future in as_completed(future_to_item):
-                try:
-                    result = future.result(timeout=5)
-                except TimeoutError:
-                    logger.error(f"Timeout occurred while fetching page content")
-                    result = {"title": "Timeout", "snippet": "", "page_content": ""}
-                except Exception as e:
-                    logger.error(f"Unexpected error while fetching page content: {e}")
-                    result = {"title": "Error", "snippet": "", "page_content": ""}
-                results.append(result)
-
-            all_search_results[query] = results
-
-    return all_search_results
+    return web_client.run(
+        search_pipeline(queries, api_key, cse_id, num_results, deadline),
+        timeout=deadline + 1,
+    )
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+from langchain_community.cross_encoders.base import BaseCrossEncoder
+from langchain_core.embeddings import Embeddings
+
+from constants import INFERENCE_SOCKET_PATH, INFERENCE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Frames are a 4 byte big endian length followed by a JSON body
+HEADER = struct.Struct(">I")
+
+
+async def read_frame(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except Exception:
+        return None
+    (length,) = HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+async def write_frame(writer, message):
+    body = json.dumps(message).encode("utf-8")
+    writer.write(HEADER.pack(len(body)) + body)
+    await writer.drain()
+
+
+def _recv_exactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Inference sidecar closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+
+# Blocking client used from the worker's request threads, one connection per thread
+class InferenceClient:
+    def __init__(self, socket_path=INFERENCE_SOCKET_PATH, timeout=INFERENCE_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def request(self, message):
+        body = json.dumps(message).encode("utf-8")
+        # Retry once on a fresh connection in case the sidecar was restarted
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                sock.sendall(HEADER.pack(len(body)) + body)
+                (length,) = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+                response = json.loads(_recv_exactly(sock, length))
+                break
+            except (ConnectionError, socket.timeout, OSError):
+                self._close()
+                if attempt == 1:
+                    raise
+        if "error" in response:
+            raise RuntimeError(f"Inference sidecar error: {response['error']}")
+        return response["result"]
+
+    def is_available(self):
+        if not os.path.exists(self.socket_path):
+            return False
+        try:
+            return self.request({"op": "ping"}) == "pong"
+        except Exception as e:
+            logger.warning(
+                f"Inference sidecar at {self.socket_path} not reachable: {e}"
+            )
+            return False
+
+
+# Drop in replacement for HuggingFaceEmbeddings backed by the sidecar
+class SidecarEmbeddings(Embeddings):
+    def __init__(self, client):
+        self.client = client
+
+    def embed_documents(self, texts):
+        return self.client.request({"op": "embed", "items": list(texts)})
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# Drop in replacement for HuggingFaceCrossEncoder backed by the sidecar
+class SidecarCrossEncoder(BaseCrossEncoder):
+    def __init__(self, client):
+        self.client = client
+
+    def score(self, text_pairs):
+        pairs = [[query, passage] for query, passage in text_pairs]
+        return self.client.request({"op": "rerank", "items": pairs})
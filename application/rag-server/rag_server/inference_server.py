@@ -0,0 +1,151 @@
+"""
+Local inference sidecar that holds a single copy of the embedding and reranker
+models for every gunicorn worker on the host. Concurrent requests from all workers
+are grouped into micro-batches, a batch is run once it reaches
+INFERENCE_MAX_BATCH_SIZE items or its oldest request has waited
+INFERENCE_MAX_WAIT_MS.
+
+Started by run.sh before the workers when USE_INFERENCE_SIDECAR is enabled,
+workers connect through the adapters in inference_client.py
+"""
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import (INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS,
+                       INFERENCE_SOCKET_PATH)
+from inference_client import read_frame, write_frame
+from model_utils import load_embedding_model, load_reranker_model
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    def __init__(self, name, batch_fn, executor):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, items):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            item_count = len(pending[0][0])
+            deadline = loop.time() + INFERENCE_MAX_WAIT_MS / 1000
+
+            # Keep collecting requests until the batch is full or the window closes
+            while item_count < INFERENCE_MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(request)
+                item_count += len(request[0])
+
+            batch = [item for items, _ in pending for item in items]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.batch_fn, batch
+                )
+            except Exception as e:
+                logger.error(f"{self.name} batch of {len(batch)} failed: {e}")
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            logger.debug(
+                f"{self.name}: {len(pending)} requests, {len(batch)} items in "
+                f"{(time.perf_counter() - start) * 1000:.1f}ms"
+            )
+
+            offset = 0
+            for items, future in pending:
+                if not future.done():
+                    future.set_result(results[offset : offset + len(items)])
+                offset += len(items)
+
+
+class InferenceServer:
+    def __init__(self):
+        logger.info("Loading inference models")
+        embedding_model = load_embedding_model()
+        reranker_model = load_reranker_model()
+
+        # A single model thread, batching rather than threads gives the throughput
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {
+            "embed": MicroBatcher("embed", embedding_model.embed_documents, executor),
+            "rerank": MicroBatcher(
+                "rerank",
+                lambda pairs: list(reranker_model.score([tuple(p) for p in pairs])),
+                executor,
+            ),
+        }
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                op = request.get("op")
+                if op == "ping":
+                    response = {"result": "pong"}
+                elif op == "stats":
+                    response = {
+                        "result": {
+                            name: {"batches": batcher.batches, "items": batcher.items}
+                            for name, batcher in self.batchers.items()
+                        }
+                    }
+                elif op in self.batchers:
+                    try:
+                        result = await self.batchers[op].submit(request["items"])
+                        response = {"result": result}
+                    except Exception as e:
+                        response = {"error": str(e)}
+                else:
+                    response = {"error": f"Unknown op {op}"}
+                await write_frame(writer, response)
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=INFERENCE_SOCKET_PATH):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        for batcher in self.batchers.values():
+            asyncio.create_task(batcher.run())
+
+        server = await asyncio.start_unix_server(self.handle_connection, socket_path)
+        logger.info(f"Inference sidecar listening on {socket_path}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(InferenceServer().serve())
@@ -0,0 +1,203 @@
+import json
+import logging
+import re
+
+from constants import (CONTEXT_CHARS_PER_TOKEN, HISTORY_KEEP_RECENT_TURNS,
+                       HISTORY_TOKEN_CEILING)
+
+logger = logging.getLogger(__name__)
+
+ELIDED_PREFIX = "Earlier tool result elided to save context."
+# Matches the "Recipe: <name> (id: <id>)" lines of recipe db tool results
+RECIPE_LINE_PATTERN = re.compile(r"^Recipe: (.+)$", re.MULTILINE)
+
+
+# Both message schemas are handled, invoke_model blocks are {"type": "tool_use"} /
+# {"type": "tool_result"}, converse blocks are {"toolUse": {}} / {"toolResult": {}}
+def is_tool_use(block):
+    return isinstance(block, dict) and (
+        block.get("type") == "tool_use" or "toolUse" in block
+    )
+
+
+def is_tool_result(block):
+    return isinstance(block, dict) and (
+        block.get("type") == "tool_result" or "toolResult" in block
+    )
+
+
+def tool_use_id(block):
+    if "toolUse" in block:
+        return block["toolUse"].get("toolUseId")
+    return block.get("id")
+
+
+def tool_result_id(block):
+    if "toolResult" in block:
+        return block["toolResult"].get("toolUseId")
+    return block.get("tool_use_id")
+
+
+def tool_result_text(block):
+    content = block["toolResult"].get("content") if "toolResult" in block else None
+    if content is None:
+        content = block.get("content")
+    if isinstance(content, str):
+        return content
+    texts = [item.get("text", "") for item in content or [] if isinstance(item, dict)]
+    return "\n".join(texts)
+
+
+def is_elided(block):
+    return tool_result_text(block).startswith(ELIDED_PREFIX)
+
+
+def message_blocks(message):
+    content = message.get("content")
+    return content if isinstance(content, list) else []
+
+
+# Same chars per token estimate as the recipe context builder
+def message_tokens(message):
+    return -(-len(json.dumps(message, default=str)) // CONTEXT_CHARS_PER_TOKEN)
+
+
+# Recipes are still named so the model can refer back to them, but not as "Recipe:"
+# lines, an elided recipe counts as unseen and is sent again if requested
+def elided_summary(block):
+    recipes = RECIPE_LINE_PATTERN.findall(tool_result_text(block))
+    if not recipes:
+        return ELIDED_PREFIX
+    return f"{ELIDED_PREFIX} It contained the recipes: {', '.join(recipes)}"
+
+
+# Keeps the id and status so the block still pairs with its tool use
+def elide_tool_result(block):
+    summary = elided_summary(block)
+    if "toolResult" in block:
+        tool_result = dict(block["toolResult"])
+        tool_result["content"] = [{"text": summary}]
+        return {"toolResult": tool_result}
+    elided = dict(block)
+    elided["content"] = summary
+    return elided
+
+
+# A turn starts at each user message that is a prompt rather than tool results
+def turn_starts(messages):
+    return [
+        i
+        for i, message in enumerate(messages)
+        if message.get("role") == "user"
+        and not any(is_tool_result(block) for block in message_blocks(message))
+    ]
+
+
+# Returns the messages to send to the model, the input is never modified. Under the
+# token ceiling the history is sent as is. Above it, tool result payloads older than
+# the most recent turns are replaced by a short summary, oldest first, and if that
+# is not enough the oldest whole turns are dropped. Only whole blocks and whole
+# turns are touched, so every tool use keeps its tool result
+def compact_history(
+    messages,
+    token_ceiling=HISTORY_TOKEN_CEILING,
+    keep_recent_turns=HISTORY_KEEP_RECENT_TURNS,
+):
+    if not token_ceiling:
+        return messages
+    tokens = [message_tokens(message) for message in messages]
+    total = sum(tokens)
+    if total <= token_ceiling:
+        return messages
+
+    # The current prompt is always kept
+    keep_recent_turns = max(1, keep_recent_turns)
+    starts = turn_starts(messages)
+    if len(starts) <= keep_recent_turns:
+        return messages
+    protected_from = starts[-keep_recent_turns]
+
+    compacted = list(messages)
+    elided = 0
+    for i in range(protected_from):
+        if total <= token_ceiling:
+            break
+        blocks = message_blocks(compacted[i])
+        if not any(is_tool_result(block) and not is_elided(block) for block in blocks):
+            continue
+        message = dict(compacted[i])
+        message["content"] = [
+            elide_tool_result(block) if is_tool_result(block) else block
+            for block in blocks
+        ]
+        compacted[i] = message
+        message_token_count = message_tokens(message)
+        total += message_token_count - tokens[i]
+        tokens[i] = message_token_count
+        elided += 1
+
+    # Dropping turns keeps the history starting at a user prompt
+    old_starts = [start for start in starts if start < protected_from]
+    boundaries = old_starts + [protected_from]
+    dropped_turns = 0
+    while total > token_ceiling and dropped_turns < len(old_starts):
+        start, end = boundaries[dropped_turns], boundaries[dropped_turns + 1]
+        total -= sum(tokens[start:end])
+        dropped_turns += 1
+    if dropped_turns:
+        compacted = compacted[boundaries[dropped_turns] :]
+
+    logger.info(
+        f"Compacted chat history to ~{total} tokens, elided {elided} tool result "
+        f"messages and dropped {dropped_turns} turns"
+    )
+    return compacted
+
+
+# Returns a list of problems, empty if the history is a valid Bedrock conversation:
+# it starts with a user message, roles alternate, and the tool uses of every
+# assistant message are answered exactly by the tool results of the next message
+def validate_message_structure(messages):
+    problems = []
+    if messages and messages[0].get("role") != "user":
+        problems.append("History doesn't start with a user message")
+
+    for i, message in enumerate(messages):
+        if i > 0 and message.get("role") == messages[i - 1].get("role"):
+            problems.append(f"Message {i} has the same role as the previous one")
+
+        tool_results = {
+            tool_result_id(block)
+            for block in message_blocks(message)
+            if is_tool_result(block)
+        }
+        previous_tool_uses = set()
+        if i > 0:
+            previous_tool_uses = {
+                tool_use_id(block)
+                for block in message_blocks(messages[i - 1])
+                if is_tool_use(block)
+            }
+        if tool_results - previous_tool_uses:
+            problems.append(
+                f"Message {i} has tool results without a tool use: "
+                f"{sorted(tool_results - previous_tool_uses)}"
+            )
+
+        tool_uses = {
+            tool_use_id(block)
+            for block in message_blocks(message)
+            if is_tool_use(block)
+        }
+        if tool_uses and i + 1 < len(messages):
+            next_tool_results = {
+                tool_result_id(block)
+                for block in message_blocks(messages[i + 1])
+                if is_tool_result(block)
+            }
+            if tool_uses - next_tool_results:
+                problems.append(
+                    f"Message {i} has tool uses without a tool result: "
+                    f"{sorted(tool_uses - next_tool_results)}"
+                )
+    return problems
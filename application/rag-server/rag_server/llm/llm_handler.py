@@ -1,5 +1,9 @@
+import asyncio
 import json
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import boto3
 from botocore.config import Config
@@ -7,13 +11,20 @@ from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
 from api_types import ConverseToolResultStatus
-from constants import MODEL_ID
-from data_utils import format_docs, get_secret, handle_vector_db_queries
-from google_search import handle_google_web_search
+from constants import (BEDROCK_CONNECT_TIMEOUT, BEDROCK_MAX_CONCURRENCY,
+                       BEDROCK_READ_TIMEOUT, MODEL_ID)
+from data_utils import retrieval_executor
+from deadline import (Deadline, DeadlineExceeded, call_with_deadline,
+                      call_with_deadline_async)
 
+from .history_compaction import compact_history
 from .message_utils import (generate_converse_message,
                             generate_converse_tool_message, generate_message,
                             generate_tool_message)
+from .prompts import final_answer_instruction
+from .speculative_retrieval import SpeculativeRetrieval
+from .tool_context import ToolContext
+from .tool_executor import execute_tool_calls
 from .tools import (converse_google_web_search_tool,
                     converse_recipe_db_query_tool, google_web_search_tool,
                     recipe_db_query_tool)
@@ -24,20 +35,29 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 boto_config = Config(
-    read_timeout=100000,
+    connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+    read_timeout=BEDROCK_READ_TIMEOUT,
+    max_pool_connections=BEDROCK_MAX_CONCURRENCY,
 )
+# BEDROCK_ENDPOINT_URL is only set to point the client at a local stub for benchmarks
 bedrock_client = boto3.client(
     "bedrock-runtime",
     config=boto_config,
     region_name="us-east-1",
+    endpoint_url=os.environ.get("BEDROCK_ENDPOINT_URL"),
+)
+
+# Blocking boto calls from the async handlers run here so they don't stall the
+# event loop, the pool size bounds the Bedrock requests in flight per worker
+bedrock_executor = ThreadPoolExecutor(
+    max_workers=BEDROCK_MAX_CONCURRENCY, thread_name_prefix="bedrock"
 )
-google_search_api_key = get_secret("google_search_api_key")
 
 
 def query_bedrock_llm(messages, config):
     payload = {
         "anthropic_version": "bedrock-2023-05-31",
-        "messages": messages,
+        "messages": compact_history(messages, config.history_token_ceiling),
         "tools": [recipe_db_query_tool, google_web_search_tool],
         "system": str(config.system_prompt),
         "max_tokens": int(config.max_tokens),
@@ -53,6 +73,17 @@ def query_bedrock_llm(messages, config):
     return response_body
 
 
+async def query_bedrock_llm_async(messages, config, deadline=None):
+    return await call_with_deadline_async(
+        bedrock_executor,
+        deadline,
+        "waiting for Bedrock",
+        query_bedrock_llm,
+        messages,
+        config,
+    )
+
+
 """
 Example response body structure:
 {
@@ -83,7 +114,7 @@ Example response body structure:
 """
 
 
-def message_handler(existing_chat_history, prompt, config, is_tool_message=False):
+def append_user_message(existing_chat_history, prompt, is_tool_message):
     # Fn results is an array of tool response objects
     # message structure needs to reflect that
     if is_tool_message:
@@ -92,8 +123,9 @@ def message_handler(existing_chat_history, prompt, config, is_tool_message=False
         user_message = generate_message(prompt)
     existing_chat_history.append(user_message)
 
+
+def append_llm_message(existing_chat_history, response_body):
     # Parse the response content
-    response_body = query_bedrock_llm(existing_chat_history, config)
     llm_message = {"role": response_body["role"], "content": response_body["content"]}
 
     # Add the response message to the chat history
@@ -102,67 +134,101 @@ def message_handler(existing_chat_history, prompt, config, is_tool_message=False
     return [response_body, llm_message, existing_chat_history]
 
 
+def message_handler(
+    existing_chat_history, prompt, config, is_tool_message=False, deadline=None
+):
+    append_user_message(existing_chat_history, prompt, is_tool_message)
+    response_body = call_with_deadline(
+        bedrock_executor,
+        deadline,
+        "waiting for Bedrock",
+        query_bedrock_llm,
+        existing_chat_history,
+        config,
+    )
+    return append_llm_message(existing_chat_history, response_body)
+
+
+async def message_handler_async(
+    existing_chat_history, prompt, config, is_tool_message=False, deadline=None
+):
+    append_user_message(existing_chat_history, prompt, is_tool_message)
+    response_body = await query_bedrock_llm_async(
+        existing_chat_history, config, deadline
+    )
+    return append_llm_message(existing_chat_history, response_body)
+
+
+# The model has to answer after the last tool round a request allows, or once
+# only the deadline's reserve is left
+def should_force_answer(tool_rounds, config, deadline):
+    return tool_rounds >= config.max_tool_rounds or deadline.low()
+
+
+# A model that still asks for tools after being told to answer gets its tool uses
+# dropped, they would have no tool result in the saved history
+def drop_tool_uses(llm_message, is_tool_use, text_block):
+    content = [block for block in llm_message["content"] if not is_tool_use(block)]
+    if not content:
+        content = [
+            text_block(
+                "Sorry, I couldn't finish looking this up in time. Please try again."
+            )
+        ]
+    llm_message["content"] = content
+
+
+def is_invoke_tool_use(block):
+    return block.get("type") == "tool_use"
+
+
+def invoke_text_block(text):
+    return {"type": "text", "text": text}
+
+
+def is_converse_tool_use(block):
+    return "toolUse" in block
+
+
+def converse_text_block(text):
+    return {"text": text}
+
+
 # Takes as an argument to LLM message content, returns a list of the fn result objects
-def handle_function_calls(tool_call_message_content, document_retriever):
-    tool_results = []
+def handle_function_calls(tool_call_message_content, tool_context):
+    # Only process messages from the LLM that are function calls
+    tool_calls = [
+        {"id": content["id"], "name": content["name"], "input": content["input"]}
+        for content in tool_call_message_content
+        if content["type"] == "tool_use"
+    ]
 
-    for tool_call in tool_call_message_content:
-        # Only process messages from the LLM that are function calls
-        if tool_call["type"] != "tool_use":
-            continue
-        fn_id = tool_call["id"]
-        fn_name = tool_call["name"]
-        fn_args = tool_call["input"]
+    tool_results = []
+    for tool_call, result in zip(
+        tool_calls, execute_tool_calls(tool_calls, tool_context)
+    ):
         fn_result = {
             "type": "tool_result",
-            "tool_use_id": fn_id,
+            "tool_use_id": tool_call["id"],
+            "content": result["content"],
         }
-
-        if fn_name == "query_food_recipe_vector_db":
-            if "queries" not in fn_args:
-                logger.error(
-                    f"ERROR: Tried to call {fn_name} with invalid args {fn_args}, skipping.."
-                )
-                fn_result["content"] = ""
-                fn_result["is_error"] = True
-                tool_results.append(fn_result)
-                continue
-
-            logger.info(f"Model called {fn_name} with args {fn_args}")
-            context_docs = handle_vector_db_queries(
-                fn_args["queries"], document_retriever
-            )
-            context_str = format_docs(context_docs)
-            fn_result["content"] = context_str
-            tool_results.append(fn_result)
-
-        elif fn_name == "google_web_search":
-            if "queries" not in fn_args:
-                logger.error(
-                    f"ERROR: Tried to call {fn_name} with invalid args {fn_args}, skipping.."
-                )
-                fn_result["content"] = ""
-                fn_result["is_error"] = True
-                tool_results.append(fn_result)
-                continue
-
-            logger.info(f"Model called {fn_name} with args {fn_args}")
-            search_results = handle_google_web_search(
-                fn_args["queries"], google_search_api_key
-            )
-            search_results_str = json.dumps(search_results)
-            fn_result["content"] = search_results_str
-            tool_results.append(fn_result)
-
-        else:
-            logger.error(f"ERROR: Attempted call to unknown function {fn_name}")
-            fn_result["content"] = ""
+        if result["is_error"]:
             fn_result["is_error"] = True
-            tool_results.append(fn_result)
+        tool_results.append(fn_result)
 
     return tool_results
 
 
+async def handle_function_calls_async(tool_call_message_content, tool_context):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        retrieval_executor,
+        handle_function_calls,
+        tool_call_message_content,
+        tool_context,
+    )
+
+
 """
 Example payload structure of response_body:
 
@@ -196,21 +262,37 @@ Example payload structure of llm_message['content']:
 
 # This function is the entry point to invoke the LLM with support for function calling
 # parsing output, calling requested functions, sending output is handled here
-def run_chat_loop(existing_chat_history, prompt, document_retriever, config):
+def run_chat_loop(
+    existing_chat_history, prompt, document_retriever, config, deadline=None
+):
     logger.info(f"[User]: {prompt}")
+    deadline = deadline or Deadline(config.request_deadline)
+    tool_context = ToolContext(
+        document_retriever, config, prompt, existing_chat_history, deadline
+    )
 
     response_body, llm_message, chat_history = message_handler(
-        existing_chat_history=existing_chat_history, prompt=prompt, config=config
+        existing_chat_history=existing_chat_history,
+        prompt=prompt,
+        config=config,
+        deadline=deadline,
     )
 
     # The model wants to call tools, call them, provide response, repeat until content is generated
     fn_calls = []
+    tool_rounds = 0
     while response_body["stop_reason"] == "tool_use":
         fn_calls.extend(response_body["content"])
         fn_results = handle_function_calls(
             tool_call_message_content=llm_message["content"],
-            document_retriever=document_retriever,
+            tool_context=tool_context,
         )
+        # Tool calls served by a fallback are listed in the debug data
+        fn_calls.extend(tool_context.pop_degraded())
+        tool_rounds += 1
+        force_answer = should_force_answer(tool_rounds, config, deadline)
+        if force_answer:
+            fn_results.append({"type": "text", "text": final_answer_instruction})
 
         # Send function results back to LLM as a new message with the existing chat history
         response_body, llm_message, chat_history = message_handler(
@@ -218,7 +300,11 @@ def run_chat_loop(existing_chat_history, prompt, document_retriever, config):
             prompt=fn_results,
             is_tool_message=True,
             config=config,
+            deadline=deadline,
         )
+        if force_answer:
+            drop_tool_uses(llm_message, is_invoke_tool_use, invoke_text_block)
+            break
 
     # The model is done calling tools, parse output and update chat
     # history with the models response
@@ -228,11 +314,69 @@ def run_chat_loop(existing_chat_history, prompt, document_retriever, config):
     return [model_text_output, chat_history, fn_calls]
 
 
+# Same loop as run_chat_loop, Bedrock calls and tool calls are awaited on their
+# executors so other requests on the worker keep being served meanwhile
+async def run_chat_loop_async(
+    existing_chat_history, prompt, document_retriever, config, deadline=None
+):
+    logger.info(f"[User]: {prompt}")
+    deadline = deadline or Deadline(config.request_deadline)
+    tool_context = ToolContext(
+        document_retriever, config, prompt, existing_chat_history, deadline
+    )
+
+    response_body, llm_message, chat_history = await message_handler_async(
+        existing_chat_history=existing_chat_history,
+        prompt=prompt,
+        config=config,
+        deadline=deadline,
+    )
+
+    fn_calls = []
+    tool_rounds = 0
+    while response_body["stop_reason"] == "tool_use":
+        fn_calls.extend(response_body["content"])
+        fn_results = await handle_function_calls_async(
+            tool_call_message_content=llm_message["content"],
+            tool_context=tool_context,
+        )
+        # Tool calls served by a fallback are listed in the debug data
+        fn_calls.extend(tool_context.pop_degraded())
+        tool_rounds += 1
+        force_answer = should_force_answer(tool_rounds, config, deadline)
+        if force_answer:
+            fn_results.append({"type": "text", "text": final_answer_instruction})
+
+        response_body, llm_message, chat_history = await message_handler_async(
+            existing_chat_history=chat_history,
+            prompt=fn_results,
+            is_tool_message=True,
+            config=config,
+            deadline=deadline,
+        )
+        if force_answer:
+            drop_tool_uses(llm_message, is_invoke_tool_use, invoke_text_block)
+            break
+
+    model_text_output = llm_message["content"][0]["text"]
+    logger.info(f"\n[Model]: {model_text_output}")
+
+    return [model_text_output, chat_history, fn_calls]
+
+
 # https://docs.aws.amazon.com/bedrock/latest/userguide/tool-use-examples.html
-def converse_msg_stream_handler(messages, config):
-    response = bedrock_client.converse_stream(
+# Yields typed events as the model streams, only the deltas are sent out and the
+# assistant message is assembled once, in the final message_stop event:
+#   {"type": "text_delta", "text": "..."}
+#   {"type": "tool_call", "toolUse": {"toolUseId": "", "name": "", "input": {}}}
+#   {"type": "message_stop", "stop_reason": "", "message": {...}, "speculative": {}}
+# When a document_retriever is given, vector searches for the recipe db tool start
+# as soon as each query in the streamed input is complete, keyed by toolUseId
+def converse_stream_events(messages, config, document_retriever=None, deadline=None):
+    converse_stream = partial(
+        bedrock_client.converse_stream,
         modelId=MODEL_ID,
-        messages=messages,
+        messages=compact_history(messages, config.history_token_ceiling),
         system=[{"text": str(config.system_prompt)}],
         inferenceConfig={
             "temperature": float(config.temperature),
@@ -244,42 +388,69 @@ def converse_msg_stream_handler(messages, config):
             "tools": [converse_recipe_db_query_tool, converse_google_web_search_tool]
         },
     )
+    response = call_with_deadline(
+        bedrock_executor, deadline, "waiting for Bedrock", converse_stream
+    )
 
     stop_reason = ""
     message = {"role": "assistant", "content": []}
-    text = ""
+    text_parts = []
     tool_use = {}
+    speculative = {}
 
     for chunk in response["stream"]:
+        # Each chunk read is bounded by the read timeout, the deadline is checked in
+        # between and closing the stream ends the model call
+        if deadline is not None and deadline.expired():
+            response["stream"].close()
+            for retrieval in speculative.values():
+                retrieval.finalize([])
+            deadline.check("while streaming the model response")
         if "messageStart" in chunk:
             message["role"] = chunk["messageStart"]["role"]
         elif "contentBlockStart" in chunk:
             tool = chunk["contentBlockStart"]["start"]["toolUse"]
             tool_use = {"toolUseId": tool["toolUseId"], "name": tool["name"]}
+            if document_retriever and tool["name"] == "query_food_recipe_vector_db":
+                speculative[tool["toolUseId"]] = SpeculativeRetrieval(
+                    document_retriever
+                )
         elif "contentBlockDelta" in chunk:
             delta = chunk["contentBlockDelta"]["delta"]
             if "toolUse" in delta:
                 if "input" not in tool_use:
                     tool_use["input"] = ""
                 tool_use["input"] += delta["toolUse"]["input"]
+                if tool_use["toolUseId"] in speculative:
+                    speculative[tool_use["toolUseId"]].feed(delta["toolUse"]["input"])
             elif "text" in delta:
-                text += delta["text"]
-                yield None, {"role": "assistant", "content": [{"text": text}]}
+                text_parts.append(delta["text"])
+                yield {"type": "text_delta", "text": delta["text"]}
         elif "contentBlockStop" in chunk:
             if "input" in tool_use:
                 tool_use["input"] = json.loads(tool_use["input"])
+                if tool_use["toolUseId"] in speculative:
+                    speculative[tool_use["toolUseId"]].finalize(
+                        tool_use["input"].get("queries")
+                    )
                 message["content"].append({"toolUse": tool_use})
+                yield {"type": "tool_call", "toolUse": tool_use}
                 tool_use = {}
             else:
-                message["content"].append({"text": text})
-                text = ""
+                message["content"].append({"text": "".join(text_parts)})
+                text_parts = []
         elif "messageStop" in chunk:
             stop_reason = chunk["messageStop"]["stopReason"]
 
-    yield stop_reason, message
+    yield {
+        "type": "message_stop",
+        "stop_reason": stop_reason,
+        "message": message,
+        "speculative": speculative,
+    }
 
 
-# Messages are created for each accumulated version streamed from the model,
+# Older clients may send back histories that still contain every streamed snapshot,
 # strip them out and only keep the final completed message
 def dedupe_streamed_messages(messages):
     # Check if messages never repeat the same role more than once before alternating
@@ -313,90 +484,137 @@ def dedupe_streamed_messages(messages):
     return processed_messages
 
 
-def run_chat_loop_streaming(existing_chat_history, prompt, document_retriever, config):
+def handle_converse_tool_calls(message_content, tool_context, speculative=None):
+    speculative = speculative or {}
+    tool_calls = [
+        {
+            "id": content["toolUse"]["toolUseId"],
+            "name": content["toolUse"]["name"],
+            "input": content["toolUse"]["input"],
+            "speculative": speculative.get(content["toolUse"]["toolUseId"]),
+        }
+        for content in message_content
+        if "toolUse" in content
+    ]
+
+    tool_results = []
+    for tool_call, result in zip(
+        tool_calls, execute_tool_calls(tool_calls, tool_context)
+    ):
+        if result["is_error"]:
+            tool_results.append(
+                {
+                    "toolUseId": tool_call["id"],
+                    "content": [],
+                    "status": ConverseToolResultStatus.error.value,
+                }
+            )
+        else:
+            tool_results.append(
+                {
+                    "toolUseId": tool_call["id"],
+                    "content": [{"text": result["content"]}],
+                    "status": ConverseToolResultStatus.success.value,
+                }
+            )
+
+    return tool_results
+
+
+# Streaming chat loop (v2 event format). Only one in-progress assistant message is
+# kept per model turn, the chat history is appended to once the turn completes.
+# Besides the stream events it yields:
+#   {"type": "tool_result", "toolResult": {...}}
+#   {"type": "degraded", "tool_use_id": "", "name": "", "reasons": [...]}
+#   {"type": "done", "stop_reason": "", "message": {...}, "new_chat_history": [...],
+#    "new_messages": [...]}
+#   {"type": "error", "error": "..."}
+def run_chat_loop_stream_events(
+    existing_chat_history, prompt, document_retriever, config, deadline=None
+):
     try:
-        messages = existing_chat_history
+        deadline = deadline or Deadline(config.request_deadline)
+        messages = dedupe_streamed_messages(existing_chat_history)
+        history_length = len(messages)
         messages.append(generate_converse_message(prompt))
+        tool_context = ToolContext(
+            document_retriever, config, prompt, messages, deadline
+        )
 
-        accumulated_text = ""
-        for stop_reason, message in converse_msg_stream_handler(messages, config):
-            if message:
-                if message["content"] and "text" in message["content"][-1]:
-                    accumulated_text += message["content"][-1]["text"]
-                messages.append(message)
-                yield message
-
-            while stop_reason == "tool_use":
-                for content in message["content"]:
-                    if "toolUse" not in content:
-                        continue
-
-                    tool_use = content["toolUse"]
-                    fn_id = tool_use["toolUseId"]
-                    fn_name = tool_use["name"]
-                    fn_args = tool_use["input"]
-                    fn_result = {"toolUseId": fn_id}
-
-                    if fn_name == "query_food_recipe_vector_db":
-                        if "queries" not in fn_args:
-                            logger.error(
-                                f"ERROR: Tried to call {fn_name} with invalid args {fn_args}, skipping..."
-                            )
-                            fn_result["content"] = []
-                            fn_result["status"] = "error"
-                            continue
-
-                        logger.info(f"Model called {fn_name} with args {fn_args}")
-                        context_docs = handle_vector_db_queries(
-                            fn_args["queries"], document_retriever
-                        )
-                        context_str = format_docs(context_docs)
-                        fn_result["content"] = [{"text": context_str}]
-                        fn_result["status"] = "success"
-
-                    elif fn_name == "google_web_search":
-                        if "queries" not in fn_args:
-                            logger.error(
-                                f"ERROR: Tried to call {fn_name} with invalid args {fn_args}, skipping..."
-                            )
-                            fn_result["content"] = []
-                            fn_result["status"] = "error"
-                            continue
-
-                        logger.info(f"Model called {fn_name} with args {fn_args}")
-
-                        search_results = handle_google_web_search(
-                            fn_args["queries"], google_search_api_key
-                        )
-                        search_results_str = json.dumps(search_results)
-                        fn_result["content"] = [{"text": search_results_str}]
-                        fn_result["status"] = "success"
-
-                    else:
-                        logger.error(
-                            f"ERROR: Attempted call to unknown function {fn_name}"
-                        )
-                        fn_result["content"] = []
-                        fn_result["status"] = "error"
-
-                    tool_result_message = generate_converse_tool_message(fn_result)
-                    messages.append(tool_result_message)
-
-                # Sanitize messages before sending
-                messages = dedupe_streamed_messages(messages)
-
-                for stop_reason, message in converse_msg_stream_handler(
-                    messages, config
-                ):
-                    if message:
-                        if message["content"] and "text" in message["content"][-1]:
-                            accumulated_text += message["content"][-1]["text"]
-                        messages.append(message)
-                        yield message
+        tool_rounds = 0
+        force_answer = False
+        while True:
+            for event in converse_stream_events(
+                messages, config, document_retriever, deadline
+            ):
+                if event["type"] == "message_stop":
+                    stop_reason = event["stop_reason"]
+                    message = event["message"]
+                    speculative = event["speculative"]
+                else:
+                    yield event
+            if force_answer:
+                drop_tool_uses(message, is_converse_tool_use, converse_text_block)
+            messages.append(message)
+
+            if stop_reason != "tool_use" or force_answer:
+                break
+
+            fn_results = handle_converse_tool_calls(
+                message["content"], tool_context, speculative
+            )
+            for fn_result in fn_results:
+                yield {"type": "tool_result", "toolResult": fn_result}
+            for degraded in tool_context.pop_degraded():
+                yield degraded
+            tool_message = generate_converse_tool_message(fn_results)
+            tool_rounds += 1
+            force_answer = should_force_answer(tool_rounds, config, deadline)
+            if force_answer:
+                tool_message["content"].append(
+                    converse_text_block(final_answer_instruction)
+                )
+            messages.append(tool_message)
+
+        yield {
+            "type": "done",
+            "stop_reason": stop_reason,
+            "message": message,
+            "new_chat_history": messages,
+            "new_messages": messages[history_length:],
+        }
     except ClientError as err:
         message = err.response["Error"]["Message"]
         logger.error("A client error occurred: %s", message)
-        yield {"error": str(message)}
+        yield {"type": "error", "error": str(message)}
+    except DeadlineExceeded as err:
+        logger.error(f"Stopped streaming for request {prompt}: {err}")
+        yield {"type": "error", "error": str(err)}
 
     else:
         logger.info(f"Successfully finished streaming results for request: {prompt}")
+
+
+# Legacy (v1) stream format built on the v2 events, yields a snapshot of the
+# current text block on every delta, each tool call and the final message
+def run_chat_loop_streaming(existing_chat_history, prompt, document_retriever, config):
+    return stream_events_to_v1(
+        run_chat_loop_stream_events(
+            existing_chat_history, prompt, document_retriever, config
+        )
+    )
+
+
+def stream_events_to_v1(events):
+    text = ""
+    for event in events:
+        if event["type"] == "text_delta":
+            text += event["text"]
+            yield {"role": "assistant", "content": [{"text": text}]}
+        elif event["type"] == "tool_call":
+            text = ""
+            yield {"role": "assistant", "content": [{"toolUse": event["toolUse"]}]}
+        elif event["type"] == "done":
+            yield event["message"]
+        elif event["type"] == "error":
+            yield {"error": event["error"]}
@@ -27,8 +27,14 @@ def generate_converse_message(prompt):
     return {"role": "user", "content": [{"text": prompt}]}
 
 
-def generate_converse_tool_message(fn_result):
+# All tool results of a model turn go back in a single user message
+def generate_converse_tool_message(fn_results):
+    if not isinstance(fn_results, list):
+        raise ValueError(
+            f"Tried to call message generate_converse_tool_message with non-list input: {fn_results}"
+        )
+
     return {
         "role": "user",
-        "content": [{"toolResult": fn_result}],
+        "content": [{"toolResult": fn_result} for fn_result in fn_results],
     }
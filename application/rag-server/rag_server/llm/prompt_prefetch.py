@@ -0,0 +1,103 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import PREFETCH_SIMILARITY_THRESHOLD, PREFETCH_WORKERS
+from data_utils import handle_vector_db_queries
+from model_utils import get_embedding_model
+from retrieval_utils import embed_queries
+
+logger = logging.getLogger(__name__)
+
+prefetch_executor = ThreadPoolExecutor(
+    max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"
+)
+
+_stats_lock = threading.Lock()
+prefetch_stats = {
+    "prefetches": 0,
+    "tool_calls": 0,
+    "full_hits": 0,
+    "queries": 0,
+    "query_hits": 0,
+    "saved_seconds": 0.0,
+}
+
+
+def record_stats(**counts):
+    with _stats_lock:
+        for name, count in counts.items():
+            prefetch_stats[name] += count
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+# Runs the coarse search for the raw user prompt while the first Bedrock request is
+# in flight. Queries the model later generates that embed close enough to the prompt
+# reuse these hits instead of running another coarse search, the retriever's later
+# stages, self query and reranking, still run for each matched query
+class PromptPrefetch:
+    def __init__(self, prompt, document_retriever):
+        self.prompt = prompt
+        self.document_retriever = document_retriever
+        self.coarse_retriever = getattr(
+            document_retriever, "base_retriever", document_retriever
+        )
+        self.embeddings = get_embedding_model()
+        self.duration = None
+        self.finished_at = None
+        self.future = prefetch_executor.submit(self.fetch)
+        record_stats(prefetches=1)
+
+    def fetch(self):
+        start = time.perf_counter()
+        prompt_vector = self.embeddings.embed_query(self.prompt)
+        documents = handle_vector_db_queries([self.prompt], self.coarse_retriever)
+        self.finished_at = time.perf_counter()
+        self.duration = self.finished_at - start
+        return prompt_vector, documents.get(self.prompt, [])
+
+    # Returns {query: documents} for the queries the prefetched documents can serve,
+    # nothing if the prefetch doesn't finish within timeout
+    def match(self, queries, timeout=None):
+        needed_at = time.perf_counter()
+        try:
+            prompt_vector, documents = self.future.result(timeout)
+        except Exception as e:
+            logger.error(f"Prompt prefetch failed: {e}")
+            return {}
+        if not documents:
+            return {}
+
+        query_vectors = embed_queries(self.embeddings, queries)
+        matched = {}
+        for query, query_vector in zip(queries, query_vectors):
+            similarity = cosine_similarity(prompt_vector, query_vector)
+            if similarity >= PREFETCH_SIMILARITY_THRESHOLD:
+                matched[query] = documents
+            logger.info(
+                f"Prompt prefetch similarity {similarity:.3f} for query {query}"
+            )
+
+        if matched and hasattr(self.document_retriever, "refine"):
+            matched = self.document_retriever.refine(matched)
+
+        # The coarse search only saves time when no other query had to be searched
+        # anyway, and only for the part of it that overlapped with the model call
+        saved = 0.0
+        if len(matched) == len(queries):
+            saved = self.duration - max(0.0, self.finished_at - needed_at)
+        record_stats(
+            tool_calls=1,
+            full_hits=int(len(matched) == len(queries)),
+            queries=len(queries),
+            query_hits=len(matched),
+            saved_seconds=saved,
+        )
+        return matched
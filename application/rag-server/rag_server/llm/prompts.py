@@ -50,6 +50,12 @@ Tuners should also be unique and different than the previously generated tuners,
 with vegan cheese,add mushrooms,gluten-free crust,more vegetables,low-carb sauce
 """
 
+# Sent with the last tool results of a request, once it ran out of tool rounds or time
+final_answer_instruction = (
+    "No more tool calls are possible for this request. Answer the user now using "
+    "the information you already have, and say so if it is incomplete."
+)
+
 self_query_sys_prompt = """"""
 # self_query_sys_prompt = """
 # system: You are a helpful assistant and expert in cooking recipes.
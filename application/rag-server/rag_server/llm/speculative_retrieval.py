@@ -0,0 +1,187 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import SPECULATIVE_RETRIEVAL_WORKERS
+from data_utils import handle_vector_db_queries, normalize_queries
+
+from .tool_executor import tool_semaphores
+
+logger = logging.getLogger(__name__)
+
+# Separate from the tool and retrieval pools, tool calls wait on these futures
+speculative_executor = ThreadPoolExecutor(
+    max_workers=SPECULATIVE_RETRIEVAL_WORKERS, thread_name_prefix="speculative"
+)
+
+_stats_lock = threading.Lock()
+speculative_stats = {
+    "launched": 0,
+    "used": 0,
+    "cancelled": 0,
+    "discarded": 0,
+    "skipped": 0,
+}
+
+
+def record_stat(name, count=1):
+    with _stats_lock:
+        speculative_stats[name] += count
+
+
+# Incremental parser over the streamed tool input JSON, e.g. {"queries": ["a", "b"]}.
+# feed() returns every string of the top level "queries" array completed so far,
+# so retrieval can start before the model finishes writing the rest of the input
+class QueriesArrayParser:
+    def __init__(self, key="queries"):
+        self.key = key
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.raw = []
+        self.last_string = None
+        self.current_key = None
+        self.in_queries = False
+
+    def feed(self, chunk):
+        completed = []
+        for char in chunk:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.raw.append(char)
+                elif char == "\\":
+                    self.escape = True
+                    self.raw.append(char)
+                elif char == '"':
+                    self.in_string = False
+                    value = json.loads('"' + "".join(self.raw) + '"')
+                    if self.in_queries and len(self.stack) == 2:
+                        completed.append(value)
+                    self.last_string = value
+                else:
+                    self.raw.append(char)
+            elif char == '"':
+                self.in_string = True
+                self.raw = []
+            elif char == ":" and len(self.stack) == 1:
+                self.current_key = self.last_string
+            elif char == "," and len(self.stack) == 1:
+                self.current_key = None
+            elif char in "{[":
+                self.stack.append(char)
+                if (
+                    char == "["
+                    and len(self.stack) == 2
+                    and self.current_key == self.key
+                ):
+                    self.in_queries = True
+            elif char in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if len(self.stack) < 2:
+                    self.in_queries = False
+        return completed
+
+
+# Launches a vector search as soon as the parser completes queries, the queries
+# completed by one chunk are searched together through the retriever's batch path.
+# Once the tool input is final, searches for queries the model didn't keep are
+# cancelled
+class SpeculativeRetrieval:
+    def __init__(self, document_retriever):
+        self.document_retriever = document_retriever
+        self.parser = QueriesArrayParser()
+        self.futures = {}
+
+    def feed(self, chunk):
+        if self.parser is None:
+            return
+        try:
+            queries = self.parser.feed(chunk)
+        except ValueError as e:
+            logger.warning(f"Stopping speculative retrieval, unparsable input: {e}")
+            self.parser = None
+            return
+        queries = [
+            query for query in dict.fromkeys(queries) if query not in self.futures
+        ]
+        if not queries:
+            return
+
+        # Counted against the recipe tool's concurrency limit. A slot is never waited
+        # for since the tool call holding one may be waiting on these searches, the
+        # queries are then searched by the tool call instead
+        semaphore = tool_semaphores["query_food_recipe_vector_db"]
+        if not semaphore.acquire(blocking=False):
+            record_stat("skipped", len(queries))
+            return
+        future = speculative_executor.submit(
+            handle_vector_db_queries, queries, self.document_retriever
+        )
+        # Also runs when the search is cancelled before it started
+        future.add_done_callback(lambda _: semaphore.release())
+        for query in queries:
+            self.futures[query] = future
+        record_stat("launched", len(queries))
+
+    def finalize(self, final_queries):
+        self.drop_unused(normalize_queries(final_queries))
+
+    # A future is shared by the queries launched together, it is only cancelled when
+    # none of them are still wanted
+    def drop_unused(self, wanted_queries):
+        wanted_queries = set(wanted_queries)
+        wanted_futures = {
+            future for query, future in self.futures.items() if query in wanted_queries
+        }
+        for query in list(self.futures):
+            if query in wanted_queries:
+                continue
+            future = self.futures.pop(query)
+            # Searches that already started can't be interrupted, their result is dropped
+            if future not in wanted_futures and future.cancel():
+                record_stat("cancelled")
+            else:
+                record_stat("discarded")
+
+    # Waits on the speculative searches and runs whatever wasn't prefetched in one call,
+    # timeout bounds the whole call. Searches for any other query are dropped, e.g.
+    # ones the prompt prefetch already answered
+    def results_for(self, queries, timeout=None):
+        queries = normalize_queries(queries)
+        self.drop_unused(queries)
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        context_docs = {}
+        missing = []
+        for query in queries:
+            future = self.futures.pop(query, None)
+            if future is None:
+                missing.append(query)
+                continue
+            try:
+                remaining = None
+                if expires_at is not None:
+                    remaining = max(0.0, expires_at - time.monotonic())
+                results = future.result(remaining)
+                if query not in results:
+                    raise ValueError("no results returned")
+                context_docs[query] = results[query]
+                record_stat("used")
+            except Exception as e:
+                logger.error(f"Speculative retrieval failed for query {query}: {e}")
+                missing.append(query)
+
+        if missing and (expires_at is None or time.monotonic() < expires_at):
+            remaining = None
+            if expires_at is not None:
+                remaining = expires_at - time.monotonic()
+            context_docs.update(
+                handle_vector_db_queries(missing, self.document_retriever, remaining)
+            )
+        # Keep the order the model asked for
+        return {
+            query: context_docs[query] for query in queries if query in context_docs
+        }
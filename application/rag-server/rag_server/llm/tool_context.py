@@ -0,0 +1,51 @@
+import threading
+
+from context_builder import SeenRecipes, seen_recipes_from_history
+
+from .history_compaction import compact_history
+from .prompt_prefetch import PromptPrefetch
+
+
+# Per request state shared by the tool calls of every model turn
+class ToolContext:
+    def __init__(
+        self,
+        document_retriever,
+        config=None,
+        prompt=None,
+        chat_history=None,
+        deadline=None,
+    ):
+        self.document_retriever = document_retriever
+        self.config = config
+        self.deadline = deadline
+        # Recipes already in the conversation are not sent again, unless compaction
+        # removed them from what the model sees
+        if chat_history and config is not None:
+            chat_history = compact_history(chat_history, config.history_token_ceiling)
+        self.seen_recipes = SeenRecipes(seen_recipes_from_history(chat_history))
+
+        # Opt in, search on the raw prompt while the first model call runs
+        self.prompt_prefetch = None
+        if config is not None and config.prefetch_retrieval and prompt:
+            self.prompt_prefetch = PromptPrefetch(prompt, document_retriever)
+
+        # Tool calls served in a degraded mode since the last model turn
+        self.degraded = []
+        self._degraded_lock = threading.Lock()
+
+    def record_degraded(self, tool_call, reasons):
+        with self._degraded_lock:
+            self.degraded.append(
+                {
+                    "type": "degraded",
+                    "tool_use_id": tool_call["id"],
+                    "name": tool_call["name"],
+                    "reasons": reasons,
+                }
+            )
+
+    def pop_degraded(self):
+        with self._degraded_lock:
+            degraded, self.degraded = self.degraded, []
+            return degraded
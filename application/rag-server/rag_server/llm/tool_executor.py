@@ -0,0 +1,218 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from threading import BoundedSemaphore
+
+from api_types import DocRetreiver
+from circuit_breaker import CircuitOpenError, circuit_breakers
+from constants import (CONTEXT_TOKEN_BUDGET, TOOL_CONCURRENCY_LIMITS,
+                       TOOL_EXECUTOR_WORKERS, WEB_SEARCH_DEADLINE)
+from context_builder import build_recipe_context
+from data_utils import (deserialize_docs, get_secret, handle_vector_db_queries,
+                        normalize_queries, serialize_docs)
+from google_search import handle_google_web_search
+from retriever_registry import retrieval_results_key
+from tool_cache import get_collection_epoch, tool_result_caches
+
+logger = logging.getLogger(__name__)
+
+# Shared by the invoke_model and converse_stream chat loops. Every tool call of a
+# model turn is dispatched at once, the per tool semaphores cap how many calls of
+# one tool run at the same time across all requests on the worker
+tool_executor = ThreadPoolExecutor(
+    max_workers=TOOL_EXECUTOR_WORKERS, thread_name_prefix="tools"
+)
+tool_semaphores = {
+    name: BoundedSemaphore(limit) for name, limit in TOOL_CONCURRENCY_LIMITS.items()
+}
+
+
+@lru_cache(maxsize=1)
+def get_google_search_api_key():
+    return get_secret("google_search_api_key")
+
+
+# Reasons the configured retriever will run below its level, see retrieval_utils for
+# where each open breaker is skipped
+def retrieval_degradations(config):
+    if config is None:
+        return []
+    degradations = []
+    if (
+        config.retriever == DocRetreiver.self_query_chain
+        and circuit_breakers["openai"].is_open()
+    ):
+        degradations.append("self_query_chain -> reranker, openai circuit open")
+    if (
+        config.retriever
+        in (
+            DocRetreiver.self_query_chain,
+            DocRetreiver.reranker,
+        )
+        and circuit_breakers["reranker"].is_open()
+    ):
+        degradations.append("reranker -> coarse, reranker circuit open")
+    return degradations
+
+
+def retrieve_recipe_docs(queries, tool_call, tool_context):
+    # Searches may already be running from the streamed tool input
+    speculative = tool_call.get("speculative")
+
+    # Results depend on how documents are retrieved, so uncacheable without a config
+    cache = tool_result_caches["query_food_recipe_vector_db"]
+    cache_key = None
+    if tool_context.config is not None:
+        cache_key = cache.cache_key(
+            queries, retrieval_results_key(tool_context.config), get_collection_epoch()
+        )
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if speculative is not None:
+                speculative.finalize([])
+            return deserialize_docs(cached)
+
+    timeout = None
+    if tool_context.deadline is not None:
+        timeout = tool_context.deadline.tool_time()
+
+    context_docs = {}
+    if tool_context.prompt_prefetch is not None:
+        context_docs = tool_context.prompt_prefetch.match(queries, timeout)
+
+    remaining = [query for query in queries if query not in context_docs]
+    if speculative is not None:
+        # Called even with nothing remaining so unused searches are dropped
+        context_docs.update(speculative.results_for(remaining, timeout))
+    elif remaining:
+        context_docs.update(
+            handle_vector_db_queries(
+                remaining, tool_context.document_retriever, timeout
+            )
+        )
+
+    # Keep the order the model asked for
+    context_docs = {
+        query: context_docs[query] for query in queries if query in context_docs
+    }
+    # Searches cut off by the deadline leave queries out, those results aren't kept
+    if cache_key is not None and all(query in context_docs for query in queries):
+        cache.set(cache_key, serialize_docs(context_docs))
+    return context_docs
+
+
+# The documents are cached rather than the tool result, which depends on the recipes
+# the conversation has already seen
+def run_recipe_db_query(tool_call, tool_context):
+    queries = normalize_queries(tool_call["input"]["queries"])
+    # Every retriever searches Qdrant, without it there is nothing to fall back to
+    if circuit_breakers["qdrant"].is_open():
+        raise CircuitOpenError("qdrant circuit is open")
+    degradations = retrieval_degradations(tool_context.config)
+    if degradations:
+        tool_context.record_degraded(tool_call, degradations)
+    context_docs = retrieve_recipe_docs(queries, tool_call, tool_context)
+    token_budget = CONTEXT_TOKEN_BUDGET
+    if tool_context.config is not None:
+        token_budget = tool_context.config.context_token_budget
+    return build_recipe_context(context_docs, tool_context.seen_recipes, token_budget)
+
+
+def run_google_web_search(tool_call, tool_context):
+    # Search results and pages are cached per query and per url by google_search
+    queries = tool_call["input"]["queries"]
+    if circuit_breakers["google_search"].is_open():
+        raise CircuitOpenError("google_search circuit is open")
+
+    deadline = WEB_SEARCH_DEADLINE
+    if tool_context.deadline is not None:
+        deadline = min(deadline, tool_context.deadline.tool_time())
+    search_results = handle_google_web_search(
+        queries, get_google_search_api_key(), deadline=deadline
+    )
+    return json.dumps(search_results)
+
+
+tool_handlers = {
+    "query_food_recipe_vector_db": run_recipe_db_query,
+    "google_web_search": run_google_web_search,
+}
+
+
+TOOL_TIMEOUT_MESSAGE = "The tool call didn't finish in time, no results are available."
+TOOL_SKIPPED_MESSAGE = "The tool call was skipped, the request is out of time."
+TOOL_UNAVAILABLE_MESSAGE = (
+    "The tool is temporarily unavailable, answer without it and tell the user."
+)
+
+
+def tool_error(content=""):
+    return {"content": content, "is_error": True}
+
+
+# Runs one tool call given as {"id": "", "name": "", "input": {}} plus an optional
+# "speculative" SpeculativeRetrieval, returns a format independent result
+# {"content": "", "is_error": bool}
+def run_tool_call(tool_call, tool_context):
+    fn_name = tool_call["name"]
+    fn_args = tool_call["input"]
+
+    if fn_name not in tool_handlers:
+        logger.error(f"ERROR: Attempted call to unknown function {fn_name}")
+        return tool_error()
+
+    if not isinstance(fn_args, dict) or "queries" not in fn_args:
+        logger.error(
+            f"ERROR: Tried to call {fn_name} with invalid args {fn_args}, skipping.."
+        )
+        return tool_error()
+
+    logger.info(f"Model called {fn_name} with args {fn_args}")
+    try:
+        with tool_semaphores[fn_name]:
+            content = tool_handlers[fn_name](tool_call, tool_context)
+    except CircuitOpenError as e:
+        logger.error(f"Skipping {fn_name}, {e}")
+        tool_context.record_degraded(tool_call, [f"{fn_name} skipped, {e}"])
+        return tool_error(TOOL_UNAVAILABLE_MESSAGE)
+    except Exception as e:
+        logger.error(f"ERROR: {fn_name} failed with args {fn_args}: {e}")
+        return tool_error()
+    return {"content": content, "is_error": False}
+
+
+# Results are returned in the same order as tool_calls regardless of which finishes first.
+# With a deadline, calls are only waited on for the time the request has left for
+# tools, the model gets an error result for each call that didn't finish
+def execute_tool_calls(tool_calls, tool_context):
+    deadline = tool_context.deadline
+    if len(tool_calls) == 1 and deadline is None:
+        return [run_tool_call(tool_calls[0], tool_context)]
+
+    if deadline is not None and deadline.tool_time() <= 0:
+        logger.error(
+            f"Skipping {len(tool_calls)} tool calls, the request is out of time"
+        )
+        return [tool_error(TOOL_SKIPPED_MESSAGE) for _tool_call in tool_calls]
+
+    futures = [
+        tool_executor.submit(run_tool_call, tool_call, tool_context)
+        for tool_call in tool_calls
+    ]
+    if deadline is None:
+        return [future.result() for future in futures]
+
+    _done, pending = wait(futures, timeout=deadline.tool_time())
+    results = []
+    for tool_call, future in zip(tool_calls, futures):
+        if future in pending:
+            # Calls still queued never start, running ones finish in the background
+            future.cancel()
+            logger.error(
+                f"{tool_call['name']} didn't finish before the request deadline"
+            )
+            results.append(tool_error(TOOL_TIMEOUT_MESSAGE))
+        else:
+            results.append(future.result())
+    return results
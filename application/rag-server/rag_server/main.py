@@ -10,23 +10,39 @@ from typing import Optional
 
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, HTTPException, Security, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from fastapi.security import APIKeyHeader, APIKeyQuery
 from pydantic import ValidationError
+from starlette.background import BackgroundTask
 
+from admission import admission_stats, admit_request
 from api_types import (ChatHistoryResponse, ChatRequest, CoarseSearchType,
                        DocRetreiver, DocsQueryRequest, DocsQueryResponse,
-                       DocumentResponse, DynamicTunersRequest,
+                       DocumentResponse, DynamicTunersRequest, StreamFormat,
                        TestQueriesRequest)
+from circuit_breaker import circuit_breaker_stats
 from constants import BUCKET_NAME_TESTING
-from data_utils import (handle_vector_db_queries, initialize_vector_db,
+from context_builder import context_stats
+from data_utils import (handle_vector_db_queries_async, initialize_vector_db,
                         upload_to_s3)
-from llm.llm_handler import (message_handler, run_chat_loop,
-                             run_chat_loop_streaming)
+from deadline import Deadline, DeadlineExceeded
+from llm.llm_handler import (message_handler_async, run_chat_loop_async,
+                             run_chat_loop_stream_events, stream_events_to_v1)
+from llm.prompt_prefetch import prefetch_stats
 from llm.prompts import dynamic_prompt_tuners
-from retrieval_utils import initialize_retrieval_chain, intialize_reranker
+from llm.speculative_retrieval import speculative_stats
+from response_cache import (cached_stream_events, lookup_chat_response,
+                            record_stream_events, response_cache,
+                            should_use_response_cache, store_chat_response)
+from retrieval_utils import (BatchSimilarityRetriever,
+                             initialize_retrieval_chain, intialize_reranker)
+from retriever_registry import RetrieverRegistry
+from session_store import new_session_id, session_store
 from test_queries import gate_keeper_queries, test_queries
+from tool_cache import tool_cache_stats
+from web_cache import web_cache_stats
 
 # Limit concurrency
 TEST_QUERY_SEMAPHORE = Semaphore(5)
@@ -82,13 +98,10 @@ api_key_query = APIKeyQuery(name="api_key", auto_error=False)
 
 # Dynamically determine doc retriever based on request
 # defaults to coarse if no retriever was specified
-def get_retriever(config):
+def build_retriever(config):
     # Initialize coarse retriever regardless as its used for all types
     if config.coarse_search_type == CoarseSearchType.similarity:
-        coarse_retriever = store.as_retriever(
-            search_type=CoarseSearchType.similarity,
-            search_kwargs={"k": config.coarse_top_k},
-        )
+        coarse_retriever = BatchSimilarityRetriever(store=store, k=config.coarse_top_k)
     else:
         coarse_retriever = store.as_retriever(
             search_type=CoarseSearchType.mmr,
@@ -102,11 +115,19 @@ def get_retriever(config):
     if config.retriever == DocRetreiver.reranker:
         return intialize_reranker(coarse_retriever, config)
     elif config.retriever == DocRetreiver.self_query_chain:
-        return initialize_retrieval_chain(coarse_retriever, config)
+        return initialize_retrieval_chain(store, coarse_retriever, config)
     else:
         return coarse_retriever
 
 
+# Built retrievers are reused across requests with the same retrieval config
+retriever_registry = RetrieverRegistry(build_retriever)
+
+
+def get_retriever(config):
+    return retriever_registry.get(config)
+
+
 async def get_api_key(
     api_key_header: str = Security(api_key_header),
     api_key_query: str = Security(api_key_query),
@@ -124,11 +145,77 @@ async def get_api_key(
         )
 
 
+# Returns (session_id, chat history as dicts). Requests without use_session keep
+# sending the full history, session requests only send the new prompt
+def load_chat_history(request, history_format):
+    if not request.use_session:
+        chat_history = [
+            message.model_dump() for message in request.existing_chat_history
+        ]
+        return None, chat_history
+
+    if request.existing_chat_history:
+        raise HTTPException(
+            status_code=400,
+            detail="existing_chat_history can't be sent with use_session",
+        )
+    if request.session_id is None:
+        # Saved right away, streams send the id before the turn is done and a failed
+        # turn must still leave a session the client can continue
+        session_id = new_session_id()
+        save_chat_history(session_id, history_format, [])
+        return session_id, []
+
+    session = session_store.get(request.session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+    if session["format"] != history_format:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Session was started on the {session['format']} endpoint",
+        )
+    return request.session_id, session["messages"]
+
+
+def save_chat_history(session_id, history_format, chat_history):
+    session_store.save(session_id, {"format": history_format, "messages": chat_history})
+
+
+# Stores the finished turn and strips the full history from the done event
+def session_stream_events(events, session_id):
+    for event in events:
+        if event["type"] == "done":
+            save_chat_history(session_id, "stream", event["new_chat_history"])
+            event = {
+                key: value for key, value in event.items() if key != "new_chat_history"
+            }
+            event["session_id"] = session_id
+        yield event
+
+
 @app.get("/v1/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 
+# Per worker counters, each gunicorn worker reports its own values
+@app.get("/v1/metrics")
+async def get_metrics(api_key: str = Depends(get_api_key)):
+    return {
+        "pid": os.getpid(),
+        "retriever_cache": retriever_registry.stats(),
+        "embedding_cache": store.embeddings.stats(),
+        "speculative_retrieval": dict(speculative_stats),
+        "prompt_prefetch": dict(prefetch_stats),
+        "tool_cache": tool_cache_stats(),
+        "web_cache": web_cache_stats(),
+        "circuit_breakers": circuit_breaker_stats(),
+        "admission": admission_stats(),
+        "response_cache": response_cache.stats(),
+        "recipe_context": dict(context_stats),
+    }
+
+
 @app.post("/v1/prompt/tuners")
 async def generate_prompt_tuners(
     request: DynamicTunersRequest, api_key: str = Depends(get_api_key)
@@ -147,7 +234,7 @@ async def generate_prompt_tuners(
             "{previous_tuners}", prev_tuners_str
         )
         # Prompt already has chat history injected, empty history used to not provide it twice
-        response_body, llm_message, updated_chat_history = message_handler(
+        response_body, llm_message, updated_chat_history = await message_handler_async(
             [], prompt_with_prev_tuners, request.config
         )
         model_text_output = llm_message["content"][0]["text"]
@@ -167,44 +254,138 @@ async def generate_prompt_tuners(
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+# The admission slot is held until the stream ends or the client goes away, the
+# generator and the background task both release it and only the first one counts
 @app.post("/v1/chat/stream")
-async def stream_chat(request: ChatRequest, api_key: str = Depends(get_api_key)):
+async def stream_chat(
+    request: ChatRequest,
+    stream_format: StreamFormat = StreamFormat.v1,
+    api_key: str = Depends(get_api_key),
+):
+    release = await admit_request("chat_stream")
+    try:
+        return await stream_chat_response(request, stream_format, release)
+    except BaseException:
+        release()
+        raise
+
+
+async def stream_chat_response(request, stream_format, release):
     logger.info("Received stream_chat request with prompt: %s", request.prompt)
-    doc_retriever = get_retriever(request.config)
-    chat_history_as_dicts = [
-        message.model_dump() for message in request.existing_chat_history
-    ]
+    deadline = Deadline(request.config.request_deadline)
+    session_id, chat_history_as_dicts = await run_in_threadpool(
+        load_chat_history, request, "stream"
+    )
+    use_cache = should_use_response_cache(request, chat_history_as_dicts)
+    events = None
+    if use_cache:
+        events = await run_in_threadpool(
+            cached_stream_events, request.prompt, request.config
+        )
+
+    if events is None:
+        # A retriever cache miss may load models, keep that off the event loop
+        doc_retriever = await run_in_threadpool(get_retriever, request.config)
+        events = run_chat_loop_stream_events(
+            chat_history_as_dicts,
+            request.prompt,
+            doc_retriever,
+            request.config,
+            deadline,
+        )
+        if use_cache:
+            events = record_stream_events(events, request.prompt, request.config)
+
+    headers = {}
+    if session_id is not None:
+        events = session_stream_events(events, session_id)
+        # v1 events don't carry the session id, clients read it from the header
+        headers["X-Session-Id"] = session_id
+
+    if stream_format == StreamFormat.v1:
+        events = stream_events_to_v1(events)
 
     def event_stream():
         try:
-            for chunk in run_chat_loop_streaming(
-                chat_history_as_dicts, request.prompt, doc_retriever, request.config
-            ):
+            for chunk in events:
                 yield f"data: {json.dumps(chunk)}\n\n"
         except Exception as e:
             logger.error("Error in event_stream: %s", e)
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+            if stream_format == StreamFormat.v2:
+                yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+            else:
+                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            release()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=headers,
+        background=BackgroundTask(release),
+    )
 
 
 @app.post("/v1/chat")
 async def generate_message(request: ChatRequest, api_key: str = Depends(get_api_key)):
+    release = await admit_request("chat")
+    try:
+        return await run_chat_request(request)
+    finally:
+        release()
+
+
+# Test sweeps call this directly, they are bounded by TEST_QUERY_SEMAPHORE instead
+async def run_chat_request(request):
     logger.info(f"Running /chat request with config {request.config}")
-    doc_retriever = get_retriever(request.config)
+    deadline = Deadline(request.config.request_deadline)
+    session_id, chat_history_as_dicts = await run_in_threadpool(
+        load_chat_history, request, "chat"
+    )
+    history_length = len(chat_history_as_dicts)
     try:
-        chat_history_as_dicts = [
-            message.model_dump() for message in request.existing_chat_history
-        ]
-        model_text_output, updated_chat_history, fn_calls = run_chat_loop(
-            chat_history_as_dicts, request.prompt, doc_retriever, request.config
-        )
+        use_cache = should_use_response_cache(request, chat_history_as_dicts)
+        chat_response = None
+        if use_cache:
+            chat_response = await run_in_threadpool(
+                lookup_chat_response, request.prompt, request.config
+            )
+
+        if chat_response is None:
+            # A retriever cache miss may load models, keep that off the event loop
+            doc_retriever = await run_in_threadpool(get_retriever, request.config)
+            chat_response = await run_chat_loop_async(
+                chat_history_as_dicts,
+                request.prompt,
+                doc_retriever,
+                request.config,
+                deadline,
+            )
+            if use_cache:
+                await run_in_threadpool(
+                    store_chat_response, request.prompt, request.config, chat_response
+                )
+
+        model_text_output, updated_chat_history, fn_calls = chat_response
         fn_resp = {"user_prompt": request.prompt, "fn_calls": fn_calls}
+        if session_id is not None:
+            await run_in_threadpool(
+                save_chat_history, session_id, "chat", updated_chat_history
+            )
+            return ChatHistoryResponse(
+                llm_response_text=model_text_output,
+                session_id=session_id,
+                new_messages=updated_chat_history[history_length:],
+                fn_calls=fn_resp,
+            )
         return ChatHistoryResponse(
             llm_response_text=model_text_output,
             new_chat_history=updated_chat_history,
             fn_calls=fn_resp,
         )
+    except DeadlineExceeded as e:
+        logger.error(f"Deadline exceeded: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
     except ValidationError as e:
         logger.error(f"Validation error: {e}")
         raise HTTPException(status_code=422, detail=str(e))
@@ -221,9 +402,12 @@ async def query_documents(
     request: DocsQueryRequest, api_key: str = Depends(get_api_key)
 ):
     logger.info(f"Running /recipes/query request with config {request.config}")
-    doc_retriever = get_retriever(request.config)
+    # A retriever cache miss may load models, keep that off the event loop
+    doc_retriever = await run_in_threadpool(get_retriever, request.config)
     try:
-        document_objects = handle_vector_db_queries(request.queries, doc_retriever)
+        document_objects = await handle_vector_db_queries_async(
+            request.queries, doc_retriever
+        )
         query_results = {}
 
         # Populate the dictionary with DocumentResponse objects
@@ -249,10 +433,14 @@ async def process_query(i, query, config):
             **config.model_dump(),  # Flatten config params into the main dictionary
         }
         try:
+            # Test sweeps measure fresh generations, never cached ones
             chat_request = ChatRequest(
-                existing_chat_history=[], prompt=query, config=config
+                existing_chat_history=[],
+                prompt=query,
+                config=config,
+                bypass_cache=True,
             )
-            response = await generate_message(chat_request)
+            response = await run_chat_request(chat_request)
             entry["Query_Response"] = response.llm_response_text
         except Exception as e:
             err = f"Error occurred during generation: {e}\n{format_exc()}"
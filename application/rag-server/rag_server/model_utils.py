@@ -0,0 +1,104 @@
+import logging
+from threading import Lock
+
+from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from constants import (EMBEDDING_MODEL_ID, INFERENCE_BACKEND,
+                       RERANKER_MODEL_ID, USE_INFERENCE_SIDECAR)
+from embedding_cache import CachedEmbeddings
+from inference_client import (InferenceClient, SidecarCrossEncoder,
+                              SidecarEmbeddings)
+
+logger = logging.getLogger(__name__)
+
+# Heavy models are loaded once per worker and shared by every retriever built from them
+_model_lock = Lock()
+_embedding_model = None
+_reranker_model = None
+_inference_client = None
+
+INFERENCE_BACKENDS = ["torch", "onnx", "onnx_int8"]
+
+
+def validate_backend(backend):
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(
+            "Invalid INFERENCE_BACKEND config - Set in constants.py\n"
+            "\t'torch', 'onnx' or 'onnx_int8'"
+        )
+
+
+# The onnx module is only imported when selected since optimum is an optional dependency
+def load_embedding_model(backend=INFERENCE_BACKEND):
+    validate_backend(backend)
+    if backend == "torch":
+        return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_ID)
+
+    from onnx_models import OnnxEmbeddings
+
+    return OnnxEmbeddings(EMBEDDING_MODEL_ID, quantize=backend == "onnx_int8")
+
+
+def load_reranker_model(backend=INFERENCE_BACKEND):
+    validate_backend(backend)
+    if backend == "torch":
+        return HuggingFaceCrossEncoder(model_name=RERANKER_MODEL_ID)
+
+    from onnx_models import OnnxCrossEncoder
+
+    return OnnxCrossEncoder(RERANKER_MODEL_ID, quantize=backend == "onnx_int8")
+
+
+# Returns the sidecar client when enabled and reachable, workers fall back to
+# loading their own models otherwise
+def get_inference_client():
+    global _inference_client
+
+    if not USE_INFERENCE_SIDECAR:
+        return None
+    if _inference_client is None:
+        client = InferenceClient()
+        if not client.is_available():
+            logger.warning("Inference sidecar unavailable, loading models in worker")
+            return None
+        _inference_client = client
+    return _inference_client
+
+
+# Query time embedding model, wrapped in the embedding cache
+def get_embedding_model():
+    global _embedding_model
+
+    with _model_lock:
+        if _embedding_model is None:
+            logger.info(
+                f"Loading embedding model {EMBEDDING_MODEL_ID} ({INFERENCE_BACKEND})"
+            )
+            inference_client = get_inference_client()
+            _embedding_model = CachedEmbeddings(
+                (
+                    SidecarEmbeddings(inference_client)
+                    if inference_client
+                    else load_embedding_model()
+                ),
+                # Quantized models produce slightly different vectors, keep them apart
+                model_id=f"{EMBEDDING_MODEL_ID}:{INFERENCE_BACKEND}",
+            )
+    return _embedding_model
+
+
+def get_reranker_model():
+    global _reranker_model
+
+    with _model_lock:
+        if _reranker_model is None:
+            logger.info(
+                f"Loading reranker model {RERANKER_MODEL_ID} ({INFERENCE_BACKEND})"
+            )
+            inference_client = get_inference_client()
+            if inference_client:
+                _reranker_model = SidecarCrossEncoder(inference_client)
+            else:
+                _reranker_model = load_reranker_model()
+    return _reranker_model
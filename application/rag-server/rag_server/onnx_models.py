@@ -0,0 +1,180 @@
+"""
+ONNX Runtime versions of the embedding and reranker models for CPU only hosts.
+Models are exported once to ONNX_MODEL_DIR and optionally dynamically quantized
+to int8. Requires the optional optimum dependency:
+    poetry run pip install "optimum[onnxruntime]"
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+import numpy as np
+from huggingface_hub import hf_hub_download
+from langchain_community.cross_encoders.base import BaseCrossEncoder
+from langchain_core.embeddings import Embeddings
+from transformers import AutoTokenizer
+
+try:
+    from optimum.onnxruntime import (ORTModelForFeatureExtraction,
+                                     ORTModelForSequenceClassification,
+                                     ORTQuantizer)
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError as e:
+    raise ImportError(
+        "The onnx inference backends require optimum, install it with "
+        '`poetry run pip install "optimum[onnxruntime]"` or set '
+        'INFERENCE_BACKEND = "torch" in constants.py'
+    ) from e
+
+from constants import ONNX_MODEL_DIR
+
+logger = logging.getLogger(__name__)
+
+MAX_SEQ_LENGTH = 512
+BATCH_SIZE = 32
+QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+# Exports are written to disk, don't let two threads export the same model at once.
+# Other gunicorn workers are kept out by export_atomically
+_export_lock = Lock()
+
+
+# Sentence-transformers ids like "multi-qa-mpnet-base-dot-v1" resolve to this org
+def hub_model_id(model_id):
+    return model_id if "/" in model_id else f"sentence-transformers/{model_id}"
+
+
+# Writes into a temporary directory next to target_dir and renames it into place,
+# so other workers never load a half written export. When another worker got
+# there first its export is kept and this one is discarded
+def export_atomically(target_dir, write):
+    if os.path.exists(target_dir):
+        return
+    parent_dir = os.path.dirname(target_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(
+        dir=parent_dir, prefix=f".{os.path.basename(target_dir)}-"
+    )
+    try:
+        write(temp_dir)
+        os.rename(temp_dir, target_dir)
+    except OSError:
+        if not os.path.exists(target_dir):
+            raise
+        logger.info(f"{target_dir} was exported by another worker")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_onnx_model(model_cls, model_id, quantize=False):
+    model_id = hub_model_id(model_id)
+    export_dir = os.path.join(ONNX_MODEL_DIR, model_id.replace("/", "__"))
+
+    def export(save_dir):
+        logger.info(f"Exporting {model_id} to ONNX at {export_dir}")
+        model = model_cls.from_pretrained(model_id, export=True)
+        model.save_pretrained(save_dir)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(save_dir)
+
+    # Dynamic quantization needs no calibration data, weights are int8 and
+    # activations are quantized on the fly at inference time
+    def quantize_export(save_dir):
+        logger.info(f"Quantizing {model_id} to int8 at {quantized_dir}")
+        quantizer = ORTQuantizer.from_pretrained(export_dir)
+        quantization_config = AutoQuantizationConfig.avx2(
+            is_static=False, per_channel=False
+        )
+        quantizer.quantize(save_dir=save_dir, quantization_config=quantization_config)
+        AutoTokenizer.from_pretrained(export_dir).save_pretrained(save_dir)
+
+    quantized_dir = f"{export_dir}-int8"
+    with _export_lock:
+        export_atomically(export_dir, export)
+        if quantize:
+            export_atomically(quantized_dir, quantize_export)
+
+    if not quantize:
+        return model_cls.from_pretrained(export_dir), AutoTokenizer.from_pretrained(
+            export_dir
+        )
+    return model_cls.from_pretrained(
+        quantized_dir, file_name=QUANTIZED_FILE_NAME
+    ), AutoTokenizer.from_pretrained(quantized_dir)
+
+
+# Reads the pooling mode the sentence-transformers model was trained with,
+# multi-qa-mpnet-base-dot-v1 uses the CLS token
+def load_pooling_mode(model_id):
+    try:
+        config_path = hf_hub_download(hub_model_id(model_id), "1_Pooling/config.json")
+        with open(config_path) as f:
+            pooling_config = json.load(f)
+    except Exception as e:
+        logger.warning(f"No pooling config found for {model_id}, using mean: {e}")
+        return "mean"
+    return "cls" if pooling_config.get("pooling_mode_cls_token") else "mean"
+
+
+# Drop in replacement for HuggingFaceEmbeddings
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, model_id, quantize=False):
+        self.model, self.tokenizer = load_onnx_model(
+            ORTModelForFeatureExtraction, model_id, quantize
+        )
+        self.pooling_mode = load_pooling_mode(model_id)
+
+    def _embed_batch(self, texts):
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=MAX_SEQ_LENGTH,
+            return_tensors="np",
+        )
+        hidden_states = np.asarray(self.model(**inputs).last_hidden_state)
+        if self.pooling_mode == "cls":
+            pooled = hidden_states[:, 0]
+        else:
+            mask = inputs["attention_mask"][..., None].astype(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(axis=1) / np.clip(
+                mask.sum(axis=1), 1e-9, None
+            )
+        return pooled.tolist()
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), BATCH_SIZE):
+            vectors.extend(self._embed_batch(texts[start : start + BATCH_SIZE]))
+        return vectors
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0]
+
+
+# Drop in replacement for HuggingFaceCrossEncoder, scores are passed through a
+# sigmoid like sentence-transformers does for single label cross-encoders
+class OnnxCrossEncoder(BaseCrossEncoder):
+    def __init__(self, model_id, quantize=False):
+        self.model, self.tokenizer = load_onnx_model(
+            ORTModelForSequenceClassification, model_id, quantize
+        )
+
+    def score(self, text_pairs):
+        scores = []
+        for start in range(0, len(text_pairs), BATCH_SIZE):
+            batch = text_pairs[start : start + BATCH_SIZE]
+            inputs = self.tokenizer(
+                [query for query, _ in batch],
+                [passage for _, passage in batch],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors="np",
+            )
+            logits = np.asarray(self.model(**inputs).logits)[:, 0]
+            scores.extend((1 / (1 + np.exp(-logits))).tolist())
+        return scores
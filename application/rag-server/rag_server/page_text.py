@@ -0,0 +1,120 @@
+import codecs
+import logging
+from html.parser import HTMLParser
+
+# lxml isn't a dependency of the server, it is only used when installed
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+logger = logging.getLogger(__name__)
+
+# Elements whose content is never visible page text
+SKIPPED_TAGS = {"script", "style", "nav", "noscript", "template", "svg", "iframe"}
+# Closing these ends every skipped element still open
+DOCUMENT_TAGS = {"body", "html"}
+
+
+# Parser target shared by the lxml and html.parser backends. Collects the visible
+# text of the page and marks itself done once max_chars have been collected
+class VisibleTextCollector:
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.pieces = []
+        self.chars = 0
+        self.skipped = []
+        self.done = False
+
+    def start(self, tag, attrib=None):
+        if tag in SKIPPED_TAGS:
+            self.skipped.append(tag)
+
+    # html.parser doesn't recover unclosed tags the way lxml does, an unclosed <nav>
+    # would otherwise hide the rest of the page. A closing tag also closes the
+    # skipped elements opened inside it, and closing a skipped element that isn't
+    # open or the document ends skipping altogether
+    def end(self, tag):
+        if tag in DOCUMENT_TAGS:
+            self.skipped.clear()
+        elif tag in SKIPPED_TAGS and self.skipped:
+            if tag in self.skipped:
+                while self.skipped.pop() != tag:
+                    pass
+            else:
+                self.skipped.clear()
+
+    def data(self, data):
+        if self.done or self.skipped:
+            return
+        text = data.strip()
+        if not text:
+            return
+        self.pieces.append(text)
+        self.chars += len(text) + 1
+        if self.chars >= self.max_chars:
+            self.done = True
+
+    def close(self):
+        return self.text()
+
+    def text(self):
+        return "\n".join(self.pieces)[: self.max_chars]
+
+
+class StdlibHTMLParser(HTMLParser):
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+# Incremental extractor, feed it the response body chunk by chunk and stop reading
+# once done is set. Bytes are decoded as they arrive, a character split across two
+# chunks is carried over to the next one
+class PageTextExtractor:
+    def __init__(self, max_chars, encoding="utf-8"):
+        self.collector = VisibleTextCollector(max_chars)
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        except LookupError:
+            self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        if etree is not None:
+            self.parser = etree.HTMLParser(target=self.collector, remove_comments=True)
+        else:
+            self.parser = StdlibHTMLParser(self.collector)
+        self.closed = False
+
+    @property
+    def done(self):
+        return self.collector.done
+
+    def feed(self, chunk):
+        text = self.decoder.decode(chunk)
+        if text:
+            self.parser.feed(text)
+
+    # Flushes text the parser still buffers, a page cut off by the byte cap or by
+    # done is not valid HTML so parse errors are expected here
+    def text(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.parser.close()
+            except Exception:
+                pass
+        return self.collector.text()
+
+
+def extract_page_text(html, max_chars):
+    extractor = PageTextExtractor(max_chars)
+    extractor.feed(html.encode("utf-8") if isinstance(html, str) else html)
+    return extractor.text()
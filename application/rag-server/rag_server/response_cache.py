@@ -0,0 +1,202 @@
+import copy
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+from constants import (RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+                       RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                       USE_RESPONSE_CACHE)
+from llm.message_utils import generate_converse_message, generate_message
+from model_utils import get_embedding_model
+
+logger = logging.getLogger(__name__)
+
+
+# Answers only depend on the prompt once the generation config and the response
+# format (invoke_model or converse message schema) are fixed
+def response_cache_key(config, response_format):
+    return f"{response_format}:{json.dumps(config.model_dump(mode='json'), sort_keys=True)}"
+
+
+# Small per worker vector index of first turn prompts. Every key has its own matrix
+# of unit length prompt embeddings, a lookup is one matrix vector product
+class SemanticResponseCache:
+    def __init__(
+        self,
+        threshold=RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+        max_size=RESPONSE_CACHE_SIZE,
+        ttl=RESPONSE_CACHE_TTL,
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self._partitions = {}  # key: {"vectors": np.ndarray, "entries": [...]}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def embed(self, prompt):
+        vector = np.asarray(get_embedding_model().embed_query(prompt), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _size(self):
+        return sum(len(p["entries"]) for p in self._partitions.values())
+
+    def _remove(self, key, indexes):
+        partition = self._partitions[key]
+        keep = [i for i in range(len(partition["entries"])) if i not in indexes]
+        partition["entries"] = [partition["entries"][i] for i in keep]
+        partition["vectors"] = partition["vectors"][keep]
+        if not partition["entries"]:
+            del self._partitions[key]
+
+    def _expire(self, now):
+        for key in list(self._partitions):
+            entries = self._partitions[key]["entries"]
+            expired = {
+                i
+                for i, entry in enumerate(entries)
+                if now - entry["created_at"] > self.ttl
+            }
+            if expired:
+                self._remove(key, expired)
+
+    # Returns (value, similarity) for the closest cached prompt above the threshold,
+    # repeated embeds of the same prompt are served by the embedding cache
+    def lookup(self, prompt, key):
+        vector = self.embed(prompt)
+        with self._lock:
+            self._expire(time.time())
+            partition = self._partitions.get(key)
+            if partition is not None:
+                similarities = partition["vectors"] @ vector
+                best = int(np.argmax(similarities))
+                similarity = float(similarities[best])
+                if similarity >= self.threshold:
+                    self.hits += 1
+                    entry = partition["entries"][best]
+                    logger.info(
+                        f"Response cache hit ({similarity:.3f}) for prompt {prompt}, "
+                        f"cached prompt {entry['prompt']}"
+                    )
+                    return copy.deepcopy(entry["value"]), similarity
+            self.misses += 1
+            return None, None
+
+    def store(self, prompt, key, value):
+        vector = self.embed(prompt)
+        entry = {
+            "prompt": prompt,
+            "value": copy.deepcopy(value),
+            "created_at": time.time(),
+        }
+        with self._lock:
+            partition = self._partitions.setdefault(
+                key,
+                {
+                    "vectors": np.empty((0, len(vector)), dtype=np.float32),
+                    "entries": [],
+                },
+            )
+            partition["vectors"] = np.vstack([partition["vectors"], vector])
+            partition["entries"].append(entry)
+
+            # Evict the oldest entries across all partitions
+            while self._size() > self.max_size:
+                oldest_key = min(
+                    self._partitions,
+                    key=lambda k: self._partitions[k]["entries"][0]["created_at"],
+                )
+                self._remove(oldest_key, {0})
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._partitions.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": USE_RESPONSE_CACHE,
+                "size": self._size(),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+response_cache = SemanticResponseCache()
+
+
+# Only first turn prompts are cached, later turns depend on the whole conversation
+def should_use_response_cache(request, chat_history):
+    return USE_RESPONSE_CACHE and not request.bypass_cache and not chat_history
+
+
+# /v1/chat, the cached chat history starts with the original prompt, swap in the new one
+# Cache failures never fail the request, it is answered without the cache instead
+def lookup_chat_response(prompt, config):
+    try:
+        value, _ = response_cache.lookup(prompt, response_cache_key(config, "chat"))
+    except Exception as e:
+        logger.error(f"Response cache lookup failed: {e}")
+        return None
+    if value is None:
+        return None
+    model_text_output, chat_history, fn_calls = value
+    chat_history[0] = generate_message(prompt)
+    return [model_text_output, chat_history, fn_calls]
+
+
+# Answers built on degraded tool calls are not reused once the dependency recovers
+def is_degraded(fn_calls):
+    return any(fn_call.get("type") == "degraded" for fn_call in fn_calls or [])
+
+
+def store_chat_response(prompt, config, chat_response):
+    if is_degraded(chat_response[2]):
+        return
+    try:
+        response_cache.store(prompt, response_cache_key(config, "chat"), chat_response)
+    except Exception as e:
+        logger.error(f"Failed to store chat response in cache: {e}")
+
+
+# /v1/chat/stream, replays the recorded v2 events of the original answer
+def cached_stream_events(prompt, config):
+    try:
+        events, _ = response_cache.lookup(prompt, response_cache_key(config, "stream"))
+    except Exception as e:
+        logger.error(f"Response cache lookup failed: {e}")
+        return None
+    if events is None:
+        return None
+    done_event = events[-1]
+    done_event["new_chat_history"][0] = generate_converse_message(prompt)
+    done_event["new_messages"][0] = done_event["new_chat_history"][0]
+    return events
+
+
+# Passes the events through and stores them once the stream completes without errors
+# or degraded tool calls
+def record_stream_events(events, prompt, config):
+    recorded = []
+    for event in events:
+        recorded.append(event)
+        yield event
+        if event["type"] in ("error", "degraded"):
+            yield from events
+            return
+    if recorded and recorded[-1]["type"] == "done":
+        try:
+            response_cache.store(prompt, response_cache_key(config, "stream"), recorded)
+        except Exception as e:
+            logger.error(f"Failed to store streamed response in cache: {e}")
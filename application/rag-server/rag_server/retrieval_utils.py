@@ -1,46 +1,171 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from threading import Lock
+from typing import Any
 
-from langchain.retrievers import ContextualCompressionRetriever
+from langchain.chains.query_constructor.base import \
+    load_query_constructor_runnable
 from langchain.retrievers.document_compressors import CrossEncoderReranker
-from langchain.retrievers.self_query.base import SelfQueryRetriever
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-from langchain_community.vectorstores import Qdrant
-from langchain_core.runnables import RunnableMap, RunnablePassthrough
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.query_constructors.qdrant import QdrantTranslator
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
+from qdrant_client.http import models as rest
 
-from constants import COARSE_TOP_K, EMBEDDING_MODEL_ID, RERANKER_MODEL_ID
+from circuit_breaker import CircuitOpenError, circuit_breakers
+from constants import SELF_QUERY_TIMEOUT
 from llm.prompts import (DOCUMENT_CONTENT_DESCRIPTION, METADATA_FIELD_INFO,
                          self_query_sys_prompt)
+from model_utils import get_reranker_model
 
 logger = logging.getLogger(__name__)
-self_query_llm = None
-fine_retriever = None
-embedding_model = None
+
+
+# The embedding model has no separate query instruction, so embedding all queries
+# as one batch gives the same vectors as embedding them one at a time
+def embed_queries(embeddings, queries):
+    if len(queries) == 1:
+        return [embeddings.embed_query(queries[0])]
+    return embeddings.embed_documents(queries)
+
+
+def document_from_point(store, point):
+    payload = point.payload or {}
+    metadata = dict(payload.get(store.metadata_payload_key) or {})
+    metadata["_id"] = point.id
+    metadata["_collection_name"] = store.collection_name
+    return Document(
+        page_content=payload.get(store.content_payload_key, ""), metadata=metadata
+    )
+
+
+# Similarity retriever that serves every query of a tool call with one embedding
+# forward pass and one Qdrant batch search request, see handle_vector_db_queries
+class BatchSimilarityRetriever(BaseRetriever):
+    store: Any
+    k: int = 5
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self.batch_retrieve([query])[query]
+
+    def batch_retrieve(self, queries):
+        # Duplicate queries would map to the same key, only search them once
+        queries = list(dict.fromkeys(queries))
+        query_vectors = embed_queries(self.store.embeddings, queries)
+
+        search_requests = []
+        for query_vector in query_vectors:
+            if self.store.vector_name:
+                query_vector = rest.NamedVector(
+                    name=self.store.vector_name, vector=query_vector
+                )
+            search_requests.append(
+                rest.SearchRequest(vector=query_vector, limit=self.k, with_payload=True)
+            )
+
+        batch_results = circuit_breakers["qdrant"].call(
+            self.store.client.search_batch,
+            collection_name=self.store.collection_name,
+            requests=search_requests,
+        )
+        return {
+            query: [document_from_point(self.store, point) for point in points]
+            for query, points in zip(queries, batch_results)
+        }
 
 
 def intialize_reranker(base_retriever, config):
-    reranker_model = HuggingFaceCrossEncoder(model_name=RERANKER_MODEL_ID)
-    compressor = CrossEncoderReranker(model=reranker_model, top_n=config.reranker_top_n)
-    reranker_retriever = ContextualCompressionRetriever(
-        base_compressor=compressor, base_retriever=base_retriever
+    return BatchRerankRetriever(
+        base_retriever=base_retriever,
+        model=get_reranker_model(),
+        top_n=config.reranker_top_n,
     )
-    return reranker_retriever
 
 
-def initialize_chain_models(config):
-    global embedding_model
+# Scores the (query, candidate) pairs of every query in one cross-encoder call and
+# splits them back into per query top_n lists, same ordering as CrossEncoderReranker
+def rerank_batch(model, candidates, top_n):
+    pairs = []
+    for query, documents in candidates.items():
+        for document in documents:
+            pairs.append((query, document))
+    if not pairs:
+        return {query: [] for query in candidates}
 
-    logger.info("Initializing retrieval models")
-    embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_ID)
+    # Sorting by length groups similar sized pairs in the model's internal batches,
+    # which cuts down on padding
+    order = sorted(
+        range(len(pairs)),
+        key=lambda i: len(pairs[i][0]) + len(pairs[i][1].page_content),
+    )
+    sorted_scores = model.score(
+        [(pairs[i][0], pairs[i][1].page_content) for i in order]
+    )
+    scores = [0.0] * len(pairs)
+    for position, pair_index in enumerate(order):
+        scores[pair_index] = sorted_scores[position]
 
+    scored_docs = {query: [] for query in candidates}
+    for (query, document), score in zip(pairs, scores):
+        scored_docs[query].append((document, score))
+
+    return {
+        query: [
+            doc
+            for doc, _ in sorted(docs_with_scores, key=itemgetter(1), reverse=True)[
+                :top_n
+            ]
+        ]
+        for query, docs_with_scores in scored_docs.items()
+    }
+
+
+# Reranker retriever that gathers the coarse hits for every query of a tool call
+# before scoring them together, see handle_vector_db_queries
+class BatchRerankRetriever(BaseRetriever):
+    base_retriever: Any
+    model: Any
+    top_n: int = 1
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self.batch_retrieve([query])[query]
+
+    def batch_retrieve(self, queries):
+        queries = list(dict.fromkeys(queries))
+        if hasattr(self.base_retriever, "batch_retrieve"):
+            candidates = self.base_retriever.batch_retrieve(queries)
+        else:
+            with ThreadPoolExecutor() as executor:
+                results = executor.map(self.base_retriever.invoke, queries)
+                candidates = dict(zip(queries, results))
+        return self.refine(candidates)
+
+    # Reranks coarse hits given as {query: documents}, also used for the hits of the
+    # prompt prefetch. Degrades to the coarse ranking while the reranker is failing
+    # or slow
+    def refine(self, candidates):
+        try:
+            return circuit_breakers["reranker"].call(
+                rerank_batch, self.model, candidates, self.top_n
+            )
+        except CircuitOpenError:
+            return {
+                query: documents[: self.top_n]
+                for query, documents in candidates.items()
+            }
+
+
+def initialize_self_query_llm(config):
     if config.self_query_api == "OpenAI":
         self_query_llm = ChatOpenAI(
             model=config.self_query_model,
             temperature=0,
             openai_api_key=os.environ.get("OPENAI_API_KEY"),
-            max_retries=3,
+            timeout=SELF_QUERY_TIMEOUT,
+            max_retries=1,
         )
     elif config.self_query_api == "Azure":
         self_query_llm = AzureChatOpenAI(
@@ -48,6 +173,8 @@ def initialize_chain_models(config):
             azure_deployment="capstone_gpt4o",
             openai_api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
             azure_endpoint="https://capstone1.openai.azure.com/",
+            timeout=SELF_QUERY_TIMEOUT,
+            max_retries=1,
         )
     else:
         raise ValueError(
@@ -58,23 +185,7 @@ def initialize_chain_models(config):
         f"Found openAI credentials in environmental variables\n"
         f"Using {config.self_query_api} for self_query_llm"
     )
-
-    reranker_model = HuggingFaceCrossEncoder(model_name="BAAI/bge-reranker-base")
-
-    fine_search = CrossEncoderReranker(model=reranker_model, top_n=1)
-
-    return self_query_llm, fine_search
-
-
-def filtered_qdrant_store(documents=[]):
-    # dependent on embedding_model global variable
-    logger.info(f"intermediate qdrant store of {len(documents)} documents instantiated")
-    filtered_qdrant_store = Qdrant.from_documents(
-        documents,
-        embedding_model,
-        location=":memory:",
-    )
-    return filtered_qdrant_store
+    return self_query_llm
 
 
 def self_query_message_prompt(user_prompt):
@@ -83,88 +194,164 @@ def self_query_message_prompt(user_prompt):
     return message
 
 
-def self_query_wrapper(dict):
-    # dependent on global variable self_query_llm
-    prompt = self_query_message_prompt(dict["query"])
-    temp_store = filtered_qdrant_store(dict["documents"])
+# Owns the models used by the self query chain. Models are shared, read only after
+# construction and every call works on local state, so one engine can serve
+# concurrent requests from multiple threads
+class SelfQueryRetrievalEngine:
+    def __init__(self, store, config):
+        logger.info("Initializing retrieval models")
+        self.store = store
+        self.self_query_llm = initialize_self_query_llm(config)
+        self.fine_retriever = CrossEncoderReranker(model=get_reranker_model(), top_n=1)
 
-    # been having an issue where the self_query_llm makes up metadata fields and attributes
-    try:
-        self_query_retriever = SelfQueryRetriever.from_llm(
-            self_query_llm,
-            temp_store,
-            document_contents=DOCUMENT_CONTENT_DESCRIPTION,
-            metadata_field_info=METADATA_FIELD_INFO,
-            use_original_query=False,
-            enable_limit=False,
-            verbose=True,
+        # Same query constructor SelfQueryRetriever.from_llm builds, but its structured
+        # query is translated to a native filter for the main collection instead of
+        # being run against a temporary store of re-embedded coarse search hits
+        self.translator = QdrantTranslator(metadata_key=store.metadata_payload_key)
+        # Only the model call counts against the openai breaker, a structured query the
+        # parser or translator rejects still means the api answered
+        guarded_llm = RunnableLambda(
+            lambda prompt_value: circuit_breakers["openai"].call(
+                self.self_query_llm.invoke, prompt_value
+            )
         )
-        documents = self_query_retriever.invoke(prompt)
-    except Exception as e:
-        logger.error(f"Error while invoking SelfQueryRetriever: {e}")
-        logger.warning(f"Forcing SelfQueryRetriever to NOT generate filters")
-        self_query_retriever_no_meta = SelfQueryRetriever.from_llm(
-            self_query_llm,
-            temp_store,
-            document_contents=DOCUMENT_CONTENT_DESCRIPTION,
-            metadata_field_info=[],
-            use_original_query=False,
+        self.query_constructor = load_query_constructor_runnable(
+            guarded_llm,
+            DOCUMENT_CONTENT_DESCRIPTION,
+            METADATA_FIELD_INFO,
+            allowed_comparators=self.translator.allowed_comparators,
+            allowed_operators=self.translator.allowed_operators,
             enable_limit=False,
-            verbose=True,
         )
-        documents = self_query_retriever_no_meta.invoke(prompt)
 
-    logger.info(
-        f"Coarse search: {COARSE_TOP_K} docs, Self query: {len(documents)} docs"
-    )
+    def structured_query_filter(self, prompt):
+        structured_query = self.query_constructor.invoke({"query": prompt})
+        logger.info(f"Generated structured query: {structured_query}")
+        new_query, search_kwargs = self.translator.visit_structured_query(
+            structured_query
+        )
+        return new_query, search_kwargs.get("filter")
+
+    # Restricts the search to the points found by coarse search, so the self query
+    # still only narrows down those hits. Qdrant scores the vectors it already stores
+    # for them, nothing is re-embedded besides the query itself
+    def search_coarse_hits(self, query, documents, metadata_filter=None):
+        point_ids = [doc.metadata["_id"] for doc in documents if "_id" in doc.metadata]
+        if len(point_ids) != len(documents):
+            logger.warning("Coarse search hits are missing point ids, skipping filter")
+            return documents
 
-    # Log the first document to inspect the structure
-    if documents:
-        logger.info(f"First document structure: {documents[0]}")
+        conditions = [rest.HasIdCondition(has_id=point_ids)]
+        if metadata_filter is not None:
+            conditions.append(metadata_filter)
+        return circuit_breakers["qdrant"].call(
+            self.store.similarity_search,
+            query,
+            k=len(point_ids),
+            filter=rest.Filter(must=conditions),
+        )
+
+    def self_query_wrapper(self, dict):
+        if dict["documents"] == []:
+            return {"documents": [], "query": dict["query"]}
 
-    # Log document titles with error handling
-    titles = []
-    for doc in documents:
+        prompt = self_query_message_prompt(dict["query"])
+
+        # been having an issue where the self_query_llm makes up metadata fields and attributes
         try:
-            titles.append(doc.metadata["name"])
-        except KeyError:
-            logger.warning(f"Document {doc} is missing 'name' in metadata")
+            new_query, metadata_filter = self.structured_query_filter(prompt)
+            documents = self.search_coarse_hits(
+                new_query or dict["query"], dict["documents"], metadata_filter
+            )
+        except CircuitOpenError as e:
+            # Same as the reranker retriever, the coarse hits go straight to fine search
+            logger.warning(f"{e}, skipping the self query filter")
+            documents = dict["documents"]
+        except Exception as e:
+            logger.error(f"Error while running self query filter: {e}")
+            logger.warning(f"Falling back to coarse search hits WITHOUT filters")
+            documents = self.search_coarse_hits(dict["query"], dict["documents"])
 
-    logger.info(f"Titles: {titles}")
-    return {"documents": documents, "query": dict["query"]}
+        logger.info(
+            f"Coarse search: {len(dict['documents'])} docs, Self query: {len(documents)} docs"
+        )
+
+        # Log the first document to inspect the structure
+        if documents:
+            logger.info(f"First document structure: {documents[0]}")
 
+        # Log document titles with error handling
+        titles = []
+        for doc in documents:
+            try:
+                titles.append(doc.metadata["name"])
+            except KeyError:
+                logger.warning(f"Document {doc} is missing 'name' in metadata")
 
-# # Additionally, you can add a log to inspect all documents if needed
-#     logger.info(f"All documents structure: {documents}")
+        logger.info(f"Titles: {titles}")
+        return {"documents": documents, "query": dict["query"]}
 
+    def fine_search_wrapper(self, dict):
+        # Expects chained pass of dict {query: "", documents: ""}
+        if dict["documents"] == []:
+            logger.info(
+                "No documents provided to fine-search. Passing empty list to bedrock llm"
+            )
+            return []
 
-def fine_search_wrapper(dict):
-    # Expects chained pass of dict {query: "", documents: ""}
-    # dependent on global variable fine_retriever
-    if dict["documents"] == []:
+        try:
+            documents_found = circuit_breakers["reranker"].call(
+                self.fine_retriever.compress_documents,
+                query=dict["query"],
+                documents=dict["documents"],
+            )
+        except CircuitOpenError:
+            logger.warning("Reranker circuit open, keeping the coarse ranking")
+            documents_found = dict["documents"][: self.fine_retriever.top_n]
         logger.info(
-            "No documents provided to fine-search. Passing empty list to bedrock llm"
+            f"Retrieval complete - document returned: {[doc.metadata['name'] for doc in documents_found]}"
         )
-        return []
 
-    documents_found = fine_retriever.compress_documents(
-        query=dict["query"], documents=dict["documents"]
-    )
-    logger.info(
-        f"Retrieval complete - document returned: {[doc.metadata['name'] for doc in documents_found]}"
-    )
+        return documents_found
 
-    return documents_found
 
+# One engine per distinct self query llm config, shared by every chain that uses it
+_self_query_engines = {}
+_self_query_engines_lock = Lock()
 
-def initialize_retrieval_chain(retriever, config):
-    global self_query_llm
-    global fine_retriever
-    self_query_llm, fine_retriever = initialize_chain_models(config)
-    retrieval_chain = (
-        RunnableMap({"documents": retriever, "query": RunnablePassthrough()})
-        | self_query_wrapper
-        | fine_search_wrapper
-    )
+
+def get_self_query_engine(store, config):
+    key = (str(config.self_query_api), config.self_query_model)
+    with _self_query_engines_lock:
+        if key not in _self_query_engines:
+            _self_query_engines[key] = SelfQueryRetrievalEngine(store, config)
+        return _self_query_engines[key]
+
+
+# Coarse search followed by the self query filter and the reranker, one query at a time
+class SelfQueryChainRetriever(BaseRetriever):
+    base_retriever: Any
+    engine: Any
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        documents = self.base_retriever.invoke(query)
+        return self.fine_search(query, documents)
+
+    def fine_search(self, query, documents):
+        return self.engine.fine_search_wrapper(
+            self.engine.self_query_wrapper({"documents": documents, "query": query})
+        )
+
+    # Runs the stages after coarse search on hits given as {query: documents}, also
+    # used for the hits of the prompt prefetch
+    def refine(self, candidates):
+        with ThreadPoolExecutor() as executor:
+            results = executor.map(self.fine_search, candidates, candidates.values())
+            return dict(zip(candidates, results))
+
+
+def initialize_retrieval_chain(store, retriever, config):
+    engine = get_self_query_engine(store, config)
+    retrieval_chain = SelfQueryChainRetriever(base_retriever=retriever, engine=engine)
     logger.info("Retrieval chain created")
     return retrieval_chain
@@ -0,0 +1,88 @@
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+from constants import RETRIEVER_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# ConfigParams fields that change how documents are retrieved, generation params are excluded
+COARSE_CONFIG_FIELDS = ["retriever", "coarse_search_type", "coarse_top_k"]
+MMR_CONFIG_FIELDS = ["coarse_lambda", "coarse_fetch_k"]
+RERANKER_CONFIG_FIELDS = ["reranker_top_n"]
+SELF_QUERY_CONFIG_FIELDS = ["self_query_api", "self_query_model"]
+# Fields that change the documents a tool call returns but not the retriever itself
+RESULT_CONFIG_FIELDS = ["prefetch_retrieval"]
+
+
+# Only the fields the selected retriever actually reads are part of the key, so e.g.
+# two coarse requests that differ only in reranker_top_n share the same retriever
+def retriever_cache_key(config):
+    fields = list(COARSE_CONFIG_FIELDS)
+    if config.coarse_search_type == "mmr":
+        fields.extend(MMR_CONFIG_FIELDS)
+    if config.retriever == "reranker":
+        fields.extend(RERANKER_CONFIG_FIELDS)
+    elif config.retriever == "self_query_chain":
+        fields.extend(SELF_QUERY_CONFIG_FIELDS)
+
+    values = config.model_dump(include=set(fields), mode="json")
+    return tuple(sorted(values.items()))
+
+
+# Key for cached retrieval results, prompt prefetch hands queries documents searched
+# for the prompt instead of the query itself
+def retrieval_results_key(config):
+    values = config.model_dump(include=set(RESULT_CONFIG_FIELDS), mode="json")
+    return retriever_cache_key(config) + tuple(sorted(values.items()))
+
+
+# Per worker LRU registry of built retrievers, build_fn is only called on a miss
+class RetrieverRegistry:
+    def __init__(self, build_fn, max_size=RETRIEVER_CACHE_SIZE):
+        self._build_fn = build_fn
+        self._max_size = max_size
+        self._retrievers = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, config):
+        key = retriever_cache_key(config)
+        with self._lock:
+            if key in self._retrievers:
+                self._retrievers.move_to_end(key)
+                self.hits += 1
+                return self._retrievers[key]
+            self.misses += 1
+
+        # Build outside the lock so a slow build doesn't block lookups for other configs
+        logger.info(f"Retriever cache miss, building retriever for {key}")
+        retriever = self._build_fn(config)
+
+        with self._lock:
+            # Another request may have built the same retriever concurrently, keep the first
+            retriever = self._retrievers.setdefault(key, retriever)
+            self._retrievers.move_to_end(key)
+            while len(self._retrievers) > self._max_size:
+                evicted_key, _ = self._retrievers.popitem(last=False)
+                self.evictions += 1
+                logger.info(f"Evicted retriever for {evicted_key}")
+        return retriever
+
+    def clear(self):
+        with self._lock:
+            self._retrievers.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._retrievers),
+                "max_size": self._max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -14,6 +14,34 @@ sleep 3
 echo "Sending request to restore snapshot"
 poetry run python ./initialize_qdrant.py
 
+# Optionally start the shared inference sidecar so workers don't each load the models
+if poetry run python -c "from constants import USE_INFERENCE_SIDECAR; exit(0 if USE_INFERENCE_SIDECAR else 1)"; then
+    INFERENCE_SOCKET_PATH=$(poetry run python -c "from constants import INFERENCE_SOCKET_PATH; print(INFERENCE_SOCKET_PATH)")
+    INFERENCE_STARTUP_TIMEOUT=$(poetry run python -c "from constants import INFERENCE_STARTUP_TIMEOUT; print(INFERENCE_STARTUP_TIMEOUT)")
+    # A socket left by a previous run would pass the readiness check below
+    rm -f "$INFERENCE_SOCKET_PATH"
+
+    echo "Starting inference sidecar"
+    poetry run python ./inference_server.py &
+    SIDECAR_PID=$!
+
+    # Workers load the models themselves when the sidecar isn't reachable
+    waited=0
+    until [ -S "$INFERENCE_SOCKET_PATH" ]; do
+        if ! kill -0 "$SIDECAR_PID" 2>/dev/null; then
+            echo "Inference sidecar exited during startup, workers will load the models"
+            break
+        fi
+        if [ "$waited" -ge "$INFERENCE_STARTUP_TIMEOUT" ]; then
+            echo "Inference sidecar not ready after ${INFERENCE_STARTUP_TIMEOUT}s, workers will load the models"
+            kill "$SIDECAR_PID"
+            break
+        fi
+        sleep 1
+        waited=$((waited + 1))
+    done
+fi
+
 # Initializes server
 echo "Initializing workers"
-poetry run gunicorn main:app --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 --timeout 3600
+poetry run gunicorn main:app --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 --timeout 120
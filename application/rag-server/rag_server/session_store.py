@@ -0,0 +1,63 @@
+import json
+import logging
+import uuid
+
+from cache_utils import LRUCache, SqliteCache
+from constants import (SESSION_MAX_COUNT, SESSION_STORE_BACKEND,
+                       SESSION_STORE_PATH, SESSION_TTL)
+
+logger = logging.getLogger(__name__)
+
+
+# A session is {"format": "chat" | "stream", "messages": [...]}. The format is the
+# message schema of the endpoint that created it, invoke_model for /v1/chat and
+# converse for /v1/chat/stream, the two can't be mixed in one history.
+# Saving a session refreshes its ttl, concurrent turns on one session are last write wins
+class MemorySessionStore:
+    def __init__(self, max_count=SESSION_MAX_COUNT, ttl=SESSION_TTL):
+        self._sessions = LRUCache(max_count, ttl=ttl)
+
+    def get(self, session_id):
+        session = self._sessions.get(session_id)
+        # Callers append to the messages, don't hand out the stored list
+        return json.loads(session) if session is not None else None
+
+    def save(self, session_id, session):
+        self._sessions.set(session_id, json.dumps(session))
+
+    def delete(self, session_id):
+        self._sessions.delete(session_id)
+
+
+class SqliteSessionStore:
+    def __init__(
+        self, path=SESSION_STORE_PATH, max_count=SESSION_MAX_COUNT, ttl=SESSION_TTL
+    ):
+        self._sessions = SqliteCache(path, "sessions", max_entries=max_count, ttl=ttl)
+
+    def get(self, session_id):
+        session = self._sessions.get(session_id)
+        return json.loads(session) if session is not None else None
+
+    def save(self, session_id, session):
+        self._sessions.set(session_id, json.dumps(session))
+
+    def delete(self, session_id):
+        self._sessions.delete(session_id)
+
+
+def initialize_session_store(backend=SESSION_STORE_BACKEND):
+    if backend == "sqlite":
+        return SqliteSessionStore()
+    elif backend == "memory":
+        return MemorySessionStore()
+    raise ValueError(
+        f"Unknown session store backend {backend}, expected memory or sqlite"
+    )
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+session_store = initialize_session_store()
@@ -0,0 +1,62 @@
+"""
+Runs N concurrent chat requests on one event loop, the way a single uvicorn worker
+would, against a local stub Bedrock endpoint. Compares calling the blocking
+run_chat_loop from an async handler with awaiting run_chat_loop_async, and
+reports the peak number of Bedrock requests in flight.
+
+Run from rag-server/rag_server: python test/benchmark_async_chat.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from stub_bedrock_server import StubBedrockServer
+
+CONCURRENT_REQUESTS = [1, 4, 16, 32]
+STUB_LATENCY = 0.5
+
+stub_server = StubBedrockServer(latency=STUB_LATENCY).start()
+
+# Must be set before the bedrock client is created on import
+os.environ["BEDROCK_ENDPOINT_URL"] = stub_server.url
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+
+from api_types import ConfigParams
+from llm.llm_handler import run_chat_loop, run_chat_loop_async
+
+prompt = "Give me a vegan breakfast recipe"
+
+
+# What the /v1/chat handler did before, a blocking call inside async def
+async def blocking_handler(config):
+    return run_chat_loop([], prompt, None, config)
+
+
+async def async_handler(config):
+    return await run_chat_loop_async([], prompt, None, config)
+
+
+async def run_batch(handler, count):
+    config = ConfigParams()
+    stub_server.reset()
+    start = time.perf_counter()
+    await asyncio.gather(*[handler(config) for _ in range(count)])
+    return time.perf_counter() - start, stub_server.max_in_flight
+
+
+async def main():
+    print(f"{'requests':>9} {'handler':>9} {'wall':>8} {'max in flight':>14}")
+    for count in CONCURRENT_REQUESTS:
+        for name, handler in [("blocking", blocking_handler), ("async", async_handler)]:
+            wall, max_in_flight = await run_batch(handler, count)
+            print(f"{count:>9} {name:>9} {wall:>7.2f}s {max_in_flight:>14}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
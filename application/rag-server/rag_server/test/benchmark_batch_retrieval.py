@@ -0,0 +1,70 @@
+"""
+Compares the batched retrieval path (one embedding pass + one Qdrant batch search)
+with the per query thread path for tool calls of 1, 4 and 8 queries.
+
+Requires the qdrant container to be running with the recipe collection restored,
+run from rag-server/rag_server: python test/benchmark_batch_retrieval.py
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_utils import handle_vector_db_queries, initialize_vector_db
+from retrieval_utils import BatchSimilarityRetriever
+
+QUERY_COUNTS = [1, 4, 8]
+REPEATS = 10
+TOP_K = 5
+
+# Sub-queries in the style the model generates for query_food_recipe_vector_db
+sample_queries = [
+    "thai food",
+    "peanut free",
+    "low carb",
+    "not spicy",
+    "vegan breakfast",
+    "gluten free dessert",
+    "quick chicken dinner under 30 minutes",
+    "high protein vegetarian lunch",
+]
+
+
+def time_path(retriever, queries):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        results = handle_vector_db_queries(queries, retriever)
+        timings.append(time.perf_counter() - start)
+        assert len(results) == len(queries), f"Missing results for {queries}"
+    return statistics.median(timings) * 1000, max(timings) * 1000
+
+
+def main():
+    store = initialize_vector_db(needs_init=False)
+    thread_retriever = store.as_retriever(
+        search_type="similarity", search_kwargs={"k": TOP_K}
+    )
+    batch_retriever = BatchSimilarityRetriever(store=store, k=TOP_K)
+
+    # Warm up the model and the http connection so the first timing isn't skewed
+    handle_vector_db_queries(sample_queries[:1], thread_retriever)
+    handle_vector_db_queries(sample_queries[:1], batch_retriever)
+
+    print(
+        f"{'queries':>8} {'thread p50':>12} {'thread max':>12} {'batch p50':>12} {'batch max':>12}"
+    )
+    for count in QUERY_COUNTS:
+        queries = sample_queries[:count]
+        thread_p50, thread_max = time_path(thread_retriever, queries)
+        batch_p50, batch_max = time_path(batch_retriever, queries)
+        print(
+            f"{count:>8} {thread_p50:>10.1f}ms {thread_max:>10.1f}ms {batch_p50:>10.1f}ms {batch_max:>10.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
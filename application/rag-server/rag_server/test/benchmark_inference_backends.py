@@ -0,0 +1,131 @@
+"""
+Parity check and latency/memory benchmark of the onnx and onnx_int8 inference
+backends against the PyTorch models. Each backend is loaded in its own process
+so the reported RSS only includes that backend's models.
+
+Run from rag-server/rag_server: python test/benchmark_inference_backends.py
+"""
+
+import math
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = ["torch", "onnx", "onnx_int8"]
+REPEATS = 10
+
+sample_queries = [
+    "thai food",
+    "peanut free dessert",
+    "low carb breakfast with eggs and spinach",
+    "vegan chocolate cake",
+    "healthy fish dinner under 500 calories",
+    "gluten free pasta",
+    "quick chicken dinner under 30 minutes",
+    "high protein vegetarian lunch with chickpeas",
+]
+
+sample_passages = [
+    "Pad Thai Noodles. Thai rice noodles stir fried with tofu, bean sprouts, egg and tamarind sauce.",
+    "Peanut Butter Cookies. Classic chewy cookies made with creamy peanut butter and brown sugar.",
+    "Spinach and Feta Omelette. A quick low carb breakfast with eggs, fresh spinach and feta cheese.",
+    "Vegan Chocolate Cake. A moist dairy free cake made with cocoa, oil and apple cider vinegar.",
+    "Baked Lemon Cod. Light fish dinner baked with lemon, garlic and herbs, about 300 calories.",
+    "Chickpea Salad. Mediterranean salad with chickpeas, cucumber, tomato and lemon tahini dressing.",
+]
+
+
+def current_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def median_ms(fn):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def run_backend(backend):
+    from model_utils import load_embedding_model, load_reranker_model
+
+    rss_before = current_rss_mb()
+    embedding_model = load_embedding_model(backend)
+    reranker_model = load_reranker_model(backend)
+    rss_after = current_rss_mb()
+
+    pairs = [
+        (query, passage) for query in sample_queries for passage in sample_passages
+    ]
+    embeddings = embedding_model.embed_documents(sample_queries)
+    scores = list(reranker_model.score(pairs))
+
+    return {
+        "backend": backend,
+        "rss_mb": rss_after - rss_before,
+        "embed_1_ms": median_ms(lambda: embedding_model.embed_query(sample_queries[0])),
+        "embed_8_ms": median_ms(
+            lambda: embedding_model.embed_documents(sample_queries)
+        ),
+        "rerank_ms": median_ms(lambda: reranker_model.score(pairs)),
+        "embeddings": embeddings,
+        "scores": scores,
+    }
+
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    return dot / (math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b)))
+
+
+# Fraction of queries whose passages are ranked in exactly the same order, and
+# fraction whose top passage matches
+def rerank_agreement(reference_scores, scores):
+    passage_count = len(sample_passages)
+    same_order = same_top = 0
+    for i in range(len(sample_queries)):
+        window = slice(i * passage_count, (i + 1) * passage_count)
+        reference_order = sorted(
+            range(passage_count), key=lambda j: -reference_scores[window][j]
+        )
+        order = sorted(range(passage_count), key=lambda j: -scores[window][j])
+        same_order += reference_order == order
+        same_top += reference_order[0] == order[0]
+    return same_order / len(sample_queries), same_top / len(sample_queries)
+
+
+def main():
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for backend in BACKENDS:
+        with context.Pool(1) as pool:
+            results[backend] = pool.apply(run_backend, (backend,))
+
+    reference = results["torch"]
+    print(
+        f"{'backend':>10} {'rss':>9} {'embed x1':>10} {'embed x8':>10} {'rerank x48':>11} {'min cos':>8} {'order':>6} {'top1':>6}"
+    )
+    for backend, result in results.items():
+        similarities = [
+            cosine(a, b) for a, b in zip(reference["embeddings"], result["embeddings"])
+        ]
+        same_order, same_top = rerank_agreement(reference["scores"], result["scores"])
+        print(
+            f"{backend:>10} {result['rss_mb']:>7.0f}MB {result['embed_1_ms']:>8.1f}ms "
+            f"{result['embed_8_ms']:>8.1f}ms {result['rerank_ms']:>9.1f}ms "
+            f"{min(similarities):>8.4f} {same_order:>6.0%} {same_top:>6.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Compares the streaming page text extractor with the previous approach, parsing the
+whole page with BeautifulSoup html.parser and truncating the text, on a corpus of
+saved pages. Reports parse time, bytes consumed and how much of the returned text
+is visible content rather than whitespace.
+
+Malformed pages with unclosed skipped elements are checked first, their visible
+text must not be dropped by either backend.
+
+Run from rag-server/rag_server: python test/benchmark_page_extraction.py [pages_dir]
+Without a directory of saved .html pages a synthetic recipe page corpus is used.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+import page_text
+from constants import WEB_MAX_CONTENT_LENGTH, WEB_READ_CHUNK_SIZE
+from page_text import PageTextExtractor
+
+REPEATS = 5
+
+# (page, text that must be extracted)
+MALFORMED_PAGES = [
+    ("<nav>Home<p>x</body></html><p>Real text", "Real text"),
+    ("<nav>Home<noscript>Menu</nav><p>Real text</p>", "Real text"),
+    ("<nav>Home<ul><li>Menu</ul></body><p>Real text</p>", "Real text"),
+    ("<p>Before</p><script>var a;</script><p>After</p>", "Before\nAfter"),
+]
+
+
+def synthetic_page(seed):
+    rng = random.Random(seed)
+    words = (
+        "flour sugar butter eggs milk salt oven bake whisk simmer garlic onion".split()
+    )
+
+    def sentence(n):
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    head = "".join(
+        f"<script>var config{i} = {{{', '.join(f'k{j}: {j}' for j in range(200))}}};</script>"
+        for i in range(20)
+    )
+    style = (
+        "<style>"
+        + " ".join(f".c{i} {{ margin: {i}px; }}" for i in range(2000))
+        + "</style>"
+    )
+    nav = (
+        "<nav>"
+        + "".join(f"<a href='/c/{i}'>Category {i}</a>\n" for i in range(300))
+        + "</nav>"
+    )
+    body = "".join(
+        f"<div class='c{i}'>\n   <p>{sentence(30)}</p>\n   </div>\n" for i in range(400)
+    )
+    return f"<html><head><title>Recipe {seed}</title>{head}{style}</head><body>{nav}{body}</body></html>"
+
+
+def load_corpus(directory):
+    if directory is None:
+        return [synthetic_page(seed).encode("utf-8") for seed in range(20)]
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(directory, name), "rb") as f:
+                pages.append(f.read())
+    return pages
+
+
+# The extraction google_search used before
+def full_parse(page):
+    soup = BeautifulSoup(page.decode("utf-8", errors="replace"), "html.parser")
+    return soup.get_text(separator="\n")[:WEB_MAX_CONTENT_LENGTH], len(page)
+
+
+def streaming_parse(page):
+    extractor = PageTextExtractor(WEB_MAX_CONTENT_LENGTH)
+    consumed = 0
+    for start in range(0, len(page), WEB_READ_CHUNK_SIZE):
+        chunk = page[start : start + WEB_READ_CHUNK_SIZE]
+        extractor.feed(chunk)
+        consumed += len(chunk)
+        if extractor.done:
+            break
+    return extractor.text(), consumed
+
+
+def check_malformed_pages():
+    for page, expected in MALFORMED_PAGES:
+        text = page_text.extract_page_text(page, WEB_MAX_CONTENT_LENGTH)
+        assert expected in text, f"{page!r} extracted as {text!r}"
+
+
+def run(label, extract_fn, corpus):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        outputs = [extract_fn(page) for page in corpus]
+    elapsed = (time.perf_counter() - start) / REPEATS
+    consumed = sum(bytes_read for _text, bytes_read in outputs)
+    visible = sum(len("".join(text.split())) for text, _bytes_read in outputs)
+    total = sum(len(text) for text, _bytes_read in outputs) or 1
+    print(
+        f"{label:<26} {elapsed * 1000 / len(corpus):8.2f} ms/page  "
+        f"read {consumed / len(corpus) / 1024:8.1f} KiB/page  "
+        f"non-whitespace {visible / total:6.1%} of returned text"
+    )
+
+
+if __name__ == "__main__":
+    corpus = load_corpus(sys.argv[1] if len(sys.argv) > 1 else None)
+    size = sum(len(page) for page in corpus) / len(corpus) / 1024
+    print(f"{len(corpus)} pages, {size:.1f} KiB average\n")
+
+    run("bs4 html.parser, full", full_parse, corpus)
+    lxml = page_text.etree
+    page_text.etree = None
+    check_malformed_pages()
+    run("streaming html.parser", streaming_parse, corpus)
+    page_text.etree = lxml
+    if lxml is not None:
+        check_malformed_pages()
+        run("streaming lxml", streaming_parse, corpus)
+    else:
+        print("lxml not installed, skipping the lxml backend")
@@ -0,0 +1,98 @@
+"""
+Runs the web search tool against a local stub search API and result pages, and
+reports the tool call latency, the requests made and the new connections opened.
+Repeated calls should open no new connections, and a hung page should only cost
+the tool call its deadline. With the web cache, a repeated call makes no requests,
+and once its entries are stale they are revalidated with 304 responses.
+
+Run from rag-server/rag_server: python test/benchmark_web_search.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from stub_web_server import StubWebServer
+
+stub_server = StubWebServer(search_latency=0.1, page_latency=0.2).start()
+
+# Must be set before google_search is imported
+os.environ["GOOGLE_SEARCH_API_URL"] = stub_server.search_url
+
+import google_search
+from google_search import FETCH_URL_LIMIT, handle_google_web_search, web_client
+from web_cache import WebCache
+
+queries = ["vegan breakfast", "gluten free pancakes", "quick tofu scramble"]
+
+
+def run(label, deadline=6):
+    stub_server.reset()
+    start = time.perf_counter()
+    results = handle_google_web_search(queries, "stub-key", deadline=deadline)
+    elapsed = time.perf_counter() - start
+    pages = sum(
+        1 for items in results.values() for item in items if item["page_content"]
+    )
+    print(
+        f"{label:<28} {elapsed:6.2f}s  requests={stub_server.requests:<3} "
+        f"new_connections={stub_server.connections:<3} "
+        f"not_modified={stub_server.not_modified:<3} pages_with_content={pages}"
+    )
+    return results, elapsed
+
+
+# Each run gets a fresh cache file, ttl=0 makes every entry stale right away
+def use_web_cache(ttl):
+    path = os.path.join(tempfile.mkdtemp(), "web_cache.sqlite3")
+    google_search.search_cache = WebCache("search", ttl, 100, path)
+    google_search.page_cache = WebCache("page", ttl, 100, path)
+
+
+if __name__ == "__main__":
+    # The pool and deadline checks need every call to reach the stub server
+    google_search.search_cache = None
+    google_search.page_cache = None
+
+    expected_pages = len(queries) * FETCH_URL_LIMIT
+    # One search plus its pages in sequence is the lower bound for a flat pipeline,
+    # all pages come from one host here so WEB_MAX_CONNECTIONS_PER_HOST also applies
+    print(
+        f"Lower bound ~{0.1 + 0.2:.2f}s per call for {len(queries)} searches "
+        f"and {expected_pages} pages"
+    )
+
+    run("cold")
+    _results, _elapsed = run("warm, pooled connections")
+    assert stub_server.connections == 0, "Warm call should reuse pooled connections"
+
+    stub_server.slow_paths = ["/page/vegan%20breakfast/0"]
+    results, elapsed = run("one hung page, 1s deadline", deadline=1)
+    assert elapsed < 2, "Deadline should bound the tool call"
+    assert all(results[query] for query in queries), "Finished searches are kept"
+    stub_server.slow_paths = []
+
+    use_web_cache(ttl=3600)
+    run("cache cold")
+    results, _elapsed = run("cache warm")
+    assert stub_server.requests == 0, "Fresh cache entries need no requests"
+    assert all(item["page_content"] for items in results.values() for item in items)
+
+    use_web_cache(ttl=0)
+    run("cache cold, ttl=0")
+    run("stale, revalidated")
+    expected = len(queries) + expected_pages
+    assert stub_server.not_modified == expected, "Stale entries should get 304s"
+    stub_server.version += 1
+    results, _elapsed = run("stale, content changed")
+    assert stub_server.not_modified == len(queries), "Changed pages are downloaded"
+    assert all(
+        "v2" in item["page_content"] for items in results.values() for item in items
+    ), "Changed pages replace the cached text"
+    print(f"Web cache stats: {google_search.page_cache.stats()}")
+
+    web_client.close()
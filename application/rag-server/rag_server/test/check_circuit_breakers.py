@@ -0,0 +1,230 @@
+"""
+Checks the circuit breakers against fault-injecting local stubs: a stub OpenAI
+endpoint for the self query filter, a stub cross-encoder for the reranker and the
+stub search API for web search. Each dependency is failed until its breaker opens,
+requests are then served by the next retrieval level, or without web search, and
+report it as degraded. Once the dependency recovers the breaker closes again.
+
+Run from rag-server/rag_server: python test/check_circuit_breakers.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai_server import STRUCTURED_QUERY, StubOpenAIServer
+from stub_web_server import StubWebServer
+
+openai_server = StubOpenAIServer().start()
+web_server = StubWebServer(search_latency=0.01, page_latency=0.01).start()
+
+# Must be set before the clients are created
+os.environ["OPENAI_BASE_URL"] = openai_server.base_url
+os.environ["OPENAI_API_KEY"] = "stub"
+os.environ["GOOGLE_SEARCH_API_URL"] = web_server.search_url
+
+from langchain_community.cross_encoders import BaseCrossEncoder
+from langchain_core.documents import Document
+
+import google_search
+import llm.tool_executor as tool_executor
+import retrieval_utils
+from api_types import ConfigParams, DocRetreiver
+from circuit_breaker import (CLOSED, OPEN, CircuitBreaker, CircuitOpenError,
+                             circuit_breakers)
+from llm.tool_context import ToolContext
+
+RESET_TIMEOUT = 0.5
+INVALID_STRUCTURED_QUERY = (
+    '```json\n{"query": "vegan breakfast", '
+    '"filter": "eq(\\"made_up_field\\", 1)"}\n```'
+)
+
+# Every call reaches the stubs
+google_search.search_cache = None
+google_search.page_cache = None
+tool_executor.get_google_search_api_key = lambda: "stub-key"
+for breaker in circuit_breakers.values():
+    breaker.reset_timeout = RESET_TIMEOUT
+
+documents = [
+    Document(page_content=f"Recipe {i}", metadata={"name": f"Recipe {i}", "_id": i})
+    for i in range(5)
+]
+
+
+class StubStore:
+    metadata_payload_key = "metadata"
+
+    def similarity_search(self, query, k, filter=None):
+        return documents[:k]
+
+
+# Scores in reverse order so a reranked result is told apart from the coarse order
+class StubCrossEncoder(BaseCrossEncoder):
+    def __init__(self):
+        self.latency = 0.0
+        self.calls = 0
+
+    def score(self, text_pairs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return [float(i) for i in range(len(text_pairs))]
+
+
+class StubBaseRetriever:
+    def batch_retrieve(self, queries):
+        return {query: documents for query in queries}
+
+
+def expect_state(name, state):
+    actual = circuit_breakers[name].state
+    assert actual == state, f"{name} circuit is {actual}, expected {state}"
+    print(f"  {name} circuit {state}: {circuit_breakers[name].stats()}")
+
+
+def check_state_machine():
+    print("Breaker state machine")
+    breaker = CircuitBreaker(
+        "unit", failure_threshold=2, slow_call_seconds=0.05, reset_timeout=0.2
+    )
+
+    def fail():
+        raise ConnectionError("injected")
+
+    for _ in range(2):
+        try:
+            breaker.call(fail)
+        except ConnectionError:
+            pass
+    assert breaker.state == OPEN
+    try:
+        breaker.call(lambda: None)
+        raise AssertionError("An open breaker must not call through")
+    except CircuitOpenError:
+        pass
+
+    time.sleep(0.2)
+    breaker.call(time.sleep, 0.1)  # A slow trial call re-opens it
+    assert breaker.state == OPEN
+    time.sleep(0.2)
+    assert breaker.allow(), "A half open breaker lets a trial call through"
+    assert not breaker.allow(), "Only one trial call at a time"
+    breaker.record_success(0.0)
+    assert breaker.state == CLOSED and breaker.allow()
+    print(f"  {breaker.stats()}")
+
+
+def check_self_query(reranker_model):
+    print("self_query_chain -> reranker when OpenAI fails")
+    retrieval_utils.get_reranker_model = lambda: reranker_model
+    config = ConfigParams(retriever=DocRetreiver.self_query_chain)
+    engine = retrieval_utils.SelfQueryRetrievalEngine(StubStore(), config)
+    request = {"documents": documents, "query": "vegan breakfast"}
+
+    engine.self_query_wrapper(request)
+    expect_state("openai", CLOSED)
+
+    # A structured query the translator rejects is not an OpenAI failure
+    openai_server.content = INVALID_STRUCTURED_QUERY
+    for _ in range(3):
+        result = engine.self_query_wrapper(request)
+    assert result["documents"], "Coarse hits are searched without the filter"
+    expect_state("openai", CLOSED)
+    openai_server.content = STRUCTURED_QUERY
+
+    openai_server.status = 500
+    for _ in range(3):
+        engine.self_query_wrapper(request)
+    expect_state("openai", OPEN)
+
+    openai_server.reset()
+    result = engine.self_query_wrapper(request)
+    assert openai_server.requests == 0, "OpenAI is skipped while the circuit is open"
+    assert result["documents"] == documents, "Coarse hits go straight to fine search"
+    assert tool_executor.retrieval_degradations(config) == [
+        "self_query_chain -> reranker, openai circuit open"
+    ]
+
+    openai_server.status = 200
+    time.sleep(RESET_TIMEOUT)
+    engine.self_query_wrapper(request)
+    expect_state("openai", CLOSED)
+
+
+def check_reranker(reranker_model):
+    print("reranker -> coarse when the reranker is slow")
+    circuit_breakers["reranker"].slow_call_seconds = 0.1
+    config = ConfigParams(retriever=DocRetreiver.reranker)
+    retriever = retrieval_utils.BatchRerankRetriever(
+        base_retriever=StubBaseRetriever(), model=reranker_model, top_n=2
+    )
+
+    reranker_model.latency = 0.2
+    for _ in range(3):
+        reranked = retriever.batch_retrieve(["vegan breakfast"])["vegan breakfast"]
+    assert reranked == [documents[4], documents[3]]
+    expect_state("reranker", OPEN)
+
+    calls = reranker_model.calls
+    coarse = retriever.batch_retrieve(["vegan breakfast"])["vegan breakfast"]
+    assert (
+        reranker_model.calls == calls
+    ), "Reranker is skipped while the circuit is open"
+    assert coarse == documents[:2], "Coarse ranking is kept"
+    assert tool_executor.retrieval_degradations(config) == [
+        "reranker -> coarse, reranker circuit open"
+    ]
+
+    reranker_model.latency = 0.0
+    time.sleep(RESET_TIMEOUT)
+    retriever.batch_retrieve(["vegan breakfast"])
+    expect_state("reranker", CLOSED)
+
+
+def check_web_search():
+    print("google_web_search skipped when the search API fails")
+    tool_context = ToolContext(None)
+
+    def web_search(query):
+        tool_call = {
+            "id": f"toolu_{query}",
+            "name": "google_web_search",
+            "input": {"queries": [query]},
+        }
+        return tool_executor.run_tool_call(tool_call, tool_context)
+
+    web_server.search_status = 500
+    for i in range(3):
+        web_search(f"egg substitute {i}")
+    expect_state("google_search", OPEN)
+
+    web_server.reset()
+    result = web_search("egg substitute")
+    assert result["is_error"] and web_server.requests == 0
+    degraded = tool_context.pop_degraded()
+    assert degraded and degraded[0]["name"] == "google_web_search", degraded
+    print(f"  degraded fn_calls entry: {degraded[0]}")
+
+    web_server.search_status = 200
+    time.sleep(RESET_TIMEOUT)
+    # A tool call that fails before any search request doesn't use up the trial call
+    tool_executor.get_google_search_api_key = lambda: 1 / 0
+    assert web_search("egg substitute")["is_error"]
+    tool_executor.get_google_search_api_key = lambda: "stub-key"
+    result = web_search("egg substitute")
+    assert not result["is_error"]
+    expect_state("google_search", CLOSED)
+
+
+if __name__ == "__main__":
+    check_state_machine()
+    reranker_model = StubCrossEncoder()
+    check_self_query(reranker_model)
+    check_reranker(reranker_model)
+    check_web_search()
+    google_search.web_client.close()
+    print("All circuit breaker checks passed")
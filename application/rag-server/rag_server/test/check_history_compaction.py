@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm.history_compaction import (ELIDED_PREFIX, compact_history,
+                                    message_tokens, tool_result_text,
+                                    validate_message_structure)
+
+# Deterministic checks for the chat history compaction, run with
+#   python test/check_history_compaction.py
+# Builds synthetic conversations in both message schemas, compacts them under a
+# range of token ceilings and asserts the result is still a valid conversation
+
+RECIPE_TEXT = "\n".join(
+    f"Recipe: Dish {i} (id: r{i})\ningredients: " + "flour, sugar, " * 40
+    for i in range(3)
+)
+
+
+def invoke_turn(turn, tool_rounds):
+    messages = [
+        {"role": "user", "content": [{"type": "text", "text": f"prompt {turn}"}]}
+    ]
+    for round in range(tool_rounds):
+        ids = [f"t{turn}_{round}_{i}" for i in range(2)]
+        messages.append(
+            {
+                "role": "assistant",
+                "content": [
+                    {"type": "tool_use", "id": id, "name": "tool", "input": {}}
+                    for id in ids
+                ],
+            }
+        )
+        messages.append(
+            {
+                "role": "user",
+                "content": [
+                    {"type": "tool_result", "tool_use_id": id, "content": RECIPE_TEXT}
+                    for id in ids
+                ],
+            }
+        )
+    messages.append(
+        {"role": "assistant", "content": [{"type": "text", "text": f"answer {turn}"}]}
+    )
+    return messages
+
+
+def converse_turn(turn, tool_rounds):
+    messages = [{"role": "user", "content": [{"text": f"prompt {turn}"}]}]
+    for round in range(tool_rounds):
+        ids = [f"t{turn}_{round}_{i}" for i in range(2)]
+        messages.append(
+            {
+                "role": "assistant",
+                "content": [{"text": "searching"}]
+                + [
+                    {"toolUse": {"toolUseId": id, "name": "tool", "input": {}}}
+                    for id in ids
+                ],
+            }
+        )
+        messages.append(
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "toolResult": {
+                            "toolUseId": id,
+                            "content": [{"text": RECIPE_TEXT}],
+                            "status": "success",
+                        }
+                    }
+                    for id in ids
+                ],
+            }
+        )
+    messages.append({"role": "assistant", "content": [{"text": f"answer {turn}"}]})
+    return messages
+
+
+def build_history(turn_fn, turns):
+    messages = []
+    for turn in range(turns):
+        messages.extend(turn_fn(turn, tool_rounds=turn % 3))
+    # The current request, a new prompt without an answer yet
+    messages.append(turn_fn(turns, tool_rounds=0)[0])
+    return messages
+
+
+def total_tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+
+def check(turn_fn):
+    history = build_history(turn_fn, turns=8)
+    original = json.dumps(history)
+    assert validate_message_structure(history) == [], validate_message_structure(
+        history
+    )
+    full_tokens = total_tokens(history)
+
+    # Under the ceiling nothing changes
+    assert compact_history(history, full_tokens) is history
+
+    for ceiling in [full_tokens // 2, full_tokens // 4, 500, 1]:
+        compacted = compact_history(history, ceiling, keep_recent_turns=2)
+        problems = validate_message_structure(compacted)
+        assert problems == [], (ceiling, problems)
+        # The input is never modified
+        assert json.dumps(history) == original
+        # The last two turns are sent verbatim
+        assert compacted[-1] == history[-1]
+        assert compacted[-5:] == history[-5:]
+        assert total_tokens(compacted) < full_tokens
+        # Same input, same output
+        assert compacted == compact_history(history, ceiling, keep_recent_turns=2)
+
+    # Eliding alone is enough for a moderate ceiling, no turn is dropped
+    compacted = compact_history(history, full_tokens // 2, keep_recent_turns=2)
+    assert len(compacted) == len(history)
+    assert total_tokens(compacted) <= full_tokens // 2
+    elided = [
+        block
+        for message in compacted
+        for block in message["content"]
+        if isinstance(block, dict)
+        and ("toolResult" in block or "tool_use_id" in block)
+        and tool_result_text(block).startswith(ELIDED_PREFIX)
+    ]
+    assert elided and "Dish 0 (id: r0)" in tool_result_text(elided[0])
+
+    # Very low ceilings drop the oldest turns but keep starting with a user prompt
+    compacted = compact_history(history, 1, keep_recent_turns=2)
+    assert compacted[0]["role"] == "user" and len(compacted) < len(history)
+
+    # Short conversations are never compacted below the recent turns
+    short = build_history(turn_fn, turns=1)
+    assert compact_history(short, 1, keep_recent_turns=2) is short
+
+    # The validator notices broken pairing
+    broken = [message for i, message in enumerate(history) if i != 4]
+    assert validate_message_structure(broken) != []
+
+
+if __name__ == "__main__":
+    check(invoke_turn)
+    check(converse_turn)
+    print("History compaction checks passed")
@@ -0,0 +1,103 @@
+"""
+Runs the async chat loop against a stub Bedrock model that never stops calling the
+recipe db tool, with a stub retriever, and checks that a request stays within its
+deadline: tool rounds are capped, a tool call that outlives the time left for tools
+is abandoned and the model is asked for its answer, and a Bedrock call past the
+deadline fails the request with DeadlineExceeded.
+
+Run from rag-server/rag_server: python test/check_request_deadline.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from stub_bedrock_server import StubBedrockServer, stub_response
+
+stub_server = StubBedrockServer(latency=0.2, tool_use=True).start()
+
+# Must be set before the bedrock client is created on import
+os.environ["BEDROCK_ENDPOINT_URL"] = stub_server.url
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+
+from langchain_core.documents import Document
+
+from api_types import ConfigParams
+from deadline import Deadline, DeadlineExceeded
+from llm.llm_handler import run_chat_loop_async
+from tool_cache import tool_result_caches
+
+prompt = "Give me a vegan breakfast recipe"
+stub_answer = stub_response["content"][0]["text"]
+
+
+class StubRetriever:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def batch_retrieve(self, queries):
+        time.sleep(self.delay)
+        return {
+            query: [
+                Document(
+                    page_content=f"Recipe for {query}",
+                    metadata={"name": query, "recipe_id": "stub"},
+                )
+            ]
+            for query in queries
+        }
+
+
+async def run(label, retriever, config, deadline):
+    tool_result_caches["query_food_recipe_vector_db"].clear_memory()
+    stub_server.reset()
+    start = time.perf_counter()
+    try:
+        text, history, fn_calls = await run_chat_loop_async(
+            [], prompt, retriever, config, deadline
+        )
+        outcome = f"answer={text!r} tool_rounds={len(fn_calls)}"
+    except DeadlineExceeded as e:
+        text, history, fn_calls = None, None, None
+        outcome = f"DeadlineExceeded: {e}"
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<34} {elapsed:5.2f}s  bedrock_requests={stub_server.requests}  "
+        f"{outcome}"
+    )
+    return elapsed, text, history
+
+
+async def main():
+    config = ConfigParams(max_tool_rounds=2)
+    elapsed, text, history = await run(
+        "tool rounds capped at 2", StubRetriever(0.05), config, Deadline(30)
+    )
+    assert stub_server.requests == 3, "Two tool rounds and one final answer"
+    assert text == stub_answer
+    assert history[-2]["content"][-1]["type"] == "text", "Answer was requested"
+
+    elapsed, text, history = await run(
+        "hung retrieval, 3s deadline",
+        StubRetriever(10),
+        ConfigParams(),
+        Deadline(3, reserve=1),
+    )
+    assert elapsed < 3, "The request should finish within its deadline"
+    assert text == stub_answer
+    assert history[-2]["content"][0]["is_error"], "Timed out tool call is an error"
+
+    stub_server.latency = 2
+    elapsed, text, _history = await run(
+        "slow bedrock, 1s deadline", StubRetriever(0.05), ConfigParams(), Deadline(1)
+    )
+    assert text is None and elapsed < 1.5, "Bedrock waits are bounded too"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
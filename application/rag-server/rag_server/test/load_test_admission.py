@@ -0,0 +1,191 @@
+"""
+Load test for admission control on the chat endpoints. Serves a small app with the
+same admission handling as /v1/chat and /v1/chat/stream on one uvicorn worker, the
+chat route runs the async chat loop against a local stub Bedrock endpoint. A burst
+of requests larger than the concurrency limit plus the queue is sent at once: the
+number of Bedrock calls in flight must stay within the limit, requests over the
+queue are shed right away with 429 and Retry-After, queued requests that wait too
+long are shed once their queue time is up, and every slot is given back, also for
+streams the client abandons. The same burst without admission control is run for
+comparison.
+
+Run from rag-server/rag_server: python test/load_test_admission.py
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from stub_bedrock_server import StubBedrockServer
+
+STUB_LATENCY = 0.5
+BURST_SIZE = 40
+MAX_CONCURRENT = 4
+MAX_QUEUE = 8
+MAX_QUEUE_WAIT = 0.8
+
+stub_server = StubBedrockServer(latency=STUB_LATENCY).start()
+
+# Must be set before the bedrock client is created on import
+os.environ["BEDROCK_ENDPOINT_URL"] = stub_server.url
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+
+import aiohttp
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from admission import (AdmissionController, admission_controllers,
+                       admission_stats, admit_request)
+from api_types import ConfigParams
+from llm.llm_handler import run_chat_loop_async
+
+PORT = 8390
+BASE_URL = f"http://127.0.0.1:{PORT}"
+prompt = "Give me a vegan breakfast recipe"
+
+app = FastAPI()
+
+
+@app.post("/v1/chat")
+async def chat():
+    release = await admit_request("chat")
+    try:
+        text, _history, _fn_calls = await run_chat_loop_async(
+            [], prompt, None, ConfigParams()
+        )
+        return {"llm_response_text": text}
+    finally:
+        release()
+
+
+# Slow stream standing in for the model output, released like /v1/chat/stream
+@app.post("/v1/chat/stream")
+async def chat_stream():
+    release = await admit_request("chat_stream")
+
+    def event_stream():
+        try:
+            for i in range(20):
+                time.sleep(0.1)
+                yield f"data: {i}\n\n"
+        finally:
+            release()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        background=BackgroundTask(release),
+    )
+
+
+@app.get("/v1/metrics")
+async def metrics():
+    return {"admission": admission_stats()}
+
+
+def set_limits(max_concurrent, max_queue, max_queue_wait):
+    for endpoint in ["chat", "chat_stream"]:
+        admission_controllers[endpoint] = AdmissionController(
+            endpoint, max_concurrent, max_queue, max_queue_wait
+        )
+
+
+async def send_chat(session):
+    start = time.perf_counter()
+    async with session.post(f"{BASE_URL}/v1/chat") as response:
+        await response.read()
+        return (
+            response.status,
+            time.perf_counter() - start,
+            response.headers.get("Retry-After"),
+        )
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_burst(label):
+    stub_server.reset()
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0)
+    ) as session:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[send_chat(session) for _ in range(BURST_SIZE)])
+        wall = time.perf_counter() - start
+        async with session.get(f"{BASE_URL}/v1/metrics") as response:
+            stats = (await response.json())["admission"]["chat"]
+
+    ok = [elapsed for status, elapsed, _ in results if status == 200]
+    shed = [(elapsed, retry) for status, elapsed, retry in results if status == 429]
+    print(
+        f"{label:<18} wall={wall:5.2f}s ok={len(ok):>2} 429={len(shed):>2} "
+        f"ok_p50={percentile(ok, 0.5):4.2f}s ok_p95={percentile(ok, 0.95):4.2f}s "
+        f"429_max={max([e for e, _ in shed], default=0):4.2f}s "
+        f"bedrock_max_in_flight={stub_server.max_in_flight}"
+    )
+    print(f"{'':<18} {stats}")
+    return results, stats
+
+
+async def check_shedding():
+    set_limits(MAX_CONCURRENT, MAX_QUEUE, MAX_QUEUE_WAIT)
+    results, stats = await run_burst("with admission")
+    statuses = [status for status, _, _ in results]
+    assert set(statuses) <= {200, 429}, statuses
+    assert stub_server.max_in_flight <= MAX_CONCURRENT, "Concurrency limit holds"
+    assert all(
+        retry and int(retry) >= 1 for status, _, retry in results if status == 429
+    )
+    assert stats["rejected_queue_full"] == BURST_SIZE - MAX_CONCURRENT - MAX_QUEUE
+    assert stats["rejected_queue_timeout"] > 0, "Requests queued too long are shed"
+    queue_full = sorted(elapsed for status, elapsed, _ in results if status == 429)
+    assert queue_full[0] < 0.2, "A full queue fails fast"
+    assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
+
+    set_limits(10000, 0, MAX_QUEUE_WAIT)
+    await run_burst("without admission")
+
+
+async def check_abandoned_streams():
+    set_limits(2, 2, 5)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(3):
+            # Read the first event then drop the connection
+            async with session.post(f"{BASE_URL}/v1/chat/stream") as response:
+                assert response.status == 200
+                await response.content.readline()
+            await asyncio.sleep(0)
+        await asyncio.sleep(2.5)
+        async with session.get(f"{BASE_URL}/v1/metrics") as response:
+            stats = (await response.json())["admission"]["chat_stream"]
+    print(f"abandoned streams   {stats}")
+    assert stats["admitted"] == 3 and stats["in_flight"] == 0, "Slots are released"
+
+
+async def main():
+    await check_shedding()
+    await check_abandoned_streams()
+
+
+if __name__ == "__main__":
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=PORT, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    asyncio.run(main())
+    server.should_exit = True
+    print("All admission checks passed")
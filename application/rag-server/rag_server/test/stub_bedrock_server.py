@@ -0,0 +1,109 @@
+"""
+Local stand-in for the Bedrock runtime invoke_model endpoint. Every request sleeps
+for a fixed latency and answers with a plain text end_turn message, the number of
+requests in flight is tracked so benchmarks can see how many calls overlap. With
+tool_use set it plays a model that keeps calling the recipe db tool until the last
+message tells it to answer.
+
+Point the server at it with BEDROCK_ENDPOINT_URL=http://127.0.0.1:<port>
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+stub_response = {
+    "id": "msg_stub",
+    "type": "message",
+    "role": "assistant",
+    "model": "claude-3-sonnet-20240229",
+    "content": [{"type": "text", "text": "Here is a stub recipe."}],
+    "stop_reason": "end_turn",
+    "stop_sequence": None,
+    "usage": {"input_tokens": 10, "output_tokens": 5},
+}
+
+stub_tool_use_response = {
+    **stub_response,
+    "content": [
+        {
+            "type": "tool_use",
+            "id": "toolu_stub",
+            "name": "query_food_recipe_vector_db",
+            "input": {"queries": ["vegan breakfast"]},
+        }
+    ],
+    "stop_reason": "tool_use",
+}
+
+
+def asks_for_answer(request_body):
+    messages = json.loads(request_body).get("messages") or [{}]
+    content = messages[-1].get("content")
+    if not isinstance(content, list):
+        return False
+    return any(
+        block.get("type") == "text" and "Answer the user now" in block.get("text", "")
+        for block in content
+    )
+
+
+class StubBedrockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.5, tool_use=False):
+        super().__init__(("127.0.0.1", port), StubBedrockHandler)
+        self.latency = latency
+        self.tool_use = tool_use
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset(self):
+        with self.lock:
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.requests = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubBedrockHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            response = stub_response
+            if server.tool_use and not asks_for_answer(request_body):
+                response = stub_tool_use_response
+            body = json.dumps(response).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    server = StubBedrockServer(port=8100)
+    print(f"Stub Bedrock listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,95 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint used by the self query chain.
+Every completion is a structured query without a filter. Faults are injected with
+latency and status, e.g. status=500 fails every request and latency=10 makes the
+requests hang past the client timeout. Setting content answers with something else,
+like a structured query on a made up metadata field.
+
+Point a client at it with base_url=http://127.0.0.1:<port>/v1
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STRUCTURED_QUERY = '```json\n{"query": "vegan breakfast", "filter": "NO_FILTER"}\n```'
+
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.05):
+        super().__init__(("127.0.0.1", port), StubOpenAIHandler)
+        self.latency = latency
+        self.status = 200
+        self.content = STRUCTURED_QUERY
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        if server.status != 200:
+            self.respond({"error": {"message": "Injected failure"}}, server.status)
+            return
+        self.respond(
+            {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": server.content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 10,
+                    "total_tokens": 20,
+                },
+            }
+        )
+
+    def respond(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, as it should for injected latency
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    server = StubOpenAIServer(port=8300)
+    print(f"Stub OpenAI listening on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,128 @@
+"""
+Local stand-in for the Google Custom Search API and the result pages it links to.
+Searches return FETCH_URL_LIMIT items pointing back at this server, pages are small
+HTML documents served after a configurable latency. Every response has an ETag and
+conditional requests for unchanged content are answered with 304 Not Modified.
+Requests, new connections and 304 responses are counted so benchmarks can check that
+connections are reused and stale cache entries are revalidated. search_status can be
+set to inject search API errors.
+
+Point the server at it with GOOGLE_SEARCH_API_URL=http://127.0.0.1:<port>/customsearch/v1
+"""
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+PAGE_HTML = """<html><head><title>{title}</title><style>body {{ color: red; }}</style>
+<script>var tracking = "{title}";</script></head>
+<body><nav>Home | Recipes | About</nav><h1>{title}</h1>
+<p>Preheat the oven and mix the ingredients for {title}.</p></body></html>"""
+
+
+class StubWebServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, search_latency=0.1, page_latency=0.2, items=3):
+        super().__init__(("127.0.0.1", port), StubWebHandler)
+        self.search_latency = search_latency
+        self.page_latency = page_latency
+        self.items = items
+        # Pages whose path contains one of these are served after slow_latency
+        self.slow_paths = []
+        self.slow_latency = 10
+        # Bump to change the content, and so the ETag, of every search and page
+        self.version = 1
+        # Status of every search response, e.g. 500 or 429 to inject failures
+        self.search_status = 200
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def search_url(self):
+        return f"{self.url}/customsearch/v1"
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+            self.not_modified = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubWebHandler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1 and a Content-Length on every response
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        url = urlparse(self.path)
+        if url.path == "/customsearch/v1":
+            query = parse_qs(url.query).get("q", [""])[0]
+            time.sleep(server.search_latency)
+            if server.search_status != 200:
+                self.respond("text/plain", "Injected failure", server.search_status)
+                return
+            items = [
+                {
+                    "title": f"{query} result {i}",
+                    "snippet": f"Snippet for {query} result {i}",
+                    "link": f"{server.url}/page/{quote(query)}/{i}",
+                }
+                for i in range(server.items)
+            ]
+            self.respond_cacheable("application/json", json.dumps({"items": items}))
+        elif url.path.startswith("/page/"):
+            slow = any(path in url.path for path in server.slow_paths)
+            time.sleep(server.slow_latency if slow else server.page_latency)
+            title = f"{url.path} v{server.version}"
+            self.respond_cacheable("text/html", PAGE_HTML.format(title=title))
+        else:
+            self.respond("text/plain", "Not found", status=404)
+
+    def respond_cacheable(self, content_type, body):
+        etag = f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            self.respond(content_type, "", status=304, etag=etag)
+        else:
+            self.respond(content_type, body, etag=etag)
+
+    def respond(self, content_type, body, status=200, etag=None):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    server = StubWebServer(port=8200)
+    print(f"Stub web search listening on {server.search_url}")
+    server.serve_forever()
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from cache_utils import LRUCache, SqliteCache
+from constants import (COLLECTION_EPOCH_PATH, TOOL_CACHE_MAX_DISK_ENTRIES,
+                       TOOL_CACHE_PATH, TOOL_CACHE_SIZE, TOOL_CACHE_TTLS,
+                       USE_SHARED_TOOL_CACHE)
+from embedding_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+# The epoch is the modification time of a marker file, so every worker on the host
+# sees a re-created or restored collection without any coordination
+def get_collection_epoch():
+    try:
+        return os.stat(COLLECTION_EPOCH_PATH).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def bump_collection_epoch():
+    directory = os.path.dirname(COLLECTION_EPOCH_PATH)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(COLLECTION_EPOCH_PATH, "w") as f:
+        f.write(str(time.time()))
+    for cache in tool_result_caches.values():
+        cache.clear_memory()
+    logger.info(f"Bumped collection epoch to {get_collection_epoch()}")
+
+
+# Caches the formatted content of a tool call. Keys cover the tool, the normalized
+# query list and whatever else changes the result, e.g. the retrieval config
+class ToolResultCache:
+    def __init__(self, tool_name, ttl, memory_size=TOOL_CACHE_SIZE, disk_path=None):
+        self.tool_name = tool_name
+        self.memory_cache = LRUCache(memory_size, ttl=ttl)
+        self.disk_cache = None
+        if disk_path:
+            try:
+                self.disk_cache = SqliteCache(
+                    disk_path,
+                    f"tool_{tool_name}",
+                    max_entries=TOOL_CACHE_MAX_DISK_ENTRIES,
+                    ttl=ttl,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"{tool_name} disk cache disabled, failed to open it: {e}"
+                )
+
+        self._stats_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def cache_key(self, queries, *key_parts):
+        key_data = {
+            "tool": self.tool_name,
+            "queries": [normalize_text(query) for query in queries],
+            "key_parts": key_parts,
+        }
+        key_text = json.dumps(key_data, sort_keys=True, default=str)
+        return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+    def _record(self, stat):
+        with self._stats_lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+
+    def get(self, key):
+        content = self.memory_cache.get(key)
+        if content is not None:
+            self._record("memory_hits")
+            return content
+
+        if self.disk_cache is not None:
+            content = self.disk_cache.get(key)
+            if content is not None:
+                self.memory_cache.set(key, content)
+                self._record("disk_hits")
+                return content
+
+        self._record("misses")
+        return None
+
+    def set(self, key, content):
+        self.memory_cache.set(key, content)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, content)
+
+    def clear_memory(self):
+        self.memory_cache.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "memory_size": len(self.memory_cache),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+
+tool_result_caches = {
+    tool_name: ToolResultCache(
+        tool_name, ttl, disk_path=TOOL_CACHE_PATH if USE_SHARED_TOOL_CACHE else None
+    )
+    for tool_name, ttl in TOOL_CACHE_TTLS.items()
+}
+
+
+def tool_cache_stats():
+    return {name: cache.stats() for name, cache in tool_result_caches.items()}
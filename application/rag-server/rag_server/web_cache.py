@@ -0,0 +1,130 @@
+import json
+import logging
+import threading
+import time
+
+from cache_utils import SqliteCache
+from constants import (USE_WEB_CACHE, WEB_CACHE_MAX_STALE, WEB_CACHE_PATH,
+                       WEB_PAGE_CACHE_MAX_ENTRIES, WEB_PAGE_CACHE_TTL,
+                       WEB_SEARCH_CACHE_MAX_ENTRIES, WEB_SEARCH_CACHE_TTL)
+
+logger = logging.getLogger(__name__)
+
+
+# Holds JSON values with the ETag and Last-Modified headers of the response they came
+# from. Entries past the ttl are still returned, marked stale, so the caller can
+# revalidate them with a conditional request instead of downloading them again. The
+# table itself only drops entries once they are older than max_stale
+class WebCache:
+    def __init__(self, name, ttl, max_entries, path, max_stale=WEB_CACHE_MAX_STALE):
+        self.name = name
+        self.ttl = ttl
+        self.disk_cache = None
+        try:
+            self.disk_cache = SqliteCache(
+                path, f"web_{name}", max_entries=max_entries, ttl=max(ttl, max_stale)
+            )
+        except Exception as e:
+            logger.warning(f"Web {name} cache disabled, failed to open it: {e}")
+
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.refreshed = 0
+        self.stale_served = 0
+
+    def _record(self, stat):
+        with self._stats_lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+
+    # Returns (entry, is_fresh), or (None, False) on a miss
+    def get(self, key):
+        if self.disk_cache is None:
+            return None, False
+        row = self.disk_cache.get_entry(key)
+        if row is None:
+            self._record("misses")
+            return None, False
+        value, created_at = row
+        try:
+            entry = json.loads(value)
+        except ValueError:
+            self._record("misses")
+            return None, False
+        if time.time() - created_at <= self.ttl:
+            self._record("hits")
+            return entry, True
+        return entry, False
+
+    def set(self, key, entry):
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, json.dumps(entry))
+
+    # Called with the stale entry when the server answered 304 Not Modified, storing
+    # it again resets its age
+    def mark_revalidated(self, key, entry):
+        self._record("revalidated")
+        self.set(key, entry)
+
+    # Called when a stale entry was replaced by a full response
+    def mark_refreshed(self):
+        self._record("refreshed")
+
+    # Called when a stale entry was used because refreshing it failed
+    def mark_stale_served(self):
+        self._record("stale_served")
+
+    def stats(self):
+        with self._stats_lock:
+            stale = self.revalidated + self.refreshed + self.stale_served
+            lookups = self.hits + self.misses + stale
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "refreshed": self.refreshed,
+                "stale_served": self.stale_served,
+                "hit_rate": (
+                    (self.hits + self.revalidated) / lookups if lookups else 0.0
+                ),
+            }
+
+
+# Headers for a conditional request revalidating a stale entry
+def conditional_headers(entry):
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def validators(response):
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+# query -> search result list and url -> extracted page text
+search_cache = None
+page_cache = None
+if USE_WEB_CACHE:
+    search_cache = WebCache(
+        "search", WEB_SEARCH_CACHE_TTL, WEB_SEARCH_CACHE_MAX_ENTRIES, WEB_CACHE_PATH
+    )
+    page_cache = WebCache(
+        "page", WEB_PAGE_CACHE_TTL, WEB_PAGE_CACHE_MAX_ENTRIES, WEB_CACHE_PATH
+    )
+
+
+def web_cache_stats():
+    return {
+        name: cache.stats()
+        for name, cache in (("search", search_cache), ("page", page_cache))
+        if cache is not None
+    }